@@ -1,12 +1,21 @@
-import time
+import os
+import asyncio
 import tkinter as tk
 from tkinter import ttk
-import threading
+from tkinter import filedialog
+from Trajectory import Trajectory, build, iter_build
+from JobExecutor import JobExecutor
+from PathOptimizer import merge_collinear
+from PreviewRenderer import PreviewRenderer
+from MotionModel import MotionModel
+from Raster import IMAGE, load_image, iter_raster, build_raster
+from Journal import Journal
 
 
 WIDTH = 300
 HEIGHT = 300
 WIDTH_ENTRY = 5
+PREVIEW_PIXELS = 250000  # プレビューでは画像をこの画素数まで間引く
 
 
 class CommandWindow(tk.Toplevel):
@@ -16,10 +25,14 @@ class CommandWindow(tk.Toplevel):
         self.cl = cl
         self.stage = stage
         self.laser = laser
+        # 加速を考慮して線分ごとの時間を見積もる
+        self.model = MotionModel(cl.motion_acceleration, cl.motion_max_velocity, cl.motion_settle)
+        self.image = None  # 彫刻する画像 (RasterImage)
+        self.image_file = ''
 
         self.create_widgets()
 
-        self.update_canvas()
+        self.preview.draw(self.get_points())
         self.bind('<Key>', self.update_canvas)
 
     def create_widgets(self):
@@ -27,10 +40,12 @@ class CommandWindow(tk.Toplevel):
         self.canvas = tk.Canvas(self, width=WIDTH, height=HEIGHT, background='white')
         frame_setting.grid(row=0, column=0)
         self.canvas.grid(row=1, column=0)
+        self.preview = PreviewRenderer(self.canvas, WIDTH, HEIGHT)
 
         self.shape = tk.IntVar(value=0)
         radio_line = ttk.Radiobutton(frame_setting, text="Line", command=self.update, variable=self.shape, value=0)
         radio_rect = ttk.Radiobutton(frame_setting, text="Rectangle", command=self.update, variable=self.shape, value=1)
+        radio_image = ttk.Radiobutton(frame_setting, text="Image", command=self.update, variable=self.shape, value=IMAGE)
         label_x = ttk.Label(frame_setting, text='X [\u03bcm]')
         label_y = ttk.Label(frame_setting, text='Y [\u03bcm]')
         self.x = tk.IntVar(value=100)
@@ -49,6 +64,12 @@ class CommandWindow(tk.Toplevel):
         self.radio_vertical = ttk.Radiobutton(frame_setting, text="縦", command=self.update, variable=self.direction, value=0, state=tk.DISABLED)
         self.radio_horizontal = ttk.Radiobutton(frame_setting, text="横", command=self.update, variable=self.direction, value=1, state=tk.DISABLED)
         button_exec = ttk.Button(frame_setting, text='EXEC', command=self.exec_command)
+        label_pitch = ttk.Label(frame_setting, text='Pitch [\u03bcm]')
+        self.pitch = tk.DoubleVar(value=10)
+        entry_pitch = ttk.Entry(frame_setting, textvariable=self.pitch, width=WIDTH_ENTRY, justify=tk.RIGHT)
+        button_open = ttk.Button(frame_setting, text='Open Image', command=self.open_image)
+        self.image_name = tk.StringVar(value='')
+        label_image = ttk.Label(frame_setting, textvariable=self.image_name)
         radio_line.grid(row=0, column=1, sticky='W')
         radio_rect.grid(row=1, column=1, sticky='W')
         label_x.grid(row=0, column=2, sticky='W')
@@ -63,9 +84,14 @@ class CommandWindow(tk.Toplevel):
         self.radio_vertical.grid(row=1, column=5, sticky='E')
         self.radio_horizontal.grid(row=1, column=6, sticky='W')
         button_exec.grid(row=2, column=4, columnspan=3)
+        radio_image.grid(row=3, column=1, sticky='W')
+        label_pitch.grid(row=3, column=2, sticky='W')
+        entry_pitch.grid(row=3, column=3, sticky='W')
+        button_open.grid(row=3, column=4, columnspan=3)
+        label_image.grid(row=4, column=1, columnspan=6)
 
     def update(self):
-        if self.shape.get() == 0:
+        if self.shape.get() in [0, IMAGE]:
             self.is_filled.set(False)
             self.check_fill.config(state=tk.DISABLED)
         elif self.shape.get() == 1:
@@ -84,95 +110,170 @@ class CommandWindow(tk.Toplevel):
 
         self.update_canvas()
 
+    def open_image(self):
+        filename = filedialog.askopenfilename(filetypes=[('image', '*.pbm *.pgm *.png *.bmp'), ('all', '*')])
+        if filename:
+            self.load_image(filename)
+
+    def load_image(self, filename: str) -> bool:
+        try:
+            self.image = load_image(filename)
+        except (ValueError, OSError) as e:
+            print(e)
+            return False
+        self.image_file = filename
+        self.image_name.set(f'{os.path.basename(filename)} ({self.image.width} x {self.image.height} px)')
+        self.shape.set(IMAGE)
+        self.update()
+        return True
+
+    def get_raster_settings(self):
+        """
+        :rtype: tuple or None
+        :return: arguments of iter_raster, or None if no image is loaded or an entry is invalid
+        """
+        if self.image is None:
+            return None
+        try:
+            return self.image, self.pitch.get(), self.vel.get()
+        except tk.TclError:
+            return None
+
     def update_canvas(self, event=None):
-        self.canvas.delete("all")
-
-        points, _, lasers = self.get_points()
-        points = points + [[0, 0]]
-
-        max_x = max([abs(p[0]) for p in points] + [1])
-        max_y = max([abs(p[1]) for p in points] + [1])
-        amplitude = min(WIDTH / max_x, HEIGHT / max_y) / 2
-        start_x = WIDTH / 2 - max_x / 2 * amplitude
-        start_y = HEIGHT / 2 + max_y / 2 * amplitude
-
-        # START POSITION
-        r = 3
-        self.canvas.create_oval(start_x - r, start_y - r, start_x + r, start_y + r, fill='red', width=0)
-
-        for i in range(len(lasers)):
-            x0, y0 = points[i - 1]
-            x1, y1 = points[i]
-            x0 = start_x + x0 * amplitude
-            x1 = start_x + x1 * amplitude
-            y0 = start_y + y0 * amplitude
-            y1 = start_y + y1 * amplitude
-            if lasers[i]:
-                self.canvas.create_line(x0, y0, x1, y1, fill='green', width=1)
-            else:
-                self.canvas.create_line(x0, y0, x1, y1, fill='green', width=1, dash=(1, 1))
+        # 入力が続く間は描き直さず、止まってからまとめて描く
+        self.preview.request(self.get_points)
 
     def exec_command(self):
-        thread = threading.Thread(target=self.move_shape)
-        thread.daemon = True
-        thread.start()
+        if self.main_window.job_running():
+            print('A job is running.')
+            return
+        # 受信待ちで画面がフリーズしないようI/Oのイベントループ上で実行する
+        self.main_window.io.submit(self.move_shape())
 
-    def get_points(self):
+    def get_settings(self):
+        """
+        :rtype: tuple or None
+        :return: arguments of build, or None if an entry is invalid
+        """
         try:
-            shape, x, y, vel, d = self.shape.get(), self.x.get(), self.y.get(), self.vel.get(), self.interval.get()
+            settings = (self.shape.get(), self.x.get(), self.y.get(), self.vel.get(), self.interval.get(),
+                        self.is_filled.get(), self.direction.get())
         except tk.TclError:
-            return [], [], []
-        if d <= 0:
-            return [], [], []
-
-        if shape == 0:  # Line
-            points = [[x, -y]]  # この系のy軸は下向きが正
-            delays = [max(abs(x), abs(y)) / vel]
-        elif shape == 1:  # Rectangle
-            points = [[x, 0],
-                      [x, -y],  # この系のy軸は下向きが正
-                      [0, -y],  # この系のy軸は下向きが正
-                      [0, 0]]
-            delays = [abs(x) / vel, abs(y) / vel, abs(x) / vel, abs(y) / vel]
-        else:
-            return
+            return None
+        return settings
 
-        if self.is_filled.get():
-            if self.direction.get() == 0:  # 縦
-                n = (abs(x) // d + 1) * 2
-                points = [
-                    [d * (i // 2), -y * (1 if i%4 in [1, 2] else 0)] for i in range(1, n)
-                ]
-            elif self.direction.get() == 1:  # 横
-                n = (abs(y) // d + 1) * 2
-                points = [
-                    [x * (1 if i%4 in [1, 2] else 0), -d * (i // 2)] for i in range(1, n)
-                ]
-            lasers = [False if i%2 else True for i in range(n - 1)]
-            delays = [d / vel if i%2 else abs(y) / vel for i in range(n - 1)]
-        else:
-            lasers = [True] * len(points)
+    def get_points(self):
+        """
+        :rtype: Trajectory
+        :return: trajectory relative to the start position
+        """
+        if self.shape.get() == IMAGE:
+            settings = self.get_raster_settings()
+            if settings is None:
+                return Trajectory.empty()
+            # 大きな画像は間引いて描く (実行はiter_pointsで全画素を使う)
+            image, pitch, vel = settings
+            image, factor = image.reduced(PREVIEW_PIXELS)
+            return build_raster(image, pitch * factor, vel)
+        settings = self.get_settings()
+        if settings is None:
+            return Trajectory.empty()
+        return build(*settings)
 
-        return points, delays, lasers
+    def iter_points(self):
+        """
+        same as get_points but generated chunk by chunk for very large jobs
+        :return: generator of Trajectory
+        """
+        if self.shape.get() == IMAGE:
+            # 画像は数行ずつ変換しながら実行する
+            settings = self.get_raster_settings()
+            return iter([]) if settings is None else iter_raster(*settings)
+        settings = self.get_settings()
+        if settings is None:
+            return iter([])
+        return iter_build(*settings)
 
-    def move_shape(self):
-        x0, y0 = self.main_window.x_cur.get(), - self.main_window.y_cur.get()
-        points, delays, lasers = self.get_points()
+    def get_journal_settings(self) -> dict:
+        """
+        :rtype: dict
+        :return: entries needed to build the same job again (see resume)
+        """
+        return {'shape': self.shape.get(), 'x': self.x.get(), 'y': self.y.get(), 'vel': self.vel.get(),
+                'interval': self.interval.get(), 'fill': self.is_filled.get(), 'direction': self.direction.get(),
+                'image': self.image_file, 'pitch': self.pitch.get(),
+                'auto_emission': self.main_window.is_auto_emission.get(), 'frq': self.main_window.frq.get(),
+                'constant_pitch': self.main_window.is_constant_pitch.get(),
+                'pulse_pitch': self.main_window.pulse_pitch.get()}
+
+    def resume(self, state):
+        """
+        restore the entries of an interrupted job and continue it from the last completed segment
+        :param state: loaded journal (see Journal.load_journal)
+        :type state: JournalState
+        """
+        settings = state.settings
+        if settings['shape'] == IMAGE and not self.load_image(settings['image']):
+            return
+        for var, key in [(self.shape, 'shape'), (self.x, 'x'), (self.y, 'y'), (self.vel, 'vel'),
+                         (self.interval, 'interval'), (self.is_filled, 'fill'), (self.direction, 'direction'),
+                         (self.pitch, 'pitch'), (self.main_window.frq, 'frq'),
+                         (self.main_window.is_constant_pitch, 'constant_pitch'),
+                         (self.main_window.pulse_pitch, 'pulse_pitch')]:
+            var.set(settings[key])
+        if self.main_window.is_auto_emission.get() != settings['auto_emission']:
+            self.main_window.is_auto_emission.set(settings['auto_emission'])
+            self.main_window.change_auto_emission()
+        self.update()
+        self.main_window.io.submit(self.move_shape(state))
+
+    async def move_shape(self, state=None):
+        """
+        :param state: loaded journal to resume. a new job from the current position if None
+        """
+        # 2つのジョブが命令を混ぜたり同じ記録に書いたりしないようにする
+        # (イベントループ上で確認して登録するので、続けて押されても1つしか始まらない)
+        if self.main_window.job_running():
+            print('A job is running.')
+            return
+        # 終了するときに止められるようにしておく (main.abort_job)
+        self.main_window.job = asyncio.current_task()
+        if state is None:
+            x0, y0 = self.main_window.x_cur.get(), - self.main_window.y_cur.get()
+        else:
+            x0, y0 = state.origin
 
         if self.cl.mode == 'DEBUG':
             print('move shape')
             return
 
-        self.stage.set_velocity_all(self.vel.get())
+        laser = frq = pitch = None
+        if self.main_window.is_auto_emission.get():  # 自動照射モード
+            pitch = self.main_window.get_pulse_pitch()  # 線分ごとに速度から周波数を決める
+            frq = self.main_window.frq.get()
+            if pitch is None and not 16 <= frq <= 10000:
+                self.main_window.msg_laser.set('Frequency must be 16~10000 Hz.')
+                return
+            laser = self.laser.aio
 
-        for (x, y), delay, laser in zip(points, delays, lasers):
-            if self.main_window.is_auto_emission.get():  # 自動照射モード
-                if laser:
-                    self.main_window.emit()
-                else:
-                    self.main_window.stop_laser()
-            self.stage.move_line((x0 + x) * 0.001, (y0 + y) * 0.001)
-            time.sleep(delay + 0.3)
+        # 完了した線分を記録し、中断しても再開できるようにする
+        journal = None
+        if self.cl.journal_file:
+            journal = Journal(self.cl.journal_file, self.cl.journal_interval, state)
+            journal.begin((x0, y0), self.get_journal_settings())
 
-        if self.main_window.is_auto_emission.get():  # 自動照射モード
-            self.main_window.stop_laser()
+        # ステージの完了を確認しながら次の線分を送る
+        executor = JobExecutor(self.stage.aio, laser, frq, model=self.model, pitch=pitch, journal=journal)
+        chunks = (merge_collinear(chunk) for chunk in self.iter_points())
+        self.main_window.poller.begin_job()  # 実行中は位置を速く更新する
+        completed = False
+        try:
+            report = await executor.run(chunks, (x0, y0), self.vel.get())
+            completed = report.completed
+        finally:
+            self.main_window.poller.end_job()
+            self.main_window.job = None
+            if journal is not None:
+                journal.end(completed)
+                journal.close()
+        print(f'{report.segments} segments in {report.elapsed:.2f} s (predicted {report.predicted:.2f} s)')
@@ -12,6 +12,57 @@ class ConfigLoader:
         self.baudrate_stage = config["BAUDRATE-stage"]
         self.baudrate_laser = config["BAUDRATE-laser"]
         self.vel_list = config["VEL_LIST"]
+        # 複数のステーション (ステージとレーザーの組) を使う場合
+        # 省略すると上のPORT, BAUDRATEの1組だけになる
+        self.stations = []
+        for i, station in enumerate(config.get('STATIONS', [{}])):
+            self.stations.append({
+                'name': station.get('name', str(i)),
+                'port_stage': f'COM{station["PORT-stage"]}' if 'PORT-stage' in station else self.port_stage,
+                'port_laser': f'COM{station["PORT-laser"]}' if 'PORT-laser' in station else self.port_laser,
+                'baudrate_stage': station.get('BAUDRATE-stage', self.baudrate_stage),
+                'baudrate_laser': station.get('BAUDRATE-laser', self.baudrate_laser),
+            })
+        self.simulation = config.get('SIMULATION', {})
+        jog = config.get('JOG', {})
+        self.jog_max_rate = jog.get('max_rate', 10)  # ジョイスティックから送る命令の上限 [回/s]
+        self.jog_analog = jog.get('analog', False)
+        self.jog_max_velocity = jog.get('max_velocity', 5000)
+        self.jog_curve = jog.get('curve', 2)
+        self.jog_hysteresis = jog.get('hysteresis', 0.02)
+        self.jog_budget = jog.get('budget', 0.3)
+        if not self.jog_max_rate > 0:
+            raise ValueError('Invalid jog max_rate in config.json. It must be positive.')
+        if not 0 < self.jog_max_velocity <= 25000:
+            raise ValueError('Invalid jog max_velocity in config.json. It must be 1~25000.')
+        if not 0 < self.jog_budget <= 1:
+            raise ValueError('Invalid jog budget in config.json. It must be 0~1.')
+        polling = config.get('POLLING', {})
+        self.poll_min_rate = polling.get('min_rate', 1)
+        self.poll_max_rate = polling.get('max_rate', 20)
+        self.poll_budget = polling.get('budget', 0.5)
+        if not 0 < self.poll_min_rate <= self.poll_max_rate:
+            raise ValueError('Invalid polling rate in config.json. It must be 0 < min_rate <= max_rate.')
+        if not 0 < self.poll_budget <= 1:
+            raise ValueError('Invalid polling budget in config.json. It must be 0~1.')
+        stats = config.get('STATS', {})
+        self.stats_file = stats.get('file', '')  # 空なら書き出さない
+        self.stats_interval = stats.get('interval', 10)
+        journal = config.get('JOURNAL', {})
+        self.journal_file = journal.get('file', 'journal.jsonl')  # 空なら記録しない
+        self.journal_interval = journal.get('interval', 1.0)  # 進み具合を書き込む間隔 [s]
+        motion = config.get('MOTION', {})
+        self.motion_acceleration = motion.get('acceleration', [100000, 100000])  # x, y [μm/s^2]
+        self.motion_max_velocity = motion.get('max_velocity', [25000, 25000])  # x, y [μm/s]
+        self.motion_settle = motion.get('settle', 0.0)  # 動作の終了からREADYまで [s]
+        startup = config.get('STARTUP', {})
+        self.startup_lazy = startup.get('lazy', False)  # 画面を先に出し、接続は裏で行う
+        self.startup_laser_timeout = startup.get('laser_timeout', 3.0)  # レーザーの応答を待つ上限 [s]
+        server = config.get('SERVER', {})
+        self.server_enabled = server.get('enabled', False)
+        self.server_host = server.get('host', '127.0.0.1')
+        self.server_port = server.get('port', 50007)
+        self.server_unix = server.get('unix', '')  # 空でなければTCPの代わりにUnixソケットを使う
         for vel in self.vel_list[1:]:
             if not 0 < vel <= 25000:
                 raise ValueError('Invalid velocity in config.json. It must be 1~25000.')
@@ -0,0 +1,266 @@
+# スクリプトからステージとレーザーを操作するためのサーバー
+# 1行に1つのJSONを送り、1行に1つのJSONが返る (Unixソケット or TCP)
+# python ControlServer.py --simulate --port 50007
+import json
+import math
+import time
+import functools
+import asyncio
+import argparse
+from DS102Controller import AsyncDS102Controller
+from PulseLaserController import AsyncPulseLaserController, LaserPort
+from SerialTransport import SerialTransport, report_exception
+from ConfigLoader import ConfigLoader
+from JobRunner import open_ports, initialize
+
+
+class ControlServer:
+    """
+    line-delimited JSON server over the async controllers
+
+    request:  {"id": 1, "cmd": "line", "x": 1.0, "y": 0.5, "vel": 1000, "wait": true}
+    response: {"id": 1, "ok": true} or {"id": 1, "ok": false, "error": "..."}
+
+    commands
+      move       {"axis": "x", "vel": -100}      move continuously [μm/s] (0 stops the axis)
+                 {"axis": "x", "pos": 1.0}        move to an absolute position [mm]
+      line       {"x": 1.0, "y": 0.5}             linear move to an absolute position [mm]
+                 optional "vel" [μm/s], "wait" (reply when the motion is complete), "timeout" [s]
+      stop       {}                               stop both axes. {"laser": true} also stops the laser
+      frequency  {"frq": 100}                     emit at frq [Hz]. 0 stops the laser
+      status     {}                               position [μm], limit, ready and laser frequency
+      subscribe  {"interval": 0.1}                push {"event": "status", ...} every interval [s]
+      unsubscribe {}
+
+    requests of one client are executed in order. only the wait of line runs in the background,
+    so stop is not blocked by a waiting line
+    """
+    def __init__(self, stage: AsyncDS102Controller, laser: AsyncPulseLaserController = None,
+                 min_interval: float = 0.02):
+        """
+        :param stage: controller of the stage
+        :param laser: controller of the laser. frequency is rejected if None
+        :param min_interval: shortest interval of subscriptions [s]
+        """
+        self.stage = stage
+        self.laser = laser
+        self.min_interval = min_interval
+        self.subscribers = {}  # writer -> [interval, last sent time]
+        self.waiting = set()  # 完了待ちのline (タスクが消されないよう参照を持っておく)
+        self.poller = None
+        self.servers = []
+        self.clients = set()
+        self.commands = {'move': self.move, 'line': self.line, 'stop': self.stop, 'frequency': self.frequency,
+                         'status': self.get_status}
+
+    async def start_tcp(self, host: str = '127.0.0.1', port: int = 50007):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        self.servers.append(server)
+        return server
+
+    async def start_unix(self, path: str):
+        server = await asyncio.start_unix_server(self.handle_client, path)
+        self.servers.append(server)
+        return server
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+        # 接続中のクライアントを切らないとwait_closedが終わらない
+        for writer in self.clients:
+            writer.close()
+        for server in self.servers:
+            await server.wait_closed()
+        for task in [self.poller, *self.waiting]:
+            if task is not None:
+                task.cancel()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self.handle_request(line, writer)
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            self.subscribers.pop(writer, None)
+            writer.close()
+
+    async def handle_request(self, line: bytes, writer: asyncio.StreamWriter):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            await self.send(writer, {'ok': False, 'error': 'invalid json'})
+            return
+        if not isinstance(request, dict):
+            await self.send(writer, {'ok': False, 'error': 'request must be an object'})
+            return
+        response = {'id': request.get('id')}
+        cmd = request.get('cmd')
+        try:
+            if cmd == 'subscribe':
+                self.subscribe(writer, request.get('interval', 0.1))
+                result = {}
+            elif cmd == 'unsubscribe':
+                self.subscribers.pop(writer, None)
+                result = {}
+            elif cmd in self.commands:
+                result = await self.commands[cmd](request)
+            else:
+                raise ValueError(f'unknown command: {cmd}')
+        except (ValueError, KeyError, TypeError) as e:
+            response.update(ok=False, error=f'{type(e).__name__}: {e}')
+            await self.send(writer, response)
+            return
+        response.update(ok=True, **result)
+        if cmd == 'line' and request.get('wait', False):
+            # 完了を待つ間も次の要求 (stopなど) を受け付ける
+            task = asyncio.create_task(self.reply_on_completion(writer, response, request.get('timeout', 60)))
+            self.waiting.add(task)
+            task.add_done_callback(self.waiting.discard)
+            task.add_done_callback(functools.partial(report_exception, 'Waiting line'))
+            return
+        await self.send(writer, response)
+
+    async def reply_on_completion(self, writer: asyncio.StreamWriter, response: dict, timeout: float):
+        response['completed'] = await self.stage.wait_motion_complete(0, timeout)
+        await self.send(writer, response)
+
+    @staticmethod
+    async def send(writer: asyncio.StreamWriter, message: dict):
+        if writer.is_closing():
+            return
+        writer.write(json.dumps(message).encode() + b'\n')
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    @staticmethod
+    def finite(value) -> float:
+        # jsonはNaNやInfinityも受け付けるので、命令に渡す前に弾く
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError(f'Invalid value: {value}. It must be a finite number.')
+        return value
+
+    @staticmethod
+    def velocity(value) -> int:
+        # 整数にしてから範囲を確かめる (0.5は0になり、DS102では逆向きの移動になってしまう)
+        vel = int(ControlServer.finite(value))
+        if not 1 <= abs(vel) <= 25000:
+            raise ValueError(f'Invalid velocity: {value}. It must be 1~25000.')
+        return vel
+
+    async def move(self, request: dict) -> dict:
+        axis = request['axis']
+        if 'pos' in request:
+            await self.stage.move_abs(axis, self.finite(request['pos']))
+        elif self.finite(request['vel']) == 0:
+            await self.stage.stop_axis(axis)
+        else:
+            await self.stage.move_velocity(axis, self.velocity(request['vel']))
+        return {}
+
+    async def line(self, request: dict) -> dict:
+        x, y = self.finite(request['x']), self.finite(request['y'])
+        self.finite(request.get('timeout', 60))  # 完了待ちの期限 (reply_on_completionで使う)
+        if 'vel' in request:
+            await self.stage.set_velocity_all(self.velocity(request['vel']))
+        await self.stage.move_line(x, y)
+        return {}
+
+    async def stop(self, request: dict) -> dict:
+        await self.stage.stop()
+        if request.get('laser', False) and self.laser is not None:
+            await self.laser.stop(force=True)
+        return {}
+
+    async def frequency(self, request: dict) -> dict:
+        if self.laser is None:
+            raise ValueError('no laser')
+        frq = int(self.finite(request['frq']))
+        if frq == 0:
+            await self.laser.stop(force=True)
+        elif 16 <= frq <= 10000:
+            await self.laser.set_frq(frq)
+        else:
+            raise ValueError(f'Invalid frequency: {frq}. It must be 16~10000 or 0.')
+        return {}
+
+    async def get_status(self, request: dict = None) -> dict:
+        status = await self.stage.get_status()
+        result = status._asdict()
+        result['laser'] = None if self.laser is None else self.laser.frq
+        result['t'] = time.time()
+        return result
+
+    def subscribe(self, writer: asyncio.StreamWriter, interval: float):
+        self.subscribers[writer] = [max(self.finite(interval), self.min_interval), 0.0]
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.create_task(self.poll())
+            # 問い合わせに失敗して止まったら表示する (次のsubscribeでまた始まる)
+            self.poller.add_done_callback(functools.partial(report_exception, 'Status subscription'))
+
+    async def poll(self):
+        # 購読者が何人いても問い合わせは1つにまとめる
+        while self.subscribers:
+            status = await self.get_status()
+            now = time.perf_counter()
+            for writer, subscription in list(self.subscribers.items()):
+                interval, last = subscription
+                if now - last >= interval * 0.9:
+                    subscription[1] = now
+                    await self.send(writer, {'event': 'status', **status})
+            await asyncio.sleep(min(interval for interval, _ in self.subscribers.values())
+                                if self.subscribers else 0)
+
+
+async def serve(cl: ConfigLoader, simulate: bool, host: str, port: int, unix: str):
+    ser_stage, ser_laser = open_ports(cl, simulate)
+    transport_stage = SerialTransport(ser_stage, name='stage')
+    transport_laser = SerialTransport(LaserPort(ser_laser), read_replies=False, name='laser')
+    await transport_stage.start()
+    await transport_laser.start()
+    stage = AsyncDS102Controller(transport_stage)
+    laser = AsyncPulseLaserController(transport_laser)
+    await initialize(stage, laser, cl.startup_laser_timeout)
+    server = ControlServer(stage, laser)
+    try:
+        if unix:
+            await server.start_unix(unix)
+            print(f'listening on {unix}')
+        else:
+            await server.start_tcp(host, port)
+            print(f'listening on {host}:{port}')
+        await asyncio.Event().wait()  # Ctrl+Cまで動かし続ける
+    finally:
+        await server.close()
+        await stage.stop()
+        await laser.stop(force=True)
+        await transport_stage.close()
+        await transport_laser.close()
+        ser_stage.close()
+        ser_laser.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the stage and the laser over a socket.')
+    parser.add_argument('--config', default='./config.json', help='config file')
+    parser.add_argument('--simulate', action='store_true', help='use the virtual devices')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50007)
+    parser.add_argument('--unix', help='listen on this unix socket instead of TCP')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(ConfigLoader(args.config), args.simulate, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -7,13 +7,20 @@ class MovableObject:
     canvas = None
     thres_list = []
 
-    def __init__(self):
+    def __init__(self, on_drag=None, on_release=None):
+        """
+        :param on_drag: called after every drag with no argument
+        :param on_release: called when the button is released with no argument
+        """
+        self.on_drag = on_drag
+        self.on_release = on_release
         self.id = None
         self.x0 = None
         self.y0 = None
         self.rank = None
         self.direction = None
         self.disp = None
+        self.vector = None
 
     def dragging(self, event):
         pass
@@ -23,6 +30,12 @@ class MovableObject:
         self.rank = 0
         self.direction = [0, 0, 0]  # (x, y, z)
         self.disp = 0
+        self.vector = [0, 0]  # 中心からの変位 (dx, dy) [px]
+
+    def release(self, event=None):
+        self.reset()
+        if self.on_release is not None:
+            self.on_release()
 
     def get_rank(self):
         """
@@ -41,13 +54,20 @@ class MovableObject:
         """
         return self.direction
 
+    def get_vector(self):
+        """
+        :rtype: list
+        :return: displacement from the center [dx, dy] (downward is positive)
+        """
+        return self.vector
+
 
 class MovableOval(MovableObject):
-    def __init__(self, x0, y0, x1, y1, **key):
-        super().__init__()
+    def __init__(self, x0, y0, x1, y1, on_drag=None, on_release=None, **key):
+        super().__init__(on_drag, on_release)
         self.id = self.canvas.create_oval(x0, y0, x1, y1, **key)
         self.canvas.tag_bind(self.id, '<Button1-Motion>', self.dragging)
-        self.canvas.tag_bind(self.id, '<ButtonRelease>', self.reset)
+        self.canvas.tag_bind(self.id, '<ButtonRelease>', self.release)
         x0, y0, x1, y1 = self.canvas.bbox(self.id)
         self.r = (x1 - x0) / 2
         self.x0 = (x0 + x1) / 2 - self.r
@@ -71,6 +91,7 @@ class MovableOval(MovableObject):
         dy = y - self.y0
         r = (dx ** 2 + dy ** 2) ** 0.5
         self.disp = r
+        self.vector = [dx, dy]
 
         # directionの確認
         if math.pi * -0.75 < theta < math.pi * -0.25:
@@ -85,3 +106,6 @@ class MovableOval(MovableObject):
         else:
             self.direction[0] = -1
             self.direction[1] = 0
+
+        if self.on_drag is not None:
+            self.on_drag()
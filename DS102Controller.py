@@ -1,29 +1,80 @@
+import time
+import asyncio
+from typing import NamedTuple
 import serial
+from SerialTransport import SerialTransport, LoopThread, PRIORITY_STOP, PRIORITY_COMMAND
 
 
 class MySerial(serial.Serial):
     # serial.SerialではEOLが\nに設定されており、DS102の規格と異なる
     eol = b'\r'
     leneol = len(eol)
+    # readのタイムアウト。返答ごとの締め切りはこの間隔で確認する
+    poll_interval = 0.01
 
-    def __init__(self, port, baudrate, **args):
+    def __init__(self, port, baudrate, reply_timeout: float = 1.0, **args):
+        """
+        :param port: name of the port
+        :param baudrate: baud rate
+        :param reply_timeout: default deadline for one reply [s]. None waits forever
+        :type reply_timeout: float
+        """
+        args.setdefault('timeout', self.poll_interval)
         super().__init__(port, baudrate, **args)
+        self.reply_timeout = reply_timeout
+        self._rx_buffer = bytearray()  # 次の返答に持ち越すバイト列
 
     def send(self, msg: str):
         msg = msg.encode() + self.eol
         self.write(msg)
 
-    def recv(self):
-        line = bytearray()
+    def send_many(self, msgs: list):
+        # まとめて1回で書き込み、返答は後からまとめて受け取る
+        self.write(b''.join(msg.encode() + self.eol for msg in msgs))
+
+    def recv_frame(self, timeout: float = None):
+        """
+        receive one reply terminated by eol
+        bytes are read in bulk and the ones after eol are kept for the next reply
+        :param timeout: deadline for this reply [s]. reply_timeout is used if None
+        :type timeout: float
+        :rtype: str or None
+        :return: reply without eol, or None if the deadline passed (the partial reply is kept)
+        """
+        if timeout is None:
+            timeout = self.reply_timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
         while True:
-            c = self.read(1)
-            if c:
-                line += c
-                if line[-self.leneol:] == self.eol:
-                    break
-            else:
-                break
-        return bytes(line).decode().strip('\r')
+            i = self._rx_buffer.find(self.eol)
+            if i >= 0:
+                frame = bytes(self._rx_buffer[:i])
+                del self._rx_buffer[:i + self.leneol]
+                return frame.decode(errors='replace')
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            # 届いている分はまとめて読み、何も無ければ1バイト目をpoll_intervalだけ待つ
+            n = self.in_waiting
+            self._rx_buffer += self.read(n if n > 0 else 1)
+
+    def recv(self, timeout: float = None):
+        """
+        receive one reply
+        :param timeout: deadline for this reply [s]. reply_timeout is used if None
+        :rtype: str
+        :return: reply without eol, or '' on timeout
+        """
+        frame = self.recv_frame(timeout)
+        if frame is None:
+            return ''
+        return frame.strip('\r')
+
+    def flush_input(self):
+        """
+        discard every received byte including a partial reply
+        :return:
+        """
+        self._rx_buffer.clear()
+        self.reset_input_buffer()
 
 
 def axis2msg(axis: str):
@@ -45,22 +96,96 @@ def axis2msg(axis: str):
     return msg
 
 
-class DS102Controller:
-    def __init__(self, ser: MySerial):
+# get_statusで送る問い合わせ (x, yの順に送る)
+STATUS_QUERIES = ['POSition?', 'LIMIT?', 'READY?']
+# get_status 1回で送るバイト数
+STATUS_BYTES = sum(len(axis2msg(axis) + query) + len(MySerial.eol) for query in STATUS_QUERIES for axis in ['x', 'y'])
+
+
+class StageStatus(NamedTuple):
+    """
+    position [μm], limit flags and ready flags of both axes
+    """
+    x: int
+    y: int
+    limit_x: bool
+    limit_y: bool
+    ready_x: bool
+    ready_y: bool
+
+
+class AsyncDS102Controller:
+    def __init__(self, transport: SerialTransport):
         """
         initialization
-        :param ser: opened port for communication
-        :type ser: MySerial
+        :param transport: started transport of the stage port
+        :type transport: SerialTransport
         """
-        self.ser = ser
+        self.transport = transport
+        # 送らなくても状態が変わらない命令を省くため、デバイスの状態を覚えておく
+        self.speed_table = {}  # 選択中のスピードテーブル
+        self.velocity = {}  # Fspeed0
+        self.motion = {}  # ('GO', 向き)など。Noneなら停止中
+        self.invalidate()
+        self.stops = 0  # stopを呼んだ回数。途中で止められた処理を打ち切るのに使う
+        self.suppressed_commands = 0
+        self.suppressed_bytes = 0
+
+    def invalidate(self):
+        """
+        forget the mirrored device state
+        called after a stop, an error or a reconnection so that the next commands are always sent
+        :return:
+        """
+        self.speed_table = {'x': None, 'y': None}
+        self.velocity = {'x': None, 'y': None}
+        self.motion = {'x': None, 'y': None}
+
+    def _suppress(self, msg: str):
+        self.suppressed_commands += 1
+        self.suppressed_bytes += len(msg.encode()) + MySerial.leneol
+
+    async def _send(self, msg: str, priority: int = PRIORITY_COMMAND, purge: bool = False) -> bool:
+        """
+        :return: False if the message was dropped by a stop before it was written
+        """
+        try:
+            await self.transport.command(msg, priority, purge)
+        except ConnectionAbortedError:
+            # 送る前に停止命令で取り消された。デバイスの状態は分からなくなる
+            self.invalidate()
+            return False
+        except Exception:
+            self.invalidate()
+            raise
+        return True
+
+    async def initialize(self, timeout: float = None) -> bool:
+        """
+        check communication and the speed table
+        the queries of both axes are written at once, so this takes one round trip
+        :param timeout: deadline of the replies [s]. reply_timeout of the port if None
+        :type timeout: float
+        :rtype: bool
+        :return: True if both axes are ready
+        """
+        self.invalidate()
         # 送受信とスピードテーブルの確認
+        msgs = [axis2msg(axis) + query for axis in ['x', 'y'] for query in ['READY?', 'SELectSPeed?']]
+        replies = await self.transport.query_many(msgs, timeout)
+        ready = True
+        for axis, ans, speed in zip(['x', 'y'], replies[0::2], replies[1::2]):
+            print(f'{axis} axis: {"READY" if ans == "1" else "NOT READY"}')
+            ready = ready and ans == '1'
+            if speed.isdigit():
+                self.speed_table[axis] = int(speed)
+            else:
+                print('selected speed:', speed)
         for axis in ['x', 'y']:
-            self.ser.send(axis2msg(axis) +'READY?')
-            print(f'{axis} axis: {"READY" if self.ser.recv() == "1" else "NOT READY"}')
-            if not self.speed_table_is(axis, 0):
-                self.select_speed_table(axis, 0)
+            await self.select_speed_table(axis, 0)  # すでに0なら送らない
+        return ready
 
-    def set_velocity(self, axis: str, vel: int):
+    async def set_velocity(self, axis: str, vel: int):
         """
         set Fspeed0 vel
         :param axis: 'x' or 'y'
@@ -74,9 +199,13 @@ class DS102Controller:
             return
 
         msg = axis2msg(axis) + f'Fspeed0 {vel}'
-        self.ser.send(msg)
+        if self.velocity[axis] == vel:
+            self._suppress(msg)
+            return
+        if await self._send(msg):
+            self.velocity[axis] = vel
 
-    def set_velocity_all(self, vel: int):
+    async def set_velocity_all(self, vel: int):
         """
         set Fspeed0 vel
         :param vel: velocity you want to set
@@ -84,16 +213,16 @@ class DS102Controller:
         :return:
         """
         for axis in ['x', 'y']:
-            self.set_velocity(axis, vel)
+            await self.set_velocity(axis, vel)
 
-    def set_velocity_max_all(self):
+    async def set_velocity_max_all(self):
         """
         set Fspeed0 vel all
         :return:
         """
-        self.set_velocity_all(25000)  # TODO: ほんとか？
+        await self.set_velocity_all(25000)  # TODO: ほんとか？
 
-    def select_speed_table(self, axis: str, speed: int):
+    async def select_speed_table(self, axis: str, speed: int):
         """
         select set of speed from 0~9
         :param axis: 'x' or 'y'
@@ -103,9 +232,13 @@ class DS102Controller:
         :return:
         """
         msg = axis2msg(axis) + f'SELectSPeed {speed}'
-        self.ser.send(msg)
+        if self.speed_table[axis] == speed:
+            self._suppress(msg)
+            return
+        if await self._send(msg):
+            self.speed_table[axis] = speed
 
-    def speed_table_is(self, axis: str, speed: int) -> bool:
+    async def speed_table_is(self, axis: str, speed: int) -> bool:
         """
         check the selected speed
         :param axis: 'x' or 'y'
@@ -115,16 +248,18 @@ class DS102Controller:
         :rtype: bool
         :return: True or False
         """
-        msg = axis2msg(axis) + 'SELectSPeed?'
-        self.ser.send(msg)
-        msg = self.ser.recv()
+        msg = await self.transport.query(axis2msg(axis) + 'SELectSPeed?')
+        if msg.isdigit():
+            self.speed_table[axis] = int(msg)
+        else:
+            self.invalidate()
         if msg == str(speed):
             return True
         else:
             print('selected speed:', msg)
             return False
 
-    def move_velocity(self, axis: str, vel: int):
+    async def move_velocity(self, axis: str, vel: int):
         """
         move along selected axis with selected velocity
         :param axis: 'x' or 'y'
@@ -133,34 +268,45 @@ class DS102Controller:
         :type vel: int
         :return:
         """
-        self.set_velocity(axis, abs(vel))
-
         msg = axis2msg(axis) + 'GO '
         if vel > 0:
             msg += '5'
         else:
             msg += '6'
-        self.ser.send(msg)
+        # 同じ向き・同じ速度で既に動いている (set_velocityで記録が変わる前に確認する)
+        moving = self.motion[axis] == ('GO', msg[-1]) and self.velocity[axis] == abs(vel)
 
-    def move_abs(self, axis: str, pos: float):
+        stops = self.stops
+        await self.set_velocity(axis, abs(vel))
+        if self.stops != stops:  # 速度を設定している間に止められた
+            return
+        if moving:
+            self._suppress(msg)
+            return
+        if await self._send(msg):
+            self.motion[axis] = ('GO', msg[-1])
+
+    async def move_abs(self, axis: str, pos: float):
         """
         :param axis: 'x' or 'y'
         :param pos: absolute position [mm]
         :return:
         """
         msg = axis2msg(axis) + f'GOABS {pos}'
-        self.ser.send(msg)
+        if await self._send(msg):
+            self.motion[axis] = ('GOABS', pos)
 
-    def move_line(self, x: float, y: float):
+    async def move_line(self, x: float, y: float):
         """
         :param x: absolute position of x [mm]
         :param y: absolute position of y [mm]
         :return:
         """
         msg = f'GOLineA X{x} Y{y}'
-        self.ser.send(msg)
+        if await self._send(msg):
+            self.motion['x'] = self.motion['y'] = ('GOLineA', x, y)
 
-    def stop_axis(self, axis: str):
+    async def stop_axis(self, axis: str):
         """
         stop each axis
         Emergency( or Reduction)
@@ -170,18 +316,24 @@ class DS102Controller:
         """
         msg = axis2msg(axis) + 'STOP Emergency'
         # msg = axis2msg(axis) + 'STOP Reduction'
-        self.ser.send(msg)
+        # 停止命令は省略しない
+        self.motion[axis] = None
+        await self._send(msg, PRIORITY_STOP)
 
-    def stop(self):
+    async def stop(self):
         """
         stop all
         :return:
         """
         msg = 'STOP Emergency'
         # msg = 'STOP Reduction'
-        self.ser.send(msg)
+        # 停止命令は省略しない
+        self.motion = {'x': None, 'y': None}
+        self.stops += 1
+        # まだ送っていない移動の命令は捨てる (停止の直後に動き出さないように)
+        await self._send(msg, PRIORITY_STOP, purge=True)
 
-    def get_position(self):
+    async def get_position(self):
         """
         get x and y position
         the unit is mm
@@ -189,19 +341,20 @@ class DS102Controller:
         :return: x position, y position
         """
         # シリアル通信のエラーで稀に正しい返答が得られないことがある。プログラムが止まらないよう0を入れるようにする。
+        # 両軸の問い合わせはまとめて送る (1往復)
+        msgs = [axis2msg(axis) + 'POSition?' for axis in ['x', 'y']]
         pos = []
-        for axis in ['x', 'y']:
-            msg = axis2msg(axis) + 'POSition?'
-            self.ser.send(msg)
-            pos_axis = self.ser.recv()
+        for msg, ans in zip(msgs, await self.transport.query_many(msgs)):
             try:
-                pos_axis = int(float(pos_axis) * 1000)
+                pos_axis = int(float(ans) * 1000)
             except ValueError:
                 pos_axis = 0
+                self.transport.stats.parse_failure(msg, ans)
+                self.invalidate()
             pos.append(pos_axis)
         return pos
 
-    def set_position(self, axis: str, pos: float):
+    async def set_position(self, axis: str, pos: float):
         """
         set x and y position
         the unit is mm
@@ -210,25 +363,200 @@ class DS102Controller:
         :return:
         """
         msg = axis2msg(axis) + f'POS {pos}'
-        self.ser.send(msg)
+        await self._send(msg)
 
-    def check_limit(self, axis: str):
+    async def check_limit(self, axis: str):
         """
         check if the current position of selected axis is on the limit
         :param axis: 'x' or 'y'
-        :return: boolean
+        :return: boolean. None if no valid reply came (e.g. timeout)
         """
         msg = axis2msg(axis) + 'LIMIT?'
-        self.ser.send(msg)
-        ans = int(self.ser.recv())
+        ans = await self.transport.query(msg)
+        # get_positionと同様、正しい返答が得られなくてもプログラムが止まらないようにする
+        try:
+            ans = int(ans)
+        except ValueError:
+            self.transport.stats.parse_failure(msg, ans)
+            self.invalidate()
+            return None
         if ans > 0:  # 1, 2 or 3
             return True
         return False
 
-    def check_limit_all(self):
+    async def check_limit_all(self):
         """
         check if the current position is on the limit
         :param
-        :return: list of boolean
+        :return: list of boolean (None for an axis without a valid reply)
+        """
+        return [await self.check_limit('x'), await self.check_limit('y')]
+
+    async def get_status(self) -> StageStatus:
+        """
+        get position, limit and ready state of both axes in one round trip
+        all queries are written back-to-back and the replies are read afterwards
+        :rtype: StageStatus
+        :return: status of the stage
+        """
+        msgs = [axis2msg(axis) + query for query in STATUS_QUERIES for axis in ['x', 'y']]
+        replies = await self.transport.query_many(msgs)
+
+        # get_positionと同様、正しい返答が得られなかった場合も止まらないようにする
+        pos = []
+        for msg, ans in zip(msgs[0:2], replies[0:2]):
+            try:
+                pos.append(int(float(ans) * 1000))
+            except ValueError:
+                pos.append(0)
+                self.transport.stats.parse_failure(msg, ans)
+                self.invalidate()
+        flags = []
+        for msg, ans in zip(msgs[2:6], replies[2:6]):
+            try:
+                flags.append(int(ans) > 0)
+            except ValueError:
+                flags.append(False)
+                self.transport.stats.parse_failure(msg, ans)
+                self.invalidate()
+        status = StageStatus(*pos, *flags)
+        # 止まっている軸は動作中の記録を消す (機械限界で止まった場合など)
+        for axis, ready in zip(['x', 'y'], [status.ready_x, status.ready_y]):
+            if ready:
+                self.motion[axis] = None
+        return status
+
+    async def is_ready(self) -> bool:
+        """
+        check if both axes have finished their motion
+        :rtype: bool
+        :return: True if both axes are ready
+        """
+        replies = await self.transport.query_many([axis2msg(axis) + 'READY?' for axis in ['x', 'y']])
+        ready = [ans == '1' for ans in replies]
+        for axis, ready_axis in zip(['x', 'y'], ready):
+            if ready_axis:
+                self.motion[axis] = None
+        return all(ready)
+
+    async def wait_motion_complete(self, predicted: float = 0, timeout: float = None,
+                                   min_interval: float = 0.005, max_interval: float = 0.1) -> bool:
+        """
+        wait until both axes are ready
+        nothing is sent until the predicted time, then READY? is polled with an interval
+        which starts at min_interval and grows up to max_interval
+        :param predicted: predicted duration of the motion [s]
+        :param timeout: give up after this time [s]. None waits forever
+        :param min_interval: first polling interval [s]
+        :param max_interval: longest polling interval [s]
+        :type predicted: float
+        :type timeout: float
+        :type min_interval: float
+        :type max_interval: float
+        :rtype: bool
+        :return: True if the motion completed, False on timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        # 予測時間までは問い合わせない (返答が届く時間を見込んで少し早めに聞く)
+        if predicted > min_interval:
+            await asyncio.sleep(predicted - min_interval)
+        interval = min_interval
+        while not await self.is_ready():
+            if deadline is not None and loop.time() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+            interval = min(interval * 1.5, max_interval)
+        return True
+
+
+class DS102Controller:
+    """
+    blocking API of the DS102
+    every method runs the corresponding coroutine of AsyncDS102Controller on the I/O loop
+    """
+    def __init__(self, ser: MySerial, io: LoopThread = None, initialize: bool = True):
+        """
+        initialization
+        :param ser: opened port for communication
+        :param io: loop which owns the port. a new one is started if None
+        :param initialize: check the stage here. if False, call aio.initialize on the loop later
+        :type ser: MySerial
+        :type io: LoopThread
+        :type initialize: bool
+        """
+        self.ser = ser
+        self.io = io if io is not None else LoopThread('ds102-io')
+        self.transport = SerialTransport(ser, name='stage')
+        self.io.run(self.transport.start())
+        self.aio = AsyncDS102Controller(self.transport)
+        if initialize:
+            self.io.run(self.aio.initialize())
+
+    def close(self):
+        """
+        stop the transport. the port itself is not closed
+        :return:
         """
-        return [self.check_limit('x'), self.check_limit('y')]
+        self.io.run(self.transport.close())
+
+    @property
+    def suppressed_bytes(self) -> int:
+        """
+        bytes not sent because the command would not change the device state
+        """
+        return self.aio.suppressed_bytes
+
+    def invalidate(self):
+        self.aio.invalidate()
+
+    def set_velocity(self, axis: str, vel: int):
+        self.io.run(self.aio.set_velocity(axis, vel))
+
+    def set_velocity_all(self, vel: int):
+        self.io.run(self.aio.set_velocity_all(vel))
+
+    def set_velocity_max_all(self):
+        self.io.run(self.aio.set_velocity_max_all())
+
+    def select_speed_table(self, axis: str, speed: int):
+        self.io.run(self.aio.select_speed_table(axis, speed))
+
+    def speed_table_is(self, axis: str, speed: int) -> bool:
+        return self.io.run(self.aio.speed_table_is(axis, speed))
+
+    def move_velocity(self, axis: str, vel: int):
+        self.io.run(self.aio.move_velocity(axis, vel))
+
+    def move_abs(self, axis: str, pos: float):
+        self.io.run(self.aio.move_abs(axis, pos))
+
+    def move_line(self, x: float, y: float):
+        self.io.run(self.aio.move_line(x, y))
+
+    def stop_axis(self, axis: str):
+        self.io.run(self.aio.stop_axis(axis))
+
+    def stop(self):
+        self.io.run(self.aio.stop())
+
+    def get_position(self):
+        return self.io.run(self.aio.get_position())
+
+    def set_position(self, axis: str, pos: float):
+        self.io.run(self.aio.set_position(axis, pos))
+
+    def check_limit(self, axis: str):
+        return self.io.run(self.aio.check_limit(axis))
+
+    def check_limit_all(self):
+        return self.io.run(self.aio.check_limit_all())
+
+    def get_status(self) -> StageStatus:
+        return self.io.run(self.aio.get_status())
+
+    def is_ready(self) -> bool:
+        return self.io.run(self.aio.is_ready())
+
+    def wait_motion_complete(self, predicted: float = 0, timeout: float = None) -> bool:
+        return self.io.run(self.aio.wait_motion_complete(predicted, timeout))
\ No newline at end of file
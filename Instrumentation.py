@@ -0,0 +1,147 @@
+# シリアル通信の統計 (コマンドごとの所要時間、送受信したバイト数、タイムアウトなど)
+# SerialTransportが記録し、GUIやファイルから確認できる
+import re
+import json
+import time
+import asyncio
+import numpy as np
+
+
+# 10 μs ~ 10 s を1桁あたり10分割する
+EDGES = np.logspace(-5, 1, 61)
+
+
+def command_type(msg: str) -> str:
+    """
+    name of the command without the axis and the arguments
+    e.g. 'AXIs1:POSition?' -> 'POSition?', 'GOLineA 1 2' -> 'GOLineA', '100\\n' -> 'frq'
+    :rtype: str
+    """
+    msg = msg.strip()
+    if re.fullmatch(r'-?\d+', msg):  # レーザーには周波数だけを送る
+        return 'frq'
+    msg = msg.split(':', 1)[-1]
+    return msg.split(' ', 1)[0]
+
+
+class LatencyHistogram:
+    """
+    histogram of durations on logarithmic bins
+    """
+    def __init__(self):
+        self.counts = np.zeros(len(EDGES) + 1, dtype=np.int64)  # 両端は範囲外
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.counts[np.searchsorted(EDGES, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> float:
+        """
+        :param q: 0~100
+        :return: upper edge of the bin which contains the q-th percentile [s]
+        """
+        if self.count == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), self.count * q / 100))
+        return float(EDGES[i]) if i < len(EDGES) else self.max
+
+    def as_dict(self) -> dict:
+        return {'count': self.count, 'mean': self.mean(), 'p50': self.percentile(50),
+                'p95': self.percentile(95), 'max': self.max}
+
+
+class PortStats:
+    """
+    counters of one port
+    latency is measured from write to reply for queries, and from submit to write for commands
+    """
+    def __init__(self, name: str = ''):
+        self.name = name
+        self.t0 = time.perf_counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.messages_sent = 0
+        self.replies = 0
+        self.timeouts = {}
+        self.parse_failures = {}
+        self.resyncs = 0  # 返答が失われて受信をやり直した回数
+        self.latency = {}
+
+    def sent(self, msgs: list, nbytes: int):
+        self.messages_sent += len(msgs)
+        self.bytes_sent += nbytes
+
+    def received(self, msg: str, reply: str, seconds: float, eol: int = 1):
+        self.replies += 1
+        self.bytes_received += len(reply) + eol
+        self.add_latency(msg, seconds)
+
+    def add_latency(self, msg: str, seconds: float):
+        key = command_type(msg)
+        if key not in self.latency:
+            self.latency[key] = LatencyHistogram()
+        self.latency[key].add(seconds)
+
+    def timeout(self, msg: str):
+        key = command_type(msg)
+        self.timeouts[key] = self.timeouts.get(key, 0) + 1
+
+    def resync(self):
+        self.resyncs += 1
+
+    def parse_failure(self, msg: str, reply: str):
+        if reply == '':  # タイムアウトとして数えてある
+            return
+        key = command_type(msg)
+        self.parse_failures[key] = self.parse_failures.get(key, 0) + 1
+
+    def as_dict(self) -> dict:
+        elapsed = time.perf_counter() - self.t0
+        return {'name': self.name, 'elapsed': elapsed,
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                'bytes_per_second': (self.bytes_sent + self.bytes_received) / elapsed if elapsed > 0 else 0.0,
+                'messages_sent': self.messages_sent, 'replies': self.replies,
+                'timeouts': dict(self.timeouts), 'parse_failures': dict(self.parse_failures),
+                'resyncs': self.resyncs,
+                'latency': {key: hist.as_dict() for key, hist in list(self.latency.items())}}
+
+    def summary(self) -> str:
+        """
+        :return: a few lines for the status panel
+        """
+        d = self.as_dict()
+        lines = [f'{self.name}: sent {d["bytes_sent"]} B / {d["messages_sent"]} msgs, '
+                 f'received {d["bytes_received"]} B, {d["bytes_per_second"]:.0f} B/s',
+                 f'  timeouts {sum(self.timeouts.values())}, parse failures {sum(self.parse_failures.values())}, '
+                 f'resyncs {self.resyncs}']
+        for key, hist in sorted(d['latency'].items(), key=lambda item: -item[1]['count']):
+            lines.append(f'  {key:14s} n={hist["count"]:<6d} p50 {hist["p50"] * 1000:6.1f} ms  '
+                         f'p95 {hist["p95"] * 1000:6.1f} ms')
+        return '\n'.join(lines)
+
+
+def dump(stats: list, filename: str, **extra):
+    """
+    write stats of ports to a json file
+    :param stats: list of PortStats
+    :param extra: other values written with them (e.g. suppressed bytes)
+    """
+    with open(filename, 'w') as f:
+        json.dump({'time': time.time(), 'ports': [s.as_dict() for s in stats], **extra}, f, indent=2)
+
+
+async def dump_periodically(stats: list, filename: str, interval: float = 10.0):
+    """
+    call dump every interval seconds until cancelled
+    """
+    while True:
+        await asyncio.sleep(interval)
+        dump(stats, filename)
@@ -0,0 +1,207 @@
+# 軌跡(Trajectory)をステージとレーザーに送って実行する
+# tkinterには依存しないので、GUI以外からも使える
+import time
+import asyncio
+import itertools
+from DS102Controller import AsyncDS102Controller
+from PulseLaserController import AsyncPulseLaserController
+from MotionModel import MotionModel
+from PulsePitch import PulsePitch
+from Journal import Journal
+
+
+WAIT_READY = 'ready'  # ステージの完了を確認して次の線分を送る
+WAIT_SLEEP = 'sleep'  # 予測時間 + margin だけ待つ (以前の方式)
+
+
+class JobReport:
+    """
+    timing of one executed job
+    """
+    def __init__(self):
+        self.segments = 0
+        self.predicted = 0.0  # 予測した移動時間の合計 [s]
+        self.elapsed = 0.0  # 実際にかかった時間 [s]
+        self.completed = True
+        self.laser_writes = 0
+        self.laser_suppressed = 0  # 状態が変わらないため送らなかったレーザーの命令
+        self.pitch_limited = 0  # 周波数の範囲に収めるため速度を変えた線分
+
+    def throughput(self) -> float:
+        """
+        :return: executed segments per second
+        """
+        return self.segments / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {'segments': self.segments, 'predicted': self.predicted, 'elapsed': self.elapsed,
+                'throughput': self.throughput(), 'completed': self.completed,
+                'laser_writes': self.laser_writes, 'laser_suppressed': self.laser_suppressed,
+                'pitch_limited': self.pitch_limited}
+
+
+class JobExecutor:
+    def __init__(self, stage: AsyncDS102Controller, laser: AsyncPulseLaserController = None, frq: int = None,
+                 wait_mode: str = WAIT_READY, margin: float = 0.3, timeout_factor: float = 3.0,
+                 model: MotionModel = None, pitch: PulsePitch = None, journal: Journal = None,
+                 tolerance: float = 2.0):
+        """
+        :param stage: controller of the stage
+        :param laser: controller of the laser. None if the laser is not switched by the job
+        :param frq: frequency while the laser emits [Hz]
+        :param wait_mode: WAIT_READY or WAIT_SLEEP
+        :param margin: time added to each segment in WAIT_SLEEP mode [s]
+        :param timeout_factor: a segment fails if it takes longer than the prediction times this value (+1 s)
+        :param model: predicts the segments with acceleration. the durations of the trajectory are used if None
+        :param pitch: set the velocity and the frequency of each segment to keep the pulse spacing instead of frq
+        :param journal: the completed segments are recorded here. segments done before a resume are skipped
+        :param tolerance: a segment has completed if the stage is this close to its end [μm] (WAIT_READY only)
+        :type stage: AsyncDS102Controller
+        :type laser: AsyncPulseLaserController
+        :type frq: int
+        :type wait_mode: str
+        :type margin: float
+        :type timeout_factor: float
+        :type model: MotionModel
+        :type pitch: PulsePitch
+        :type journal: Journal
+        :type tolerance: float
+        """
+        if wait_mode not in [WAIT_READY, WAIT_SLEEP]:
+            raise ValueError(f'wait_mode must be {WAIT_READY} or {WAIT_SLEEP}.')
+        self.stage = stage
+        self.laser = laser
+        self.frq = frq
+        self.wait_mode = wait_mode
+        self.margin = margin
+        self.timeout_factor = timeout_factor
+        self.model = model
+        self.pitch = pitch
+        self.journal = journal
+        self.tolerance = tolerance
+
+    async def wait_segment(self, duration: float) -> bool:
+        if self.wait_mode == WAIT_SLEEP:
+            await asyncio.sleep(duration + self.margin)
+            return True
+        return await self.stage.wait_motion_complete(duration, duration * self.timeout_factor + 1)
+
+    async def reached(self, x: float, y: float) -> bool:
+        """
+        check that a motion which became ready has really reached its end
+        READY also comes after an emergency stop or at a mechanical limit
+        :param x: absolute target [μm]
+        :param y: absolute target [μm]
+        :rtype: bool
+        """
+        if self.wait_mode == WAIT_SLEEP:
+            return True  # 問い合わせずに待つモードでは確認しない
+        for _ in range(2):  # 返答が化けて0になった場合に備えてもう一度聞く
+            x_cur, y_cur = await self.stage.get_position()
+            if abs(x_cur - x) <= self.tolerance and abs(y_cur - y) <= self.tolerance:
+                return True
+        return False
+
+    async def return_to(self, point, origin, vel: int = None) -> bool:
+        """
+        move to a point with the laser off (e.g. the end of the last completed segment when resuming)
+        :param point: [μm] relative to origin
+        :param vel: velocity for the prediction [μm/s]
+        :rtype: bool
+        :return: True if the stage has reached the point (not stopped on the way)
+        """
+        if self.laser is not None:
+            await self.laser.stop()
+        x, y = origin[0] + point[0], origin[1] + point[1]
+        x_cur, y_cur = await self.stage.get_position()
+        predicted = max(abs(x - x_cur), abs(y - y_cur)) / vel if vel else 0
+        stops = self.stage.stops
+        await self.stage.move_line(x * 0.001, y * 0.001)
+        if not await self.stage.wait_motion_complete(predicted, predicted * self.timeout_factor + 1 if vel else None):
+            await self.stage.stop()
+            return False
+        return self.stage.stops == stops and await self.reached(x, y)
+
+    async def run(self, chunks, origin=(0, 0), vel: int = None) -> JobReport:
+        """
+        execute a trajectory
+        :param chunks: iterable of Trajectory (e.g. Trajectory.iter_build or Trajectory.chunks)
+        :param origin: position of the start point of the trajectory [μm]
+        :param vel: velocity of the stage [μm/s]. not changed if None
+        :type vel: int
+        :rtype: JobReport
+        :return: timing of the job
+        """
+        report = JobReport()
+        x0, y0 = origin
+        t0 = time.perf_counter()
+        if self.laser is not None:
+            laser_stats = self.laser.stats()
+        if vel is not None:
+            await self.stage.set_velocity_all(vel)
+        try:
+            for chunk in chunks:
+                if self.journal is not None and self.journal.skipping():
+                    # 再開: 前回までに完了した線分は飛ばす
+                    n = min(self.journal.resume - self.journal.next, len(chunk))
+                    self.journal.skip(n, chunk.points[n - 1] if n > 0 else chunk.start)
+                    chunk = chunk.skip(n)
+                    if len(chunk) == 0:
+                        continue
+                if self.journal is not None and self.journal.returning:
+                    # 最後に完了した点に戻ってから続ける
+                    self.journal.returning = False
+                    if not await self.return_to(self.journal.point, origin, vel):
+                        print('Could not return to the last completed point.')
+                        report.completed = False
+                        return report
+                if self.pitch is None:
+                    durations = chunk.durations if self.model is None else self.model.durations(chunk, vel)
+                    vels, frqs = itertools.repeat(None), itertools.repeat(self.frq)
+                else:
+                    vels, frqs, durations = self.pitch.apply(chunk, vel)
+                    if self.model is not None:
+                        durations = self.model.durations(chunk, vels)
+                    if vel is not None:
+                        report.pitch_limited += int((chunk.lasers & (vels != vel)).sum())
+                    vels, frqs = vels.tolist(), frqs.tolist()
+                for (x, y), duration, laser, v, frq in zip(chunk.points.tolist(), durations.tolist(),
+                                                           chunk.lasers.tolist(), vels, frqs):
+                    # 線分ごとの速度 (パルス間隔を保つ場合)。同じなら送信されない
+                    if v is not None:
+                        await self.stage.set_velocity_all(v)
+                    # 線分の境目で照射を切り替える (状態が変わるときだけ送信される)
+                    if self.laser is not None:
+                        await self.laser.switch(laser, frq)
+                    stops = self.stage.stops
+                    await self.stage.move_line((x0 + x) * 0.001, (y0 + y) * 0.001)
+                    if self.stage.stops == stops and not await self.wait_segment(duration):
+                        print(f'Segment {report.segments} did not complete in time.')
+                        await self.stage.stop()  # 最後のGOLineAを動かしたままにしない
+                        report.completed = False
+                        return report
+                    # 停止ボタンや機械限界で止まっても完了 (READY) になるので、本当に終点に着いたか確かめる
+                    if self.stage.stops != stops:
+                        print(f'Stopped during segment {report.segments}.')
+                        report.completed = False
+                        return report
+                    if not await self.reached(x0 + x, y0 + y):
+                        print(f'Segment {report.segments} stopped before its end (limit?).')
+                        await self.stage.stop()
+                        report.completed = False
+                        return report
+                    report.segments += 1
+                    report.predicted += duration
+                    if self.journal is not None:
+                        self.journal.completed((x, y), laser, frq if laser else 0)
+        finally:
+            if self.journal is not None:
+                self.journal.flush()
+            if self.laser is not None:
+                self.laser.cancel_scheduled()
+                await self.laser.stop(force=True)
+                stats = self.laser.stats()
+                report.laser_writes = stats['writes'] - laser_stats['writes']
+                report.laser_suppressed = stats['suppressed_writes'] - laser_stats['suppressed_writes']
+            report.elapsed = time.perf_counter() - t0
+        return report
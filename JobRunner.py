@@ -0,0 +1,311 @@
+# GUIを使わずにジョブファイルを実行する
+# python JobRunner.py jobs/example.json --simulate --report report.json
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import serial
+import numpy as np
+from ConfigLoader import ConfigLoader
+from DS102Controller import MySerial, AsyncDS102Controller
+from PulseLaserController import AsyncPulseLaserController, LaserPort
+from SerialTransport import SerialTransport
+from VirtualDevice import open_virtual_ports
+from JobExecutor import JobExecutor, WAIT_READY
+from Trajectory import Trajectory, LINE, RECTANGLE, VERTICAL, HORIZONTAL, build
+from PathOptimizer import merge_collinear, choose_fill_direction, order_shapes, estimate, join
+from Telemetry import Telemetry
+from MotionModel import MotionModel
+from PulsePitch import PulsePitch
+from Journal import Journal, load_journal
+
+
+SHAPES = {'line': LINE, 'rectangle': RECTANGLE}
+DIRECTIONS = {'vertical': VERTICAL, 'horizontal': HORIZONTAL}
+
+
+class Job:
+    """
+    sequence of shapes loaded from a job file (json)
+
+    {
+      "velocity": 1000,           # μm/s
+      "frequency": 100,           # Hz, 0 or null keeps the laser off
+      "pitch": 2,                 # μm, optional. the frequency of each segment is velocity / pitch (see PulsePitch)
+      "optimize": true,           # reorder shapes and merge collinear segments
+      "shapes": [
+        {"shape": "rectangle", "x": 100, "y": 100, "offset": [0, 0],
+         "fill": true, "interval": 5, "direction": "vertical",   # "horizontal" or "auto"
+         "velocity": 500, "frequency": 200, "pitch": 0}            # optional, override the job
+      ]
+    }
+    x, y and offset are in μm, relative to the position of the stage when the job starts (y is upward)
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, 'r') as f:
+            job = json.load(f)
+        self.velocity = job.get('velocity', 100)
+        self.frequency = job.get('frequency', 0)
+        self.pitch = job.get('pitch', 0)
+        self.optimize = job.get('optimize', False)
+        self.shapes = [self.load_shape(shape) for shape in job['shapes']]
+
+    def load_shape(self, shape: dict) -> dict:
+        if shape['shape'] not in SHAPES:
+            raise ValueError(f'Invalid shape: {shape["shape"]}. It must be line or rectangle.')
+        vel = shape.get('velocity', self.velocity)
+        if not 0 < vel <= 25000:
+            raise ValueError(f'Invalid velocity: {vel}. It must be 1~25000.')
+        frq = shape.get('frequency', self.frequency) or 0
+        if frq and not 16 <= frq <= 10000:
+            raise ValueError(f'Invalid frequency: {frq}. It must be 16~10000.')
+        pitch = shape.get('pitch', self.pitch) or 0
+        if pitch < 0:
+            raise ValueError(f'Invalid pitch: {pitch}. It must be positive.')
+        x, y, d = shape['x'], shape['y'], shape.get('interval', 5)
+        is_filled = shape.get('fill', False)
+        if is_filled and SHAPES[shape['shape']] != RECTANGLE:
+            raise ValueError(f'Invalid fill: {shape["shape"]} cannot be filled. Only rectangle can be filled.')
+        direction = shape.get('direction', 'vertical')
+        if direction == 'auto':
+            direction = choose_fill_direction(x, y, d, vel)
+        else:
+            direction = DIRECTIONS[direction]
+        trajectory = build(SHAPES[shape['shape']], x, y, vel, d, is_filled, direction)
+        ox, oy = shape.get('offset', [0, 0])
+        return {'trajectory': trajectory.translated((ox, -oy)),  # この系のy軸は下向きが正
+                'velocity': vel, 'frequency': frq, 'pitch': pitch}
+
+
+def open_ports(cl: ConfigLoader, simulate: bool = False, station: dict = None):
+    """
+    open the ports of the stage and the laser
+    :param cl: loaded config
+    :param simulate: use the virtual devices whatever the mode is
+    :param station: one of cl.stations. the first one if None
+    :rtype: (MySerial, serial.Serial)
+    """
+    if simulate or cl.mode == 'SIMULATION':
+        return open_virtual_ports(cl)  # 呼ぶたびに別の仮想デバイスになる
+    if cl.mode == 'RELEASE':
+        station = cl.stations[0] if station is None else station
+        # 2つのポートを同時に開く (レーザーはポートを開くと再起動するので、その待ちも早く始まる)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [pool.submit(MySerial, station['port_stage'], station['baudrate_stage'], write_timeout=0),
+                       pool.submit(serial.Serial, station['port_laser'], station['baudrate_laser'], write_timeout=0)]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            for future in futures:
+                if future.exception() is None:
+                    future.result().close()
+            raise errors[0]
+        return futures[0].result(), futures[1].result()
+    raise ValueError('JobRunner needs RELEASE or SIMULATION mode (or --simulate).')
+
+
+async def initialize(stage: AsyncDS102Controller, laser: AsyncPulseLaserController, timeout: float = 3.0) -> dict:
+    """
+    initialize the stage and wait for the laser at the same time
+    :param timeout: deadline of the handshake with the laser [s]
+    :rtype: dict
+    :return: time until each device was ready [s] and whether it answered
+    """
+    t0 = time.perf_counter()
+
+    async def timed(coro):
+        result = await coro
+        return result, time.perf_counter() - t0
+
+    (stage_ready, t_stage), (laser_ready, t_laser) = await asyncio.gather(timed(stage.initialize()),
+                                                                          timed(laser.wait_ready(timeout)))
+    if not laser_ready:
+        print(f'The pulse laser did not answer in {timeout} s.')
+    return {'stage': t_stage, 'laser': t_laser, 'stage_ready': stage_ready, 'laser_ready': laser_ready}
+
+
+async def record(stage: AsyncDS102Controller, laser: AsyncPulseLaserController, telemetry: Telemetry,
+                 interval: float):
+    """
+    append the status of the stage to telemetry until cancelled
+    """
+    while True:
+        status = await stage.get_status()
+        telemetry.append(time.perf_counter(), status.x, status.y, status.limit_x, status.limit_y,
+                         -1 if laser.frq is None else laser.frq)
+        await asyncio.sleep(interval)
+
+
+async def execute(job: Job, stage: AsyncDS102Controller, laser: AsyncPulseLaserController,
+                  wait_mode: str = WAIT_READY, model: MotionModel = None, journal: Journal = None,
+                  origin=None) -> dict:
+    """
+    execute a job on initialized controllers, relative to the current position
+    :param model: used for the estimate and the timing of the segments if given
+    :param journal: the completed segments are recorded here. a resumed journal skips the segments done before
+    :param origin: position where the job started [μm] (e.g. the origin in the journal to resume). the current position if None
+    :rtype: dict
+    :return: timing report of the shapes
+    """
+    t0 = time.perf_counter()
+    report = {'shapes': []}
+    if origin is None:
+        origin = await stage.get_position()
+    origin = np.array(origin, dtype=float)
+    shapes = job.shapes
+    trajectories = [shape['trajectory'] for shape in shapes]
+    tour = [(i, False) for i in range(len(shapes))]
+    # 最適化による短縮が分かるよう、最適化の前後の見積もりを残す
+    before = estimate(join(trajectories, tour, vel=job.velocity), model=model)
+    after = before
+    if job.optimize:
+        trajectories = [merge_collinear(trajectory) for trajectory in trajectories]
+        tour = order_shapes(trajectories)
+        after = estimate(join(trajectories, tour, vel=job.velocity), model=model)
+    report['estimate'] = {'before': before, 'after': after}
+
+    t_job = time.perf_counter()
+    report['setup'] = t_job - t0  # 最初の命令を送るまでの準備
+    if journal is not None:
+        journal.begin(origin, {'job': job.filename})
+    position = np.zeros(2)
+    completed = False
+    try:
+        for i, flip in tour:
+            shape = shapes[i]
+            trajectory = trajectories[i].reversed() if flip else trajectories[i]
+            # 図形の開始位置まではレーザーを止めて移動する (再開するときも同じ番号になるよう記録に含める)
+            travel = Trajectory([trajectory.start], [np.abs(trajectory.start - position).max() / job.velocity],
+                                [False], position)
+            result = await JobExecutor(stage, laser, wait_mode=wait_mode, model=model,
+                                       journal=journal).run([travel], origin, job.velocity)
+            if not result.completed:
+                break
+            pitch = PulsePitch(shape['pitch']) if shape['pitch'] else None
+            executor = JobExecutor(stage, laser if shape['frequency'] or pitch else None, shape['frequency'],
+                                   wait_mode=wait_mode, model=model, pitch=pitch, journal=journal)
+            result = await executor.run(trajectory.chunks(), origin, shape['velocity'])
+            report['shapes'].append(dict(index=i, reversed=flip, **result.as_dict()))
+            if not result.completed:
+                break
+            position = trajectory.end()
+        else:
+            completed = True
+    finally:
+        if journal is not None:
+            journal.end(completed)
+    report['elapsed'] = time.perf_counter() - t_job
+    return report
+
+
+async def run(job: Job, ser_stage: MySerial, ser_laser: serial.Serial, wait_mode: str = WAIT_READY,
+              telemetry: Telemetry = None, interval: float = 0.05, model: MotionModel = None,
+              laser_timeout: float = 3.0, started: float = None, journal: Journal = None, origin=None) -> dict:
+    """
+    open the controllers on the ports and execute a job
+    :param telemetry: the status of the stage is recorded here during the job if given
+    :param interval: interval of the recording [s]
+    :param model: see execute
+    :param laser_timeout: deadline of the handshake with the laser [s]
+    :param started: time.perf_counter() when the ports were opened. now if None
+    :param journal: see execute
+    :param origin: see execute
+    :rtype: dict
+    :return: timing report
+    """
+    t0 = time.perf_counter() if started is None else started
+    transport_stage = SerialTransport(ser_stage, name='stage')
+    transport_laser = SerialTransport(LaserPort(ser_laser), read_replies=False, name='laser')
+    await transport_stage.start()
+    await transport_laser.start()
+    stage = AsyncDS102Controller(transport_stage)
+    laser = AsyncPulseLaserController(transport_laser)
+    init = await initialize(stage, laser, laser_timeout)
+    startup = time.perf_counter() - t0
+    recording = asyncio.create_task(record(stage, laser, telemetry, interval)) if telemetry is not None else None
+
+    try:
+        report = await execute(job, stage, laser, wait_mode, model, journal, origin)
+    finally:
+        if recording is not None:
+            recording.cancel()
+        # 例外や中断で抜けた場合もステージを動かしたままにしない
+        try:
+            await stage.stop()
+            await laser.stop(force=True)
+        except ConnectionError:
+            pass
+        await transport_stage.close()
+        await transport_laser.close()
+    report['startup'] = startup
+    report['init'] = init
+    report['first_command'] = startup + report['setup']
+    report['total'] = time.perf_counter() - t0
+    report['io'] = [transport_stage.stats.as_dict(), transport_laser.stats.as_dict()]
+    report['io'][0]['suppressed_bytes'] = stage.suppressed_bytes
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a job file without the GUI.')
+    parser.add_argument('job', help='job file (json)')
+    parser.add_argument('--config', default='./config.json', help='config file')
+    parser.add_argument('--simulate', action='store_true', help='use the virtual devices')
+    parser.add_argument('--report', help='write the timing report (json) to this file')
+    parser.add_argument('--telemetry', help='record the position of the stage to this file (see Telemetry.py)')
+    parser.add_argument('--interval', type=float, default=0.05, help='interval of the recording [s]')
+    parser.add_argument('--journal', help='record the completed segments to this file (see Journal.py)')
+    parser.add_argument('--resume', action='store_true', help='continue the last job in the journal')
+    args = parser.parse_args()
+
+    cl = ConfigLoader(args.config)
+    job = Job(args.job)
+    journal = None
+    origin = None
+    if args.resume:
+        if not args.journal:
+            print('--resume needs --journal.')
+            return
+        state = load_journal(args.journal)
+        if state is None or state.finished:
+            print('Nothing to resume in the journal.')
+            return
+        if state.settings.get('job') != args.job:
+            print(f'The journal is of {state.settings.get("job")}, not {args.job}.')
+            return
+        print(f'Resume after {state.done} segments.')
+        journal = Journal(args.journal, cl.journal_interval, state)
+        origin = state.origin
+    elif args.journal:
+        journal = Journal(args.journal, cl.journal_interval)
+    model = MotionModel(cl.motion_acceleration, cl.motion_max_velocity, cl.motion_settle)
+    telemetry = None
+    if args.telemetry:
+        telemetry = Telemetry()
+        telemetry.start_recording(args.telemetry)
+    started = time.perf_counter()
+    ser_stage, ser_laser = open_ports(cl, args.simulate)
+    try:
+        report = asyncio.run(run(job, ser_stage, ser_laser, telemetry=telemetry, interval=args.interval, model=model,
+                                 laser_timeout=cl.startup_laser_timeout, started=started,
+                                 journal=journal, origin=origin))
+    finally:
+        if journal is not None:
+            journal.close()
+        ser_stage.close()
+        ser_laser.close()
+        if telemetry is not None:
+            print(f'{telemetry.stop_recording()} samples recorded')
+
+    print(f'{sum(s["segments"] for s in report["shapes"])} segments in {report["elapsed"]:.2f} s '
+          f'(startup {report["startup"]:.2f} s, first command {report["first_command"]:.2f} s, '
+          f'estimated {report["estimate"]["after"]["total"]:.2f} s, '
+          f'{report["estimate"]["before"]["total"]:.2f} s without optimization)')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
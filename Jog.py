@@ -0,0 +1,123 @@
+# ジョイスティック (MovableOval) の操作をステージへの命令に変える
+# 操作が速く続いても命令の数は一定以下に抑える
+# アナログモードでは速度をつまみの変位に比例させ、斜めにも動かせる
+import math
+import time
+from DS102Controller import MySerial, axis2msg
+
+
+class RateLimiter:
+    """
+    calls func at most max_rate times per second
+    requests in the meantime are merged, and only the latest one is called when the interval has passed
+    runs on the tkinter main loop (after)
+    """
+    def __init__(self, widget, func, max_rate: float = 10):
+        """
+        :param widget: any tkinter widget (used for after)
+        :param func: function called with the arguments of request
+        :param max_rate: max calls per second
+        """
+        self.widget = widget
+        self.func = func
+        self.interval = 1 / max_rate
+        self.last = -float('inf')
+        self.pending = None  # まだ送っていない最新の要求
+        self.job = None
+        self.calls = 0
+        self.merged = 0  # 新しい要求に置き換えられて送らなかった要求の数
+
+    def request(self, *args):
+        if self.pending is not None:
+            self.merged += 1
+        self.pending = args
+        wait = self.last + self.interval - time.perf_counter()
+        if wait <= 0:
+            self.flush()
+        elif self.job is None:
+            self.job = self.widget.after(int(wait * 1000) + 1, self.flush)
+
+    def flush(self):
+        self.job = None
+        if self.pending is None:
+            return
+        args, self.pending = self.pending, None
+        self.last = time.perf_counter()
+        self.calls += 1
+        self.func(*args)
+
+    def cancel(self):
+        """
+        drop the pending request (e.g. the stop must not be followed by an old move)
+        """
+        if self.job is not None:
+            self.widget.after_cancel(self.job)
+            self.job = None
+        self.pending = None
+
+
+def update_bytes() -> int:
+    """
+    :return: bytes sent by one analog update in the worst case (Fspeed0 and GO on both axes)
+    """
+    msgs = [axis2msg(axis) + cmd for axis in ['x', 'y'] for cmd in ['Fspeed0 25000', 'GO 5']]
+    return sum(len(msg) + len(MySerial.eol) for msg in msgs)
+
+
+def budget_rate(baudrate: int, budget: float) -> float:
+    """
+    :param baudrate: baudrate of the stage
+    :param budget: fraction of the serial bandwidth which jogging may use (0~1)
+    :return: max analog updates per second
+    """
+    # 1バイトはスタートビットとストップビットを含めて10ビット
+    return budget * baudrate / 10 / update_bytes()
+
+
+class AnalogJog:
+    """
+    converts the displacement of the knob to the velocity of both axes
+    the velocity grows continuously with the displacement (power of curve)
+    """
+    def __init__(self, max_velocity: int = 5000, radius: float = 135, dead_zone: float = 15, curve: float = 2.0,
+                 hysteresis: float = 0.02):
+        """
+        :param max_velocity: velocity at the edge of the pad [μm/s]
+        :param radius: displacement at the edge of the pad [px]
+        :param dead_zone: displacement below this is zero [px]
+        :param curve: exponent of the response. 1 is linear, larger values give finer control near the center
+        :param hysteresis: changes smaller than this fraction of max_velocity are ignored
+        """
+        self.max_velocity = max_velocity
+        self.radius = radius
+        self.dead_zone = dead_zone
+        self.curve = curve
+        self.threshold = hysteresis * max_velocity
+        self.sent = (0, 0)  # 最後に送った速度
+
+    def velocity(self, dx: float, dy: float):
+        """
+        :param dx: displacement of the knob [px] (right is positive)
+        :param dy: displacement of the knob [px] (down is positive, same as the stage)
+        :rtype: (int, int)
+        :return: velocity of x and y [μm/s]
+        """
+        r = math.hypot(dx, dy)
+        if r <= self.dead_zone:
+            return 0, 0
+        ratio = min((r - self.dead_zone) / (self.radius - self.dead_zone), 1)
+        speed = self.max_velocity * ratio ** self.curve
+        vel = []
+        for d in [dx, dy]:
+            v = int(round(speed * d / r))
+            vel.append(max(min(v, 25000), -25000))  # move_velocityの範囲に収める
+        return tuple(vel)
+
+    def changed(self, vel) -> bool:
+        """
+        :return: True if vel should be sent (an axis starts, stops, reverses or changes more than the hysteresis)
+        """
+        for v, s in zip(vel, self.sent):
+            if (v == 0) != (s == 0) or v * s < 0 or abs(v - s) > self.threshold:
+                return True
+        return False
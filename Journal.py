@@ -0,0 +1,159 @@
+# 長いジョブの進み具合をファイルに追記し、中断したところから再開できるようにする
+# 1行に1つのJSON。書き込みは interval 秒ごとにまとめ、そのたびにfsyncする
+# python Journal.py journal.jsonl
+import os
+import json
+import time
+import argparse
+from collections import namedtuple
+
+
+# done: 完了した線分の数 (次に実行する線分の番号), point: 最後に完了した線分の終点 (originからの相対) [μm]
+JournalState = namedtuple('JournalState', ['origin', 'settings', 'done', 'point', 'laser', 'frq', 'finished'])
+
+
+class Journal:
+    """
+    append-only record of the completed segments of a job
+
+    {"start": 1700000000.0, "origin": [x, y], "resume": 0, "settings": {...}}   # every run (or resumed run)
+    {"done": 1200, "point": [x, y], "laser": true, "frq": 100}                 # every interval
+    {"end": true, "done": 5000}                                                 # completed or not
+
+    the segments are numbered through the whole job, over every JobExecutor.run which shares the journal.
+    a resumed run skips the first `resume` segments and continues from the end of the last one
+    """
+    def __init__(self, filename: str, interval: float = 1.0, state: JournalState = None):
+        """
+        :param filename: journal file. appended if it exists
+        :param interval: the progress is written at most once in this time [s]
+        :param state: state loaded from the file to resume (see load_journal). None starts from the first segment
+        """
+        self.filename = filename
+        self.interval = interval
+        self.resume = 0 if state is None else state.done
+        self.next = 0  # 次の線分の番号
+        self.point = None if state is None else state.point
+        self.returning = self.resume > 0  # 最初の線分の前に、最後に完了した点へ戻る
+        self.laser = False
+        self.frq = None
+        self.written = 0  # ファイルに書いた完了数
+        self.last_sync = time.perf_counter()
+        self.f = open(filename, 'a')
+
+    def begin(self, origin, settings: dict = None):
+        """
+        write the start of a run
+        :param origin: position of the stage where the job started [μm]. the same as before when resuming
+        :param settings: whatever is needed to build the same job again
+        """
+        self.write({'start': time.time(), 'origin': [float(v) for v in origin], 'resume': self.resume,
+                    'settings': settings or {}})
+        self.written = self.resume
+        self.sync()
+
+    def skipping(self) -> bool:
+        """
+        :return: True while the segments done before the resume are passed
+        """
+        return self.next < self.resume
+
+    def skip(self, n: int, point):
+        """
+        pass n segments done before the resume
+        :param point: end of the last one [μm]
+        """
+        self.next += n
+        self.point = [float(v) for v in point]
+
+    def completed(self, point, laser: bool, frq: int = None):
+        """
+        record that the next segment has completed. written to the file once in interval
+        :param point: end of the segment [μm]
+        :param laser: True if the laser emitted during the segment
+        :param frq: frequency of the laser [Hz]
+        """
+        self.next += 1
+        self.point = point
+        self.laser = laser
+        self.frq = frq
+        if time.perf_counter() - self.last_sync >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        write the progress now if it has changed
+        """
+        if self.next > self.written:
+            self.write({'done': self.next, 'point': [float(v) for v in self.point], 'laser': self.laser,
+                        'frq': self.frq})
+            self.written = self.next
+            self.sync()
+
+    def end(self, completed: bool):
+        """
+        write the end of the run
+        :param completed: False if the job was interrupted (it can be resumed)
+        """
+        self.flush()
+        self.write({'end': completed, 'done': self.next})
+        self.sync()
+
+    def write(self, record: dict):
+        self.f.write(json.dumps(record) + '\n')
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.last_sync = time.perf_counter()
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+
+
+def load_journal(filename: str) -> JournalState:
+    """
+    read the progress of the last job in a journal
+    a broken last line (e.g. power failure while writing) is ignored
+    :rtype: JournalState
+    :return: state of the last job, or None if the file has no job
+    """
+    state = None
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if 'start' in record:
+                if state is None or record['resume'] == 0:
+                    state = JournalState(record['origin'], record['settings'], 0, None, False, None, False)
+                state = state._replace(done=max(state.done, record['resume']), finished=False)
+            elif state is None:
+                continue
+            elif 'end' in record:
+                state = state._replace(done=record['done'], finished=record['end'])
+            elif 'done' in record:
+                state = state._replace(done=record['done'], point=record['point'], laser=record['laser'],
+                                       frq=record['frq'])
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the progress of the last job in a journal.')
+    parser.add_argument('journal', help='journal file')
+    args = parser.parse_args()
+
+    state = load_journal(args.journal)
+    if state is None:
+        print('No job in the journal.')
+        return
+    print(f'origin: {state.origin}, settings: {state.settings}')
+    print(f'{state.done} segments done, last point {state.point}, laser {"on" if state.laser else "off"} '
+          f'({"finished" if state.finished else "can be resumed"})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# DS102の動作時間を加速度を考慮して見積もる
+# Trajectoryのdurations (距離 / 速度) の代わりに使える
+# python MotionModel.py --calibrate recording.bin --vel 1000
+# python MotionModel.py --job jobs/example.json
+import json
+import argparse
+import numpy as np
+from Trajectory import Trajectory
+from Telemetry import load_recording
+
+
+class MotionModel:
+    """
+    trapezoidal velocity profile of GOLineA with per-axis acceleration and max velocity
+    the axis with the longer travel (major) runs at vel and the other axis (minor) follows it,
+    so the minor axis moves at ratio = minor / major of the velocity and the acceleration of the major axis
+    """
+    def __init__(self, acceleration=(100000, 100000), max_velocity=(25000, 25000), settle: float = 0.0):
+        """
+        :param acceleration: acceleration of x and y [μm/s^2] (or one value for both)
+        :param max_velocity: max velocity of x and y [μm/s] (or one value for both)
+        :param settle: time from the end of the motion until READY [s]
+        """
+        self.acceleration = np.broadcast_to(np.asarray(acceleration, dtype=float), 2).copy()
+        self.max_velocity = np.broadcast_to(np.asarray(max_velocity, dtype=float), 2).copy()
+        self.settle = settle
+        if not (np.all(self.acceleration > 0) and np.all(self.max_velocity > 0)):
+            raise ValueError('acceleration and max_velocity must be positive.')
+
+    def as_dict(self) -> dict:
+        """
+        :return: the MOTION section of config.json
+        """
+        return {'acceleration': self.acceleration.tolist(), 'max_velocity': self.max_velocity.tolist(),
+                'settle': self.settle}
+
+    def profile(self, deltas, vel):
+        """
+        velocity profile of GOLineA along the major axis
+        :param deltas: (N, 2) travel of each segment [μm]
+        :param vel: velocity [μm/s], scalar or (N,)
+        :rtype: (np.ndarray, np.ndarray, np.ndarray)
+        :return: travel of the major axis [μm], cruise velocity [μm/s] and acceleration [μm/s^2]
+        """
+        deltas = np.abs(np.asarray(deltas, dtype=float).reshape(-1, 2))
+        n = np.arange(len(deltas))
+        major = (deltas[:, 1] > deltas[:, 0]).astype(int)  # 同じ場合はx (仮想デバイスと同じ)
+        length = deltas[n, major]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(length > 0, deltas[n, 1 - major] / length, 0)
+            # 従う軸もその軸の上限を超えないようにする
+            v = np.minimum(np.minimum(vel, self.max_velocity[major]),
+                           np.where(ratio > 0, self.max_velocity[1 - major] / ratio, np.inf))
+            a = np.minimum(self.acceleration[major],
+                           np.where(ratio > 0, self.acceleration[1 - major] / ratio, np.inf))
+        return length, v, a
+
+    def segment_times(self, deltas, vel) -> np.ndarray:
+        """
+        :param deltas: (N, 2) travel of each segment [μm]
+        :param vel: velocity [μm/s], scalar or (N,)
+        :rtype: np.ndarray
+        :return: (N,) time from the command until READY [s]. 0 for segments of length 0
+        """
+        length, v, a = self.profile(deltas, vel)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # 距離が短い場合は最高速度に達しない(三角形プロファイル)
+            times = np.where(length * a >= v ** 2, length / v + v / a, 2 * np.sqrt(length / a))
+        return np.where(length > 0, times + self.settle, 0.0)
+
+    def durations(self, trajectory: Trajectory, vel: float = None) -> np.ndarray:
+        """
+        :param trajectory: trajectory to execute
+        :param vel: velocity of the stage [μm/s]. if None, the velocity of each segment is taken from
+                    its nominal duration (distance / vel), so trajectories joined with different velocities work
+        :rtype: np.ndarray
+        :return: (N,) estimated time of each segment [s]
+        """
+        deltas = trajectory.points - trajectory.starts()
+        if vel is None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vel = np.abs(deltas).max(axis=1) / trajectory.durations  # 長さ0の線分は使わない
+        return self.segment_times(deltas, vel)
+
+    def apply(self, trajectory: Trajectory, vel: float = None) -> Trajectory:
+        """
+        :return: the same trajectory with the estimated durations
+        :rtype: Trajectory
+        """
+        return Trajectory(trajectory.points, self.durations(trajectory, vel), trajectory.lasers, trajectory.start)
+
+    def total(self, trajectory: Trajectory, vel: float = None) -> float:
+        return float(self.durations(trajectory, vel).sum())
+
+    @classmethod
+    def calibrate(cls, samples: np.ndarray, vel: float = None, base: 'MotionModel' = None,
+                  tolerance: float = 0.5, resolution: float = 1.0, max_ratio: float = 0.2, min_moves: int = 3):
+        """
+        fit the acceleration of each axis to recorded positions (see Telemetry)
+        moves are the runs of samples between rests. the duration T and the travel L of each straight,
+        nearly axis-aligned move are fitted to T = L / v + v / a (trapezoid), so the samples should be
+        much denser than the moves (e.g. JobRunner --telemetry with a small --interval)
+        :param samples: records of Telemetry.SAMPLE (e.g. load_recording)
+        :param vel: commanded velocity [μm/s]. fitted together with the acceleration if None
+        :param base: model whose values are kept for what cannot be fitted (settle, max velocity, axes without moves)
+        :param tolerance: position changes below this are rest [μm]
+        :param resolution: step of the recorded positions [μm]. a move is seen only after it has travelled
+                           about this far, so the measured durations are corrected by the time it takes
+        :param max_ratio: moves with minor / major above this are not used
+        :param min_moves: an axis needs this many moves to be fitted
+        :rtype: (MotionModel, dict)
+        :return: calibrated model and the fit of each axis
+        """
+        base = cls() if base is None else base
+        moves = find_moves(samples, tolerance)
+        acceleration = base.acceleration.copy()
+        info = {}
+        for axis, name in enumerate(['x', 'y']):
+            mine = [(length, duration) for major, length, ratio, duration in moves
+                    if major == axis and ratio <= max_ratio]
+            info[name] = {'moves': len(mine)}
+            if len(mine) < min_moves:
+                continue
+            length, duration = np.array(mine).T
+            used = np.ones(len(length), dtype=bool)
+            a = acceleration[axis]
+            for _ in range(5):
+                # 始めと終わりの見えない移動の分を足し、三角形プロファイルになった短い移動を除いて合わせ直す
+                if used.sum() < min_moves:
+                    break
+                corrected = duration + 2 * np.sqrt(2 * resolution / a)
+                if vel is None:
+                    (p, q), *_ = np.linalg.lstsq(np.column_stack([length[used], np.ones(used.sum())]),
+                                                 corrected[used], rcond=None)
+                    v = 1 / p if p > 0 else np.inf
+                else:
+                    v, q = vel, float(np.mean(corrected[used] - length[used] / vel))
+                if not (q > 0 and np.isfinite(v)):
+                    break
+                a = v / q
+                used = length * a >= v ** 2
+                acceleration[axis] = a
+                info[name].update(velocity=float(v), acceleration=float(a), used=int(used.sum()))
+            if 'acceleration' in info[name]:
+                deltas = np.zeros((len(length), 2))
+                deltas[:, axis] = length
+                residual = corrected - cls(acceleration, base.max_velocity).segment_times(deltas, info[name]['velocity'])
+                info[name]['rms'] = float(np.sqrt(np.mean(residual ** 2)))
+        return cls(acceleration, base.max_velocity, base.settle), info
+
+
+def find_moves(samples: np.ndarray, tolerance: float = 0.5) -> list:
+    """
+    split recorded positions into moves from rest to rest
+    the start and the end of a move are taken in the middle of the samples around them
+    :param samples: records of Telemetry.SAMPLE
+    :param tolerance: position changes below this are rest [μm]
+    :rtype: list
+    :return: list of (major axis, travel of the major axis [μm], minor / major, duration [s]) of straight moves
+    """
+    t = samples['t']
+    p = np.column_stack([samples['x'], samples['y']]).astype(float)
+    moving = np.abs(np.diff(p, axis=0)).max(axis=1) > tolerance
+    # 動いている区間のまとまりの始まりと終わり (記録の両端で切れたものは使わない)
+    edges = np.diff(moving.astype(int))
+    starts = np.flatnonzero(edges == 1) + 1
+    ends = np.flatnonzero(edges == -1) + 1
+    ends = ends[ends > (starts[0] if len(starts) else len(t))]
+    moves = []
+    for s, e in zip(starts, ends):
+        # 区間s~e-1が動いている: p[s]まで止まっていて、p[e]で止まった
+        delta = p[e] - p[s]
+        major = int(abs(delta[1]) > abs(delta[0]))
+        length = abs(delta[major])
+        if length <= tolerance or e - s < 2:
+            continue
+        # 途中で向きを変えた (2つの線分が1つに見えている) ものは使わない
+        d = p[s + 1:e] - p[s]
+        off_line = np.abs(d[:, 0] * delta[1] - d[:, 1] * delta[0]) / np.hypot(*delta)
+        if off_line.max(initial=0) > 2 * tolerance + 0.01 * length:
+            continue
+        duration = (t[e - 1] + t[e]) / 2 - (t[s] + t[s + 1]) / 2
+        moves.append((major, length, abs(delta[1 - major]) / length, duration))
+    return moves
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate the motion model or estimate a job.')
+    parser.add_argument('--calibrate', help='recording of the telemetry (see Telemetry.py)')
+    parser.add_argument('--vel', type=float, help='velocity used in the recording [μm/s]')
+    parser.add_argument('--job', help='job file (json) to estimate')
+    parser.add_argument('--config', default='./config.json', help='config file')
+    args = parser.parse_args()
+
+    from ConfigLoader import ConfigLoader
+    cl = ConfigLoader(args.config)
+    model = MotionModel(cl.motion_acceleration, cl.motion_max_velocity, cl.motion_settle)
+    if args.calibrate:
+        model, info = MotionModel.calibrate(load_recording(args.calibrate), args.vel, model)
+        for axis, fit in info.items():
+            print(f'{axis}: ' + ', '.join(f'{key} {value:.4g}' for key, value in fit.items()))
+        print(json.dumps({'MOTION': model.as_dict()}))
+    if args.job:
+        from JobRunner import Job
+        from PathOptimizer import join
+        job = Job(args.job)
+        trajectory = join([shape['trajectory'] for shape in job.shapes], [(i, False) for i in range(len(job.shapes))],
+                          vel=job.velocity)
+        print(f'{len(trajectory)} segments, distance / velocity {trajectory.total_duration():.2f} s, '
+              f'motion model {model.total(trajectory):.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# 軌跡の生成と実行の間で、レーザーを止めて移動する時間を減らす
+# ・同じ向き・同じ照射状態で続く線分をまとめる
+# ・塗りつぶしの走査方向を選ぶ
+# ・複数の図形を最近傍法 + 2-optで並べ替える
+import numpy as np
+from Trajectory import Trajectory, VERTICAL, HORIZONTAL, count_fill, rectangle
+from MotionModel import MotionModel
+
+
+# 線分1本ごとにかかる余分な時間 (送信と完了確認) [s]
+SEGMENT_OVERHEAD = 0.03
+
+
+def travel_time(a, b, vel: float) -> float:
+    """
+    time of GOLineA from a to b (the longer axis runs at vel)
+    """
+    return float(np.max(np.abs(np.asarray(b, dtype=float) - a))) / vel
+
+
+def estimate(trajectory: Trajectory, overhead: float = SEGMENT_OVERHEAD, model: MotionModel = None) -> dict:
+    """
+    :param trajectory: trajectory to execute
+    :param overhead: time added to every segment [s]
+    :param model: MotionModel. the durations of the trajectory (distance / velocity) are used if None
+    :rtype: dict
+    :return: total time, time without emission and number of segments
+    """
+    times = (trajectory.durations if model is None else model.durations(trajectory)) + overhead
+    return {'total': float(times.sum()), 'travel': float(times[~trajectory.lasers].sum()),
+            'segments': len(trajectory)}
+
+
+def merge_collinear(trajectory: Trajectory) -> Trajectory:
+    """
+    merge consecutive segments going in the same direction with the same laser state
+    :rtype: Trajectory
+    """
+    if len(trajectory) < 2:
+        return trajectory
+    vectors = trajectory.points - trajectory.starts()
+    a, b = vectors[:-1], vectors[1:]
+    cross = a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+    dot = (a * b).sum(axis=1)
+    scale = np.abs(a).sum(axis=1) * np.abs(b).sum(axis=1)
+    straight = (np.abs(cross) <= 1e-9 * scale) & (dot > 0)
+    # 長さ0の線分は前後どちらにもまとめてよい
+    zero = np.abs(vectors).sum(axis=1) == 0
+    same = (straight | zero[:-1] | zero[1:]) & (trajectory.lasers[:-1] == trajectory.lasers[1:])
+    keep = np.append(~same, True)  # 次とまとめない線分の終点だけを残す
+    first = np.flatnonzero(np.insert(keep[:-1], 0, True))  # まとめたグループの最初の線分
+    return Trajectory(trajectory.points[keep], np.add.reduceat(trajectory.durations, first),
+                      trajectory.lasers[keep], trajectory.start)
+
+
+def choose_fill_direction(x: float, y: float, d: float, vel: float, overhead: float = SEGMENT_OVERHEAD) -> int:
+    """
+    choose the scan direction of a serpentine fill which finishes first
+    :rtype: int
+    :return: VERTICAL or HORIZONTAL
+    """
+    times = []
+    for direction in [VERTICAL, HORIZONTAL]:
+        n = count_fill(x, y, d, direction)
+        scan = abs(y) if direction == VERTICAL else abs(x)
+        lines = (n + 1) // 2
+        times.append(lines * scan / vel + (lines - 1) * d / vel + n * overhead)
+    return VERTICAL if times[0] <= times[1] else HORIZONTAL
+
+
+class _GridIndex:
+    """
+    uniform grid over the entry points of the shapes for nearest neighbour queries
+    """
+    def __init__(self, points: np.ndarray, owners: np.ndarray):
+        self.points = points
+        self.owners = owners
+        lo, hi = points.min(axis=0), points.max(axis=0)
+        self.origin = lo
+        self.cell = max(float((hi - lo).max()) / max(np.sqrt(len(points)), 1), 1e-9)
+        cells = np.floor((points - lo) / self.cell).astype(int)
+        self.cells = {}
+        for i, key in enumerate(map(tuple, cells)):
+            self.cells.setdefault(key, []).append(i)
+        self.size = int(cells.max()) + 1 if len(cells) else 1
+
+    def nearest(self, p, used: np.ndarray):
+        """
+        :return: index of the nearest point whose owner is not used (Chebyshev distance), or None
+        """
+        cx, cy = np.floor((np.asarray(p) - self.origin) / self.cell).astype(int)
+        best, best_dist = None, np.inf
+        for ring in range(self.size + max(abs(cx), abs(cy)) + 1):
+            # これより外側の輪にはbest_distより近い点が無い
+            if best is not None and (ring - 1) * self.cell > best_dist:
+                break
+            for i in self._ring(cx, cy, ring):
+                if used[self.owners[i]]:
+                    continue
+                dist = np.abs(self.points[i] - p).max()
+                if dist < best_dist:
+                    best, best_dist = i, dist
+        return best
+
+    def _ring(self, cx: int, cy: int, ring: int):
+        for gx in range(cx - ring, cx + ring + 1):
+            for gy in range(cy - ring, cy + ring + 1):
+                if max(abs(gx - cx), abs(gy - cy)) != ring:
+                    continue
+                yield from self.cells.get((gx, gy), [])
+
+
+def order_shapes(shapes: list, start=(0, 0), max_passes: int = 50):
+    """
+    order shapes to shorten the travel between them
+    nearest neighbour on a grid index, then 2-opt which may also reverse shapes
+    :param shapes: list of Trajectory in the same coordinate system
+    :param start: current position [μm]
+    :param max_passes: limit of 2-opt passes
+    :rtype: list
+    :return: list of (index of the shape, True if it is traced reversed)
+    """
+    n = len(shapes)
+    if n == 0:
+        return []
+    entries = np.array([s.start for s in shapes], dtype=float)
+    exits = np.array([s.end() for s in shapes], dtype=float)
+    # 入口と出口のどちらからでも入れる
+    index = _GridIndex(np.vstack([entries, exits]), np.concatenate([np.arange(n), np.arange(n)]))
+    used = np.zeros(n, dtype=bool)
+    order, flipped = [], []
+    p = np.asarray(start, dtype=float)
+    for _ in range(n):
+        i = index.nearest(p, used)
+        shape, flip = i % n, i >= n
+        used[shape] = True
+        order.append(shape)
+        flipped.append(flip)
+        p = entries[shape] if flip else exits[shape]
+
+    # 2-opt: order[i..j]を逆順にし、各図形の向きも反転する
+    order, flipped = np.array(order), np.array(flipped)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n):
+            ins = np.where(flipped[:, np.newaxis], exits[order], entries[order])
+            outs = np.where(flipped[:, np.newaxis], entries[order], exits[order])
+            before = outs[i - 1] if i > 0 else np.asarray(start, dtype=float)
+            j = np.arange(i, n)  # j == i は1つの図形の向きだけを反転する
+            old = np.abs(ins[i] - before).max()
+            new = np.abs(outs[j] - before).max(axis=1)
+            has_next = j + 1 < n
+            nxt = ins[np.minimum(j + 1, n - 1)]
+            old = old + np.where(has_next, np.abs(nxt - outs[j]).max(axis=1), 0)
+            new = new + np.where(has_next, np.abs(nxt - ins[i]).max(axis=1), 0)
+            gain = old - new
+            k = int(np.argmax(gain))
+            if gain[k] > 1e-9:
+                jj = j[k]
+                order[i:jj + 1] = order[i:jj + 1][::-1]
+                flipped[i:jj + 1] = ~flipped[i:jj + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return list(zip(order.tolist(), flipped.tolist()))
+
+
+def join(shapes: list, tour: list, start=(0, 0), vel: float = 1000) -> Trajectory:
+    """
+    connect shapes in the order of the tour with laser-off moves
+    :param shapes: list of Trajectory
+    :param tour: list of (index, reversed) given by order_shapes
+    :param start: current position [μm]
+    :param vel: velocity of the moves between shapes [μm/s]
+    :rtype: Trajectory
+    """
+    parts = []
+    p = np.asarray(start, dtype=float)
+    for i, flip in tour:
+        shape = shapes[i].reversed() if flip else shapes[i]
+        parts.append(Trajectory([shape.start], [travel_time(p, shape.start, vel)], [False], p))
+        parts.append(shape)
+        p = shape.end()
+    return Trajectory.concatenate(parts)
+
+
+def optimize(shapes: list, start=(0, 0), vel: float = 1000, overhead: float = SEGMENT_OVERHEAD):
+    """
+    merge collinear segments and order the shapes
+    :param shapes: list of Trajectory in the same coordinate system
+    :param start: current position [μm]
+    :param vel: velocity of the moves between shapes [μm/s]
+    :param overhead: time added to every segment for the estimation [s]
+    :rtype: (Trajectory, dict)
+    :return: optimized trajectory, estimation before and after the optimization
+    """
+    before = estimate(join(shapes, [(i, False) for i in range(len(shapes))], start, vel), overhead)
+    merged = [merge_collinear(shape) for shape in shapes]
+    trajectory = join(merged, order_shapes(merged, start), start, vel)
+    return trajectory, {'before': before, 'after': estimate(trajectory, overhead)}
+
+
+def main():
+    rng = np.random.default_rng(0)
+    shapes = [rectangle(100, 100, 1000).translated(offset) for offset in rng.uniform(-3000, 3000, (200, 2))]
+    _, report = optimize(shapes)
+    for key, value in report.items():
+        print(f'{key:6s} total {value["total"]:.2f} s, travel {value["travel"]:.2f} s, {value["segments"]} segments')
+
+
+if __name__ == '__main__':
+    main()
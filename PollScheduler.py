@@ -0,0 +1,103 @@
+# update_positionの問い合わせ間隔を決める
+# 動いている間やジョブの実行中は速く、止まっている間はゆっくり問い合わせる
+import time
+import asyncio
+from DS102Controller import STATUS_BYTES
+
+
+class PollScheduler:
+    def __init__(self, min_rate: float = 1, max_rate: float = 20, baudrate: int = 38400, budget: float = 0.5,
+                 bytes_per_poll: int = STATUS_BYTES, backoff: float = 0.8):
+        """
+        :param min_rate: polling rate while idle [Hz]
+        :param max_rate: polling rate while moving [Hz]
+        :param baudrate: baudrate of the stage
+        :param budget: fraction of the serial bandwidth which polling may use (0~1)
+        :param bytes_per_poll: bytes sent by one poll
+        :param backoff: the rate is multiplied by this value at every idle poll until it reaches min_rate
+        :type min_rate: float
+        :type max_rate: float
+        :type baudrate: int
+        :type budget: float
+        :type bytes_per_poll: int
+        :type backoff: float
+        """
+        # 1バイトはスタートビットとストップビットを含めて10ビット
+        self.cap = budget * baudrate / 10 / bytes_per_poll
+        self.max_rate = min(max_rate, self.cap)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.backoff = backoff
+        self.rate = self.min_rate  # 現在の目標
+        self.effective_rate = 0.0  # 実際の問い合わせ頻度 (指数移動平均)
+        self.jobs = 0
+        self.last = None
+        self.started = None  # 直前の問い合わせを始めた時刻
+        self.loop = None
+        self.event = None
+
+    def is_active(self) -> bool:
+        return self.jobs > 0
+
+    def begin_job(self):
+        """
+        poll at max_rate until end_job is called
+        """
+        self.jobs += 1
+        self.wake()
+
+    def end_job(self):
+        self.jobs = max(self.jobs - 1, 0)
+
+    def wake(self):
+        """
+        poll at max_rate from now on (e.g. a move command was sent). can be called from any thread
+        """
+        self.rate = self.max_rate
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def tick(self, moving: bool) -> float:
+        """
+        record a poll and decide the next interval
+        :param moving: True if any axis is moving
+        :rtype: float
+        :return: time until the next poll [s]
+        """
+        t = time.perf_counter()
+        if self.last is not None and t > self.last:
+            self.effective_rate += (1 / (t - self.last) - self.effective_rate) * 0.3
+        self.last = t
+        if moving or self.is_active():
+            self.rate = self.max_rate
+        else:
+            self.rate = max(self.rate * self.backoff, self.min_rate)
+        # 問い合わせにかかった時間も間隔に含める
+        spent = 0 if self.started is None else t - self.started
+        return max(1 / self.rate - spent, 0)
+
+    async def sleep(self, moving: bool):
+        """
+        wait until the next poll. wake() ends the wait early
+        :param moving: True if any axis is moving
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.event = asyncio.Event()
+        interval = self.tick(moving)
+        try:
+            await asyncio.wait_for(self.event.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+        self.started = time.perf_counter()
+
+
+def main():
+    scheduler = PollScheduler()
+    print(f'cap {scheduler.cap:.1f} Hz, {scheduler.min_rate}~{scheduler.max_rate:.1f} Hz')
+    for moving in [True] * 3 + [False] * 15:
+        print(f'{"moving" if moving else "idle  "} {1 / scheduler.tick(moving):.1f} Hz')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# CommandWindowのプレビュー描画
+# 同じピクセルに収まる線分はまとめ、線分が多い場合は画像として描くことで、
+# 軌跡の大きさによらず再描画の時間を抑える
+import tkinter as tk
+import numpy as np
+from Trajectory import Trajectory
+
+
+COLOR_ON = (0, 128, 0)  # green
+COLOR_OFF = (160, 210, 160)  # レーザーを止めて移動する線分
+BOUND = 1 << 12  # これより外側の座標はキャンバスの外なので丸める
+SPAN = 2 * BOUND
+
+
+def project(trajectory: Trajectory, width: int, height: int):
+    """
+    convert the trajectory to canvas coordinates in the same way as before (origin included)
+    :rtype: (tuple, np.ndarray)
+    :return: start position on the canvas, (N, 4) rounded segments x0, y0, x1, y1
+    """
+    points = np.vstack([trajectory.points, [[0, 0]]])
+    max_x = max(np.abs(points[:, 0]).max(), 1)
+    max_y = max(np.abs(points[:, 1]).max(), 1)
+    amplitude = min(width / max_x, height / max_y) / 2
+    start = np.array([width / 2 - max_x / 2 * amplitude, height / 2 + max_y / 2 * amplitude])
+    if len(trajectory) == 0:
+        return tuple(start), np.zeros((0, 4), dtype=int)
+    starts = np.rint(trajectory.starts() * amplitude + start)
+    ends = np.rint(trajectory.points * amplitude + start)
+    return tuple(start), np.hstack([starts, ends]).astype(int)
+
+
+def collapse(segments: np.ndarray, lasers: np.ndarray):
+    """
+    remove segments which are drawn on the same pixels as another one
+    :param segments: (N, 4) pixel coordinates
+    :param lasers: (N,) laser state
+    :rtype: (np.ndarray, np.ndarray)
+    :return: unique segments and their laser state
+    """
+    if len(segments) == 0:
+        return segments, lasers.astype(bool)
+    # 向きを揃えてから重複を除く
+    forward = (segments[:, 0] < segments[:, 2]) | ((segments[:, 0] == segments[:, 2]) & (segments[:, 1] <= segments[:, 3]))
+    segments = np.where(forward[:, np.newaxis], segments, segments[:, [2, 3, 0, 1]])
+    # 1つの整数にまとめてからnp.uniqueに渡す (行ごとのuniqueより速い)
+    packed = np.clip(segments, -BOUND, BOUND - 1) + BOUND
+    keys = (((packed[:, 0] * SPAN + packed[:, 1]) * SPAN + packed[:, 2]) * SPAN + packed[:, 3]) * 2 + lasers
+    keys = np.unique(keys)
+    lasers = (keys & 1).astype(bool)
+    keys = keys >> 1
+    columns = []
+    for _ in range(4):
+        columns.append(keys % SPAN)
+        keys = keys // SPAN
+    return np.column_stack(columns[::-1]) - BOUND, lasers
+
+
+def rasterize(segments: np.ndarray, lasers: np.ndarray, width: int, height: int) -> bytes:
+    """
+    draw segments into an image
+    :rtype: bytes
+    :return: PPM image
+    """
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    # 照射する線分を後に描いて上書きする
+    for mask, color in [(~lasers, COLOR_OFF), (lasers, COLOR_ON)]:
+        part = segments[mask]
+        if len(part) == 0:
+            continue
+        n = np.abs(part[:, 2:] - part[:, :2]).max(axis=1) + 1  # 線分ごとのサンプル数
+        index = np.repeat(np.arange(len(part)), n)
+        t = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / np.maximum(np.repeat(n, n) - 1, 1)
+        x = np.rint(part[index, 0] + (part[index, 2] - part[index, 0]) * t).astype(int)
+        y = np.rint(part[index, 1] + (part[index, 3] - part[index, 1]) * t).astype(int)
+        inside = (0 <= x) & (x < width) & (0 <= y) & (y < height)
+        image[y[inside], x[inside]] = color
+    return f'P6 {width} {height} 255\n'.encode() + image.tobytes()
+
+
+class PreviewRenderer:
+    """
+    draws trajectories on a canvas
+    redraws are debounced, canvas items are reused and large trajectories are drawn as an image
+    """
+    def __init__(self, canvas: tk.Canvas, width: int, height: int, delay: int = 50, max_items: int = 1000):
+        """
+        :param canvas: canvas to draw on
+        :param width: width of the canvas
+        :param height: height of the canvas
+        :param delay: redraw this time after the last request [ms]
+        :param max_items: above this number of segments the trajectory is drawn as an image
+        """
+        self.canvas = canvas
+        self.width = width
+        self.height = height
+        self.delay = delay
+        self.max_items = max_items
+        self.job = None
+        self.lines = []  # 使い回すline item
+        self.photo = None
+        self.image = canvas.create_image(0, 0, anchor=tk.NW, state=tk.HIDDEN)
+        r = 3
+        self.r = r
+        self.start = canvas.create_oval(-r, -r, r, r, fill='red', width=0)
+
+    def request(self, get_trajectory):
+        """
+        draw after delay ms. requests in the meantime replace this one
+        :param get_trajectory: function returning the Trajectory to draw
+        :return:
+        """
+        if self.job is not None:
+            self.canvas.after_cancel(self.job)
+        self.job = self.canvas.after(self.delay, lambda: self.draw(get_trajectory()))
+
+    def draw(self, trajectory: Trajectory):
+        self.job = None
+        (start_x, start_y), segments = project(trajectory, self.width, self.height)
+        segments, lasers = collapse(segments, trajectory.lasers)
+
+        # START POSITION
+        r = self.r
+        self.canvas.coords(self.start, start_x - r, start_y - r, start_x + r, start_y + r)
+
+        if len(segments) > self.max_items:
+            self.photo = tk.PhotoImage(data=rasterize(segments, lasers, self.width, self.height), format='PPM')
+            self.canvas.itemconfig(self.image, image=self.photo, state=tk.NORMAL)
+            segments = segments[:0]
+        else:
+            self.canvas.itemconfig(self.image, state=tk.HIDDEN)
+
+        # 足りない分だけitemを作り、余った分は隠す
+        while len(self.lines) < len(segments):
+            self.lines.append(self.canvas.create_line(0, 0, 0, 0, fill='green', width=1))
+        for item, segment, laser in zip(self.lines, segments.tolist(), lasers.tolist()):
+            self.canvas.coords(item, *segment)
+            self.canvas.itemconfig(item, dash=() if laser else (1, 1), state=tk.NORMAL)
+        for item in self.lines[len(segments):]:
+            self.canvas.itemconfig(item, state=tk.HIDDEN)
+        self.canvas.tag_raise(self.start)
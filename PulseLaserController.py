@@ -1,32 +1,247 @@
 import time
+import asyncio
 import serial
+from SerialTransport import SerialTransport, LoopThread, PRIORITY_STOP, PRIORITY_COMMAND
 
 
-class PulseLaserController:
+class AsyncPulseLaserController:
+    def __init__(self, transport: SerialTransport, booting: bool = False):
+        """
+        initialization
+        :param transport: started transport of the laser port
+        :param booting: True if the port has just been opened. commands wait until wait_ready has finished
+        :type transport: SerialTransport
+        :type booting: bool
+        """
+        self.transport = transport
+        # 現在の周波数 (0: 停止中, None: 不明)。変化するときだけ書き込む
+        self.frq = None
+        self.writes = 0
+        self.suppressed_writes = 0
+        self.scheduled = set()
+        # wait_readyの間は書き込みを待たせる (起動中のレーザーは入力を無視する)
+        self.ready = asyncio.Event()
+        if not booting:
+            self.ready.set()
+
+    def invalidate(self):
+        """
+        forget the state of the laser so that the next command is always sent
+        :return:
+        """
+        self.frq = None
+
+    async def wait_ready(self, timeout: float = 3.0, interval: float = 0.1) -> bool:
+        """
+        handshake with the laser after the port is opened, instead of waiting for a fixed boot time
+        -1 (stop) is sent every interval until the laser echoes it. commands issued meanwhile wait for this
+        :param timeout: deadline [s]
+        :param interval: time to wait for the echo before sending again [s]
+        :type timeout: float
+        :type interval: float
+        :rtype: bool
+        :return: True if the laser answered (it is stopped then)
+        """
+        self.ready.clear()
+        try:
+            # 送受信はポートを直接使う (この間トランスポートからは書き込まない)
+            loop = asyncio.get_running_loop()
+            answered = await loop.run_in_executor(None, self.transport.ser.handshake, timeout, interval)
+        finally:
+            self.ready.set()
+        self.frq = 0 if answered else None
+        return answered
+
+    async def _write(self, frq: int, priority: int, purge: bool = False):
+        if not self.ready.is_set():
+            await self.ready.wait()
+        try:
+            await self.transport.command(f'{frq}\n', priority, purge)
+        except ConnectionAbortedError:
+            self.invalidate()  # 送る前に停止命令で取り消された
+            return
+        except Exception:
+            self.invalidate()
+            raise
+        self.writes += 1
+        self.frq = max(frq, 0)
+
+    async def set_frq(self, frq: int):
+        if 16 <= frq <= 10000:
+            if self.frq == frq:
+                self.suppressed_writes += 1
+                return
+            await self._write(frq, PRIORITY_COMMAND)
+        else:
+            print('Invalid frequency. It must be 16~10000(integer).')
+
+    async def stop(self, force: bool = False):
+        """
+        stop emission
+        :param force: send even if the laser is known to be stopped. the scheduled switchings are cancelled
+        :type force: bool
+        :return:
+        """
+        if force:
+            # 予約した切り替えが停止の後に照射を再開しないようにする
+            self.cancel_scheduled()
+        if self.frq == 0 and not force:
+            self.suppressed_writes += 1
+            return
+        # 強制停止では、まだ送っていない照射の命令を捨てる
+        await self._write(-1, PRIORITY_STOP, purge=force)
+
+    async def switch(self, on: bool, frq: int = None):
+        """
+        turn the laser on with frq or off. nothing is sent if the state does not change
+        :param on: True to emit
+        :param frq: frequency while emitting [Hz]
+        :type on: bool
+        :type frq: int
+        :return:
+        """
+        if on:
+            await self.set_frq(frq)
+        else:
+            await self.stop()
+
+    def schedule(self, delay: float, on: bool, frq: int = None) -> asyncio.Task:
+        """
+        switch the laser after delay seconds without waiting for it (e.g. at the predicted end of a segment)
+        must be called on the loop of the transport
+        :param delay: [s]
+        :param on: True to emit
+        :param frq: frequency while emitting [Hz]
+        :rtype: asyncio.Task
+        :return: task which can be cancelled until it fires
+        """
+        async def switch_later():
+            await asyncio.sleep(delay)
+            await self.switch(on, frq)
+
+        task = asyncio.get_running_loop().create_task(switch_later())
+        self.scheduled.add(task)
+        task.add_done_callback(self.scheduled.discard)
+        return task
+
+    def cancel_scheduled(self):
+        """
+        cancel every switching which has not fired yet
+        :return:
+        """
+        for task in list(self.scheduled):
+            task.cancel()
+
+    def stats(self) -> dict:
+        """
+        :rtype: dict
+        :return: number of written and suppressed commands
+        """
+        return {'writes': self.writes, 'suppressed_writes': self.suppressed_writes}
+
+
+class LaserPort:
+    # レーザーは改行コードを含めた文字列をそのまま書き込む
+    terminator = b'\n'
+    # readのタイムアウト。返答ごとの締め切りはこの間隔で確認する
+    poll_interval = 0.01
+
     def __init__(self, ser: serial.Serial):
+        self.ser = ser
+        self.ser.timeout = self.poll_interval
+        self._rx_buffer = bytearray()
+
+    def send_many(self, msgs: list):
+        self.ser.write(''.join(msgs).encode())
+
+    def recv_frame(self, timeout: float):
+        """
+        receive one line sent back by the laser
+        :param timeout: deadline for this line [s]
+        :type timeout: float
+        :rtype: str or None
+        :return: line without the terminator, or None if the deadline passed
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            i = self._rx_buffer.find(self.terminator)
+            if i >= 0:
+                frame = bytes(self._rx_buffer[:i])
+                del self._rx_buffer[:i + len(self.terminator)]
+                return frame.decode(errors='replace').strip()
+            if time.monotonic() >= deadline:
+                return None
+            n = self.ser.in_waiting
+            self._rx_buffer += self.ser.read(n if n > 0 else 1)
+
+    def handshake(self, timeout: float = 3.0, interval: float = 0.1) -> bool:
+        """
+        send -1 until the laser echoes it (blocking)
+        :param timeout: deadline [s]
+        :param interval: time to wait for the echo before sending again [s]
+        :rtype: bool
+        :return: True if the laser answered
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            # 起動前に送った分の返答や、以前の命令の返答は捨てる
+            self.ser.reset_input_buffer()
+            self._rx_buffer.clear()
+            self.send_many(['-1\n'])
+            if self.recv_frame(min(interval, max(deadline - time.monotonic(), 0))) == '-1':
+                return True
+        return False
+
+
+class PulseLaserController:
+    """
+    blocking API of the pulse laser
+    every method runs the corresponding coroutine of AsyncPulseLaserController on the I/O loop
+    """
+    def __init__(self, ser: serial.Serial, io: LoopThread = None, timeout: float = 3.0):
         """
         initialization
         :param ser: opened port for communication
+        :param io: loop which owns the port. a new one is started if None
+        :param timeout: deadline of the handshake after the port is opened [s].
+                        if None, call aio.wait_ready on the loop later
         :type ser: serial.Serial
+        :type io: LoopThread
+        :type timeout: float
         """
         self.ser = ser
-        time.sleep(1)
+        self.io = io if io is not None else LoopThread('laser-io')
+        self.transport = SerialTransport(LaserPort(ser), read_replies=False, name='laser')
+        self.io.run(self.transport.start())
+        self.aio = AsyncPulseLaserController(self.transport, booting=True)
+        if timeout is not None and not self.io.run(self.aio.wait_ready(timeout)):
+            print(f'The pulse laser did not answer in {timeout} s.')
+
+    def close(self):
+        """
+        stop the transport. the port itself is not closed
+        :return:
+        """
+        self.io.run(self.transport.close())
 
     def set_frq(self, frq: int):
-        if 16 <= frq <= 10000:
-            self.ser.write(f'{frq}\n'.encode())
-        else:
-            print('Invalid frequency. It must be 16~10000(integer).')
+        self.io.run(self.aio.set_frq(frq))
+
+    def stop(self, force: bool = False):
+        self.io.run(self.aio.stop(force))
+
+    def switch(self, on: bool, frq: int = None):
+        self.io.run(self.aio.switch(on, frq))
 
-    def stop(self):
-        self.ser.write('-1\n'.encode())
+    def stats(self) -> dict:
+        return self.aio.stats()
 
 
 def main():
     ser = serial.Serial('COM6', baudrate=9600, write_timeout=0)
-    time.sleep(2)
-    ser.write('-1\n'.encode())
-    print(ser.readline().decode())
+    t = time.perf_counter()
+    answered = LaserPort(ser).handshake()
+    print(f'{"answered" if answered else "no answer"} in {time.perf_counter() - t:.2f} s')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+# パルスの間隔 (ワーク上の距離) を一定にするように、速度からレーザーの周波数を決める
+# 周波数 = 経路上の速さ / 間隔。周波数が範囲外になるときは、間隔を保てる中で最も速い速度に変える
+# python PulsePitch.py --pitch 2 --vel 1000 30000 50
+import argparse
+import numpy as np
+from Trajectory import Trajectory
+
+
+FRQ_MIN = 16  # レーザーが受け付ける周波数の範囲 [Hz]
+FRQ_MAX = 10000
+VEL_MIN = 1  # DS102の速度の範囲 [μm/s]
+VEL_MAX = 25000
+
+
+class PulsePitch:
+    """
+    constant spacing of the pulses on the work piece
+    GOLineA runs the axis with the longer travel at vel, so the speed along a segment is
+    vel * (length / travel of the major axis). the frequency is that speed / pitch
+    """
+    def __init__(self, pitch: float):
+        """
+        :param pitch: distance between two pulses [μm]
+        """
+        if not pitch > 0:
+            raise ValueError(f'Invalid pitch: {pitch}. It must be positive.')
+        self.pitch = pitch
+
+    def frequency(self, speed: float):
+        """
+        frequency for a speed along the path (e.g. jogging)
+        :param speed: speed along the path [μm/s]
+        :rtype: (int, float)
+        :return: frequency [Hz] and the speed which keeps the pitch with it [μm/s]
+        """
+        frq = int(round(speed / self.pitch))
+        if FRQ_MIN <= frq <= FRQ_MAX:
+            return frq, speed
+        frq = min(max(frq, FRQ_MIN), FRQ_MAX)
+        return frq, frq * self.pitch
+
+    def segments(self, deltas, vel):
+        """
+        velocity and frequency of each segment
+        :param deltas: (N, 2) travel of each segment [μm]
+        :param vel: requested velocity (of the major axis) [μm/s], scalar or (N,)
+        :rtype: (np.ndarray, np.ndarray)
+        :return: (N,) velocity [μm/s] and (N,) frequency [Hz], both integer
+        """
+        deltas = np.abs(np.asarray(deltas, dtype=float).reshape(-1, 2))
+        major = deltas.max(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = np.where(major > 0, np.hypot(deltas[:, 0], deltas[:, 1]) / major, 1.0)  # 1 ~ √2
+        vel = np.broadcast_to(np.asarray(vel, dtype=float), len(deltas))
+        frq = np.clip(np.round(vel * factor / self.pitch), FRQ_MIN, FRQ_MAX)
+        # 範囲に収めた周波数で間隔を保つ速度 (範囲内ならほぼ元の速度)
+        limited = np.round(vel * factor / self.pitch) != frq
+        vel = np.where(limited, np.round(frq * self.pitch / factor), np.round(vel))
+        vel = np.clip(vel, VEL_MIN, VEL_MAX)
+        frq = np.clip(np.round(vel * factor / self.pitch), FRQ_MIN, FRQ_MAX)
+        return vel.astype(int), frq.astype(int)
+
+    def apply(self, trajectory: Trajectory, vel: float = None):
+        """
+        velocity and frequency of each segment of a trajectory. segments without the laser keep vel
+        :param vel: requested velocity [μm/s]. taken from the durations (distance / vel) if None
+        :rtype: (np.ndarray, np.ndarray, np.ndarray)
+        :return: (N,) velocity [μm/s], (N,) frequency [Hz] and (N,) durations with the velocity [s]
+        """
+        deltas = trajectory.points - trajectory.starts()
+        travel = np.abs(deltas).max(axis=1)
+        if vel is None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vel = np.where(trajectory.durations > 0, travel / trajectory.durations, VEL_MAX)
+        vel = np.broadcast_to(np.asarray(vel, dtype=float), len(trajectory))
+        vels, frqs = self.segments(deltas, vel)
+        vels = np.where(trajectory.lasers, vels, np.clip(np.round(vel), VEL_MIN, VEL_MAX).astype(int))
+        return vels, frqs, travel / vels
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the frequency which keeps the pulse pitch.')
+    parser.add_argument('vel', type=float, nargs='+', help='velocity [μm/s]')
+    parser.add_argument('--pitch', type=float, default=1.0, help='distance between pulses [μm]')
+    args = parser.parse_args()
+
+    pitch = PulsePitch(args.pitch)
+    vels, frqs = pitch.segments([[1, 0]] * len(args.vel), args.vel)
+    for requested, vel, frq in zip(args.vel, vels, frqs):
+        print(f'{requested:g} μm/s -> {vel} μm/s at {frq} Hz ({vel / frq:.3f} μm)')
+
+
+if __name__ == '__main__':
+    main()
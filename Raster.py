@@ -0,0 +1,188 @@
+# 画像 (グレースケール or 2値) をラスター走査の軌跡に変換する
+# 黒い画素が続く部分は1本の線分にまとめ、その間はレーザーを止めたまま動かす
+# 画像は数行ずつ読み、軌跡も数行ずつ生成するので、大きな画像でも線分をすべてメモリに置かない
+# python Raster.py logo.pgm --pitch 10 --vel 1000
+import argparse
+import numpy as np
+from Trajectory import Trajectory
+try:
+    from PIL import Image  # netpbm以外の形式 (png, bmpなど) を読む場合だけ使う
+except ImportError:
+    Image = None
+
+
+IMAGE = 2  # CommandWindowの図形の番号 (Trajectory.LINE, RECTANGLEの続き)
+ROWS = 64  # 1つのTrajectoryにまとめる画像の行数
+
+
+class RasterImage:
+    """
+    image whose rows are converted on demand
+    binary netpbm files are memory-mapped, so only the rows being converted are read
+    """
+    def __init__(self, data: np.ndarray, maxval: int = 255, width: int = None):
+        """
+        :param data: (H, W) gray levels (0 is black), or (H, ceil(W / 8)) packed bits of PBM (1 is black) if width is given
+        :param maxval: gray level of white
+        :param width: number of pixels in a row of packed bits
+        """
+        self.data = data
+        self.maxval = maxval
+        self.packed = width is not None
+        self.height = data.shape[0]
+        self.width = width if self.packed else data.shape[1]
+
+    def darkness(self, r0: int, r1: int) -> np.ndarray:
+        """
+        :return: (r1 - r0, W) 0 (white) ~ 1 (black) of the rows r0 ~ r1 - 1
+        """
+        block = np.asarray(self.data[r0:r1])
+        if self.packed:
+            return np.unpackbits(block, axis=1)[:, :self.width].astype(float)
+        return 1 - block.astype(float) / self.maxval
+
+    def reduced(self, max_pixels: int):
+        """
+        every factor-th row and column, for a preview of a large image
+        :param max_pixels: the result has about this many pixels at most
+        :rtype: (RasterImage, int)
+        :return: reduced image and factor (multiply the pitch by it)
+        """
+        factor = max(int(np.ceil(np.sqrt(self.width * self.height / max_pixels))), 1)
+        if factor == 1:
+            return self, 1
+        rows = np.asarray(self.data[::factor])  # メモリマップなら使う行だけ読む
+        if self.packed:
+            return RasterImage(1 - np.unpackbits(rows, axis=1)[:, :self.width:factor], 1), factor
+        return RasterImage(rows[:, ::factor], self.maxval), factor
+
+
+def read_header(f):
+    """
+    :param f: netpbm file opened in binary mode
+    :rtype: (bytes, int, int, int)
+    :return: magic number, width, height and maxval (1 for PBM). f is left at the start of the pixels
+    """
+    magic = f.read(2)
+    n = 2 if magic in [b'P1', b'P4'] else 3
+    values = []
+    token = b''
+    while len(values) < n:
+        c = f.read(1)
+        if c == b'':
+            raise ValueError('Truncated netpbm header.')
+        if c == b'#':
+            f.readline()
+            c = b'\n'
+        if c.isspace():
+            # 最後の値の後の空白1文字までがヘッダー
+            if token:
+                values.append(int(token))
+                token = b''
+        else:
+            token += c
+    width, height = values[:2]
+    return magic, width, height, values[2] if n == 3 else 1
+
+
+def load_image(filename: str) -> RasterImage:
+    """
+    load PBM (P1, P4) or PGM (P2, P5). other formats need Pillow
+    :rtype: RasterImage
+    """
+    with open(filename, 'rb') as f:
+        magic, width, height, maxval = read_header(f)
+        offset = f.tell()
+        if magic == b'P1':
+            digits = np.frombuffer(bytes(c for c in f.read() if c in b'01'), dtype=np.uint8) - ord('0')
+            return RasterImage(np.packbits(digits.reshape(height, width), axis=1), width=width)
+        if magic == b'P2':
+            return RasterImage(np.array(f.read().split(), dtype=int).reshape(height, width), maxval)
+    if magic == b'P4':
+        return RasterImage(np.memmap(filename, np.uint8, 'r', offset, (height, (width + 7) // 8)), width=width)
+    if magic == b'P5':
+        dtype = np.uint8 if maxval < 256 else np.dtype('>u2')
+        return RasterImage(np.memmap(filename, dtype, 'r', offset, (height, width)), maxval)
+    if Image is None:
+        raise ValueError('Only PBM and PGM images can be loaded without Pillow (pip install pillow).')
+    with Image.open(filename) as image:
+        return RasterImage(np.asarray(image.convert('L')), 255)
+
+
+def iter_raster(image: RasterImage, pitch: float, vel: float, threshold: float = 0.5, bidirectional: bool = True,
+                rows: int = ROWS):
+    """
+    raster scan of the dark pixels, generated a few rows at a time
+    the start position is the lower left corner of the image and the rows are scanned from the bottom.
+    every run of dark pixels in a row is one segment with the laser on (from the left edge of the first pixel
+    to the right edge of the last one), reached by a segment with the laser off
+    :param image: loaded image
+    :param pitch: size of a pixel [μm]
+    :param vel: velocity [μm/s]
+    :param threshold: pixels with darkness of this or more are engraved (0~1)
+    :param bidirectional: scan every other row from right to left
+    :param rows: number of image rows in one chunk
+    :return: generator of Trajectory
+    """
+    if pitch <= 0 or vel <= 0:
+        return
+    start = np.zeros(2)
+    scanned = 0  # これまでに走査した (黒い画素のある) 行の数
+    for r1 in range(image.height, 0, -rows):
+        r0 = max(r1 - rows, 0)
+        mask = image.darkness(r0, r1)[::-1] >= threshold  # 下の行から
+        # 黒い画素の連続を両端の位置で表す (run-length)
+        edges = np.diff(np.pad(mask, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+        row, a = np.nonzero(edges == 1)
+        _, b = np.nonzero(edges == -1)
+        if len(row) == 0:
+            continue
+        used = np.unique(row)
+        backward = bidirectional & ((np.searchsorted(used, row) + scanned) % 2 == 1)
+        scanned += len(used)
+        order = np.lexsort((np.where(backward, -a, a), row))
+        row, a, b, backward = row[order], a[order], b[order], backward[order]
+        y = -(image.height - (r1 - 1 - row) - 0.5) * pitch  # この系のy軸は下向きが正
+        points = np.empty((2 * len(row), 2))
+        points[0::2, 0] = np.where(backward, b, a) * pitch
+        points[1::2, 0] = np.where(backward, a, b) * pitch
+        points[0::2, 1] = points[1::2, 1] = y
+        lasers = np.tile([False, True], len(row))
+        starts = np.vstack([start[np.newaxis], points[:-1]])
+        chunk = Trajectory(points, np.abs(points - starts).max(axis=1) / vel, lasers, start)
+        start = chunk.end()
+        yield chunk
+
+
+def build_raster(image: RasterImage, pitch: float, vel: float, threshold: float = 0.5,
+                 bidirectional: bool = True) -> Trajectory:
+    """
+    whole raster scan (e.g. for the preview). use iter_raster to execute large images
+    :rtype: Trajectory
+    """
+    return Trajectory.concatenate(iter_raster(image, pitch, vel, threshold, bidirectional))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert an image to a raster scan and print its size.')
+    parser.add_argument('image', help='PBM or PGM (other formats need Pillow)')
+    parser.add_argument('--pitch', type=float, default=10, help='size of a pixel [μm]')
+    parser.add_argument('--vel', type=float, default=1000, help='velocity [μm/s]')
+    parser.add_argument('--threshold', type=float, default=0.5, help='darkness engraved (0~1)')
+    args = parser.parse_args()
+
+    image = load_image(args.image)
+    segments = largest = 0
+    duration = emission = 0.0
+    for chunk in iter_raster(image, args.pitch, args.vel, args.threshold):
+        segments += len(chunk)
+        largest = max(largest, len(chunk))
+        duration += chunk.total_duration()
+        emission += float(chunk.durations[chunk.lasers].sum())
+    print(f'{image.width} x {image.height} px, {image.width * args.pitch / 1000:.2f} x '
+          f'{image.height * args.pitch / 1000:.2f} mm')
+    print(f'{segments} segments (at most {largest} in a chunk), {duration:.1f} s, emission {emission:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+# シリアルポートをasyncioから扱うためのトランスポート
+# ポートごとに書き込みを1つのタスクが担当し、返答の受信だけを専用スレッドに任せる
+import heapq
+import asyncio
+import threading
+import itertools
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from Instrumentation import PortStats
+
+
+# 書き込みの優先度 (小さいほど先に送る)
+PRIORITY_STOP = 0
+PRIORITY_COMMAND = 1
+PRIORITY_QUERY = 2
+
+
+class SerialTransport:
+    """
+    asyncio transport over an opened serial port
+    a single writer task owns the port and takes messages from a priority queue
+    replies are matched to queries in the order they were written
+    """
+    def __init__(self, ser, read_replies: bool = True, read_timeout: float = 0.05, max_in_flight: int = 6,
+                 name: str = 'serial'):
+        """
+        :param ser: opened port. recv_frame(timeout) is used to read one reply
+        :param read_replies: False for devices that never answer
+        :param read_timeout: how long one blocking read may take [s]. also the delay of close()
+            and the silence which ends the resynchronization after a lost reply
+        :param max_in_flight: number of unanswered queries allowed on the wire
+        :param name: name of the port in the statistics
+        :type ser: MySerial
+        :type read_replies: bool
+        :type read_timeout: float
+        :type max_in_flight: int
+        :type name: str
+        """
+        self.ser = ser
+        self.stats = PortStats(name)
+        self.eol = len(getattr(ser, 'eol', b''))
+        self.read_replies = read_replies
+        self.read_timeout = read_timeout
+        self.max_in_flight = max_in_flight
+        self.queue = []  # heap of (priority, seq, msgs, reply futures, written future)
+        self.seq = itertools.count()
+        self.pending = collections.deque()  # 返答待ちのFuture (書き込んだ順)
+        self.has_pending = None
+        self.wakeup = None
+        self.reader = None
+        self.writer = None
+        self.executor = None
+        self.resyncing = False  # 返答が失われたので、受信を空にして対応付けをやり直す
+        self.closed = False
+
+    async def start(self):
+        """
+        start the writer and reader tasks on the running loop
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        self.has_pending = asyncio.Event()
+        self.wakeup = asyncio.Event()
+        self.writer = loop.create_task(self._write_loop())
+        if self.read_replies:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='serial-reader')
+            self.reader = loop.create_task(self._read_loop())
+
+    async def _write_loop(self):
+        while not self.closed:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            _, _, msgs, replies, written = self.queue[0]
+            # 返答待ちが多い間や同期を取り直す間は問い合わせを送らず、STOPなどが割り込めるようにしておく
+            if replies and (self.resyncing or
+                            self.pending and len(self.pending) + len(replies) > self.max_in_flight):
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            heapq.heappop(self.queue)
+            if written.cancelled():  # 送る前に取り消された
+                continue
+            self.pending.extend(replies)
+            if replies:
+                self.has_pending.set()
+            try:
+                self.ser.send_many(msgs)
+            except Exception as e:
+                written.set_exception(e)
+                self._fail_pending(e)
+                continue
+            self.stats.sent(msgs, sum(len(msg.encode()) + self.eol for msg in msgs))
+            written.set_result(None)
+
+    async def _read_loop(self):
+        loop = asyncio.get_running_loop()
+        while not self.closed:
+            if self.resyncing:
+                try:
+                    await loop.run_in_executor(self.executor, self._drain_input)
+                except Exception as e:
+                    self._fail_pending(e)
+                    return
+                # 返答待ちはすべて取り消す (呼び出し側にはタイムアウトとして'')
+                while self.pending:
+                    self.pending.popleft().cancel()
+                self.resyncing = False
+                self.stats.resync()
+                self.wakeup.set()
+                continue
+            if not self.pending:
+                self.has_pending.clear()
+                await self.has_pending.wait()
+                continue
+            try:
+                frame = await loop.run_in_executor(self.executor, self.ser.recv_frame, self.read_timeout)
+            except Exception as e:  # ポートが閉じられた場合など
+                self._fail_pending(e)
+                return
+            if frame is None or self.resyncing:  # 同期を取り直す間に届いた返答は誰のものか分からない
+                continue
+            future = self.pending.popleft() if self.pending else None
+            self.wakeup.set()
+            # キャンセルされた問い合わせの返答は捨てる
+            if future is not None and not future.done():
+                future.set_result(frame)
+
+    def _drain_input(self):
+        # 返答が途切れるまで読み捨ててから、途中まで届いた返答も含めて受信を空にする
+        while self.ser.recv_frame(self.read_timeout) is not None:
+            pass
+        self.ser.flush_input()
+
+    def _request_resync(self):
+        if self.resyncing or not self.read_replies:
+            return
+        self.resyncing = True
+        self.has_pending.set()
+
+    def _fail_pending(self, e: Exception):
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(e)
+
+    def submit(self, msgs: list, expect_reply: bool = False, priority: int = PRIORITY_COMMAND,
+               purge: bool = False):
+        """
+        put messages into the send queue. must be called on the loop of the transport
+        :param msgs: messages without eol. they are written in one piece
+        :param expect_reply: True if every message has one reply
+        :param priority: PRIORITY_STOP, PRIORITY_COMMAND or PRIORITY_QUERY
+        :param purge: drop the queued commands (PRIORITY_COMMAND) which are not written yet, e.g. with an emergency stop
+        :type msgs: list
+        :type expect_reply: bool
+        :type priority: int
+        :type purge: bool
+        :rtype: (list, asyncio.Future)
+        :return: futures of the replies, future which is done when the messages are written
+        """
+        if self.closed:
+            raise ConnectionError('transport closed')
+        if purge:
+            self._purge_commands()
+        loop = asyncio.get_running_loop()
+        replies = [loop.create_future() for _ in msgs] if expect_reply else []
+        written = loop.create_future()
+        heapq.heappush(self.queue, (priority, next(self.seq), msgs, replies, written))
+        self.wakeup.set()
+        return replies, written
+
+    def _purge_commands(self):
+        # 停止の後に、止める前に積まれた移動や照射の命令が送られないようにする
+        error = ConnectionAbortedError('dropped by a stop')
+        kept = []
+        for entry in self.queue:
+            priority, _, _, replies, written = entry
+            if priority != PRIORITY_COMMAND:
+                kept.append(entry)
+                continue
+            for future in replies + [written]:
+                if not future.done():
+                    future.set_exception(error)
+        heapq.heapify(kept)
+        self.queue = kept
+
+    async def command(self, msg: str, priority: int = PRIORITY_COMMAND, purge: bool = False):
+        """
+        send a message which has no reply
+        :param msg: message without eol
+        :param priority: PRIORITY_STOP jumps ahead of queued commands and queries
+        :param purge: drop the queued commands first (see submit). they raise ConnectionAbortedError
+        :type msg: str
+        :type priority: int
+        :type purge: bool
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        t = loop.time()
+        _, written = self.submit([msg], False, priority, purge)
+        await written
+        self.stats.add_latency(msg, loop.time() - t)
+
+    async def query(self, msg: str, timeout: float = None, priority: int = PRIORITY_QUERY) -> str:
+        """
+        send a message and wait for its reply
+        :param msg: message without eol
+        :param timeout: deadline of the reply after it is written [s]. reply_timeout of the port if None
+        :param priority: priority in the send queue
+        :type msg: str
+        :type timeout: float
+        :type priority: int
+        :rtype: str
+        :return: reply, or '' if the deadline passed
+        """
+        return (await self.query_many([msg], timeout, priority))[0]
+
+    async def query_many(self, msgs: list, timeout: float = None, priority: int = PRIORITY_QUERY) -> list:
+        """
+        write all messages back-to-back and wait for every reply
+        :param msgs: messages without eol
+        :param timeout: deadline of all replies after they are written [s]. reply_timeout of the port if None
+        :param priority: priority in the send queue
+        :type msgs: list
+        :type timeout: float
+        :type priority: int
+        :rtype: list
+        :return: replies. '' for the ones which did not arrive in time
+        """
+        futures, written = self.submit(msgs, True, priority)
+        if timeout is None:
+            timeout = self.ser.reply_timeout
+        try:
+            await written
+            t = asyncio.get_running_loop().time()
+            for msg, future in zip(msgs, futures):
+                future.add_done_callback(functools.partial(self._record_reply, msg, t))
+            done, _ = await asyncio.wait(futures, timeout=timeout)
+        except asyncio.CancelledError:
+            # 送信前なら送らずに捨て、送信後なら届いた返答を読み捨てる
+            written.cancel()
+            for future in futures:
+                future.cancel()
+            raise
+        replies = []
+        for msg, future in zip(msgs, futures):
+            if future in done and not future.cancelled():
+                replies.append(future.result())
+            else:
+                # 返答が1つ失われると、以降の返答が1つずつずれてしまう。
+                # 受信が静まるのを待って空にし、返答待ちをすべて取り消してから対応付けをやり直す
+                self.stats.timeout(msg)
+                future.cancel()
+                self._request_resync()
+                replies.append('')
+        return replies
+
+    def _record_reply(self, msg: str, t: float, future: asyncio.Future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.stats.received(msg, future.result(), future.get_loop().time() - t, self.eol)
+
+    async def close(self):
+        """
+        stop the writer and the reader. the port itself is not closed
+        :return:
+        """
+        self.closed = True
+        for event in [self.has_pending, self.wakeup]:
+            if event is not None:
+                event.set()
+        for task in [self.writer, self.reader]:
+            if task is not None:
+                await task
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        error = ConnectionError('transport closed')
+        while self.queue:
+            _, _, _, replies, written = heapq.heappop(self.queue)
+            for future in replies + [written]:
+                if not future.done():
+                    future.set_exception(error)
+        self._fail_pending(error)
+
+
+def report_exception(name: str, future):
+    if future.cancelled() or future.exception() is None:
+        return
+    e = future.exception()
+    print(f'{name} failed: {type(e).__name__}: {e}')
+
+
+class LoopThread:
+    """
+    event loop running in a daemon thread
+    blocking code submits coroutines to it and waits for the results
+    """
+    def __init__(self, name: str = 'serial-io'):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, coro, report: bool = True):
+        """
+        schedule a coroutine without waiting
+        :param report: print the exception if the coroutine fails (nobody may look at the future)
+        :rtype: concurrent.futures.Future
+        :return: future of the result
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if report:
+            future.add_done_callback(functools.partial(report_exception, coro.__qualname__))
+        return future
+
+    def run(self, coro, timeout: float = None):
+        """
+        run a coroutine on the loop and wait for its result
+        :param timeout: [s] None waits forever
+        :return: result of the coroutine
+        """
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError('LoopThread.run must not be called from its own loop.')
+        return self.submit(coro, report=False).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
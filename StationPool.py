@@ -0,0 +1,208 @@
+# 複数のステーション (ステージとレーザーの組) を1つのプロセスから並列に動かす
+# python StationPool.py jobs/example.json jobs/example.json --simulate --stations 4
+import json
+import time
+import asyncio
+import argparse
+from ConfigLoader import ConfigLoader
+from DS102Controller import AsyncDS102Controller
+from PulseLaserController import AsyncPulseLaserController, LaserPort
+from SerialTransport import SerialTransport
+from JobExecutor import WAIT_READY
+from JobRunner import Job, open_ports, initialize, execute
+from MotionModel import MotionModel
+
+
+class Station:
+    """
+    one stage and laser pair with its own transports
+    """
+    def __init__(self, name: str, ser_stage, ser_laser):
+        self.name = name
+        self.ser_stage = ser_stage
+        self.ser_laser = ser_laser
+        self.transport_stage = SerialTransport(ser_stage, name=f'{name}/stage')
+        self.transport_laser = SerialTransport(LaserPort(ser_laser), read_replies=False, name=f'{name}/laser')
+        self.stage = AsyncDS102Controller(self.transport_stage)
+        self.laser = AsyncPulseLaserController(self.transport_laser)
+        self.startup = 0.0
+        self.init = {}
+        self.jobs = 0
+        self.segments = 0
+        self.busy = 0.0  # ジョブを実行していた時間 [s]
+        self.error = None
+
+    async def start(self, laser_timeout: float = 3.0):
+        """
+        start the transports, initialize the stage and wait for the laser
+        :param laser_timeout: deadline of the handshake with the laser [s]
+        """
+        t0 = time.perf_counter()
+        await self.transport_stage.start()
+        await self.transport_laser.start()
+        self.init = await initialize(self.stage, self.laser, laser_timeout)
+        self.startup = time.perf_counter() - t0
+
+    async def close(self):
+        try:
+            await self.stage.stop()
+            await self.laser.stop(force=True)
+        except ConnectionError:
+            pass
+        await self.transport_stage.close()
+        await self.transport_laser.close()
+        self.ser_stage.close()
+        self.ser_laser.close()
+
+    async def status(self) -> dict:
+        status = (await self.stage.get_status())._asdict()
+        status['laser'] = self.laser.frq
+        return status
+
+    def summary(self) -> dict:
+        return {'startup': self.startup, 'init': self.init, 'jobs': self.jobs, 'segments': self.segments, 'busy': self.busy,
+                'throughput': self.segments / self.busy if self.busy > 0 else 0.0, 'error': self.error}
+
+
+class StationPool:
+    """
+    runs jobs on several stations at once
+    every station has one worker which takes the next job from a shared queue
+    """
+    def __init__(self, stations: list):
+        """
+        :param stations: list of Station
+        """
+        self.stations = stations
+
+    @classmethod
+    async def open(cls, cl: ConfigLoader, simulate: bool = False, n: int = None):
+        """
+        open and initialize the stations in parallel
+        :param cl: loaded config. the stations are taken from STATIONS
+        :param simulate: use virtual devices
+        :param n: number of virtual stations (simulate only). len(cl.stations) if None
+        :rtype: StationPool
+        """
+        if simulate and n is not None:
+            configs = [{'name': f'sim{i}'} for i in range(n)]
+        else:
+            configs = cl.stations
+        loop = asyncio.get_running_loop()
+        # ポートを開く処理はブロックするので別スレッドで同時に行う
+        results = await asyncio.gather(*(loop.run_in_executor(None, open_ports, cl, simulate, config)
+                                         for config in configs), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            for result in results:
+                if not isinstance(result, Exception):
+                    for ser in result:
+                        ser.close()
+            raise errors[0]
+        pool = cls([Station(config['name'], *ports) for config, ports in zip(configs, results)])
+        await asyncio.gather(*(station.start(cl.startup_laser_timeout) for station in pool.stations))
+        return pool
+
+    async def close(self):
+        await asyncio.gather(*(station.close() for station in self.stations))
+
+    async def status(self) -> dict:
+        """
+        :rtype: dict
+        :return: status of every station by name
+        """
+        statuses = await asyncio.gather(*(station.status() for station in self.stations))
+        return {station.name: status for station, status in zip(self.stations, statuses)}
+
+    async def run_jobs(self, jobs: list, wait_mode: str = WAIT_READY, model: MotionModel = None) -> dict:
+        """
+        execute jobs on the free stations
+        :param jobs: list of (name, Job)
+        :param model: see JobRunner.execute
+        :rtype: dict
+        :return: report of every job and of the whole run
+        """
+        queue = asyncio.Queue()
+        for i, (name, job) in enumerate(jobs):
+            queue.put_nowait((i, name, job))
+        results = []
+        t0 = time.perf_counter()
+        workers = [asyncio.ensure_future(self.worker(station, queue, results, wait_mode, model))
+                   for station in self.stations]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            # 予期しない例外やキャンセルで止まったら、ほかのステーションのジョブも止める
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+        elapsed = time.perf_counter() - t0
+        segments = sum(result['segments'] for result in results)
+        return {'elapsed': elapsed, 'jobs': sorted(results, key=lambda result: result['index']),
+                'left': queue.qsize(),  # 全ステーションが失敗して始められなかったジョブ
+                'segments': segments, 'throughput': segments / elapsed if elapsed > 0 else 0.0,
+                'stations': {station.name: station.summary() for station in self.stations}}
+
+    @staticmethod
+    async def worker(station: Station, queue: asyncio.Queue, results: list, wait_mode: str, model: MotionModel):
+        while not queue.empty():
+            i, name, job = queue.get_nowait()
+            t = time.perf_counter()
+            try:
+                report = await execute(job, station.stage, station.laser, wait_mode, model)
+            except (ConnectionError, OSError) as e:
+                # このステーションは止める。途中まで加工したジョブはやり直さず失敗として報告する
+                station.error = f'{type(e).__name__}: {e}'
+                results.append({'index': i, 'job': name, 'station': station.name,
+                                'elapsed': time.perf_counter() - t, 'segments': 0, 'completed': False,
+                                'error': station.error})
+                return
+            elapsed = time.perf_counter() - t
+            segments = sum(shape['segments'] for shape in report['shapes'])
+            station.jobs += 1
+            station.segments += segments
+            station.busy += elapsed
+            results.append({'index': i, 'job': name, 'station': station.name, 'elapsed': elapsed,
+                            'segments': segments, 'completed': all(s['completed'] for s in report['shapes']),
+                            'error': None})
+
+
+async def run(cl: ConfigLoader, filenames: list, simulate: bool, n: int) -> dict:
+    jobs = [(filename, Job(filename)) for filename in filenames]
+    t0 = time.perf_counter()
+    pool = await StationPool.open(cl, simulate, n)
+    startup = time.perf_counter() - t0
+    try:
+        model = MotionModel(cl.motion_acceleration, cl.motion_max_velocity, cl.motion_settle)
+        report = await pool.run_jobs(jobs, model=model)
+        report['status'] = await pool.status()
+    finally:
+        await pool.close()
+    report['startup'] = startup
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run job files on several stations in parallel.')
+    parser.add_argument('jobs', nargs='+', help='job files (json)')
+    parser.add_argument('--config', default='./config.json', help='config file')
+    parser.add_argument('--simulate', action='store_true', help='use virtual devices')
+    parser.add_argument('--stations', type=int, help='number of virtual stations (with --simulate)')
+    parser.add_argument('--report', help='write the report (json) to this file')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(ConfigLoader(args.config), args.jobs, args.simulate, args.stations))
+    print(f'{len(report["jobs"])} jobs, {report["segments"]} segments in {report["elapsed"]:.2f} s '
+          f'({report["throughput"]:.1f} segments/s, startup {report["startup"]:.2f} s)')
+    for name, station in report['stations'].items():
+        error = f', error: {station["error"]}' if station['error'] else ''
+        print(f'  {name}: {station["jobs"]} jobs, {station["segments"]} segments, '
+              f'busy {station["busy"]:.2f} s{error}')
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import tkinter as tk
+from tkinter import ttk
+
+
+class StatsWindow(tk.Toplevel):
+    """
+    shows the statistics of the serial ports (see Instrumentation.py)
+    """
+    def __init__(self, main_window, interval: int = 1000):
+        """
+        :param main_window: Application
+        :param interval: refresh interval [ms]
+        """
+        super().__init__()
+        self.title('Statistics')
+        self.main_window = main_window
+        self.interval = interval
+
+        self.text = tk.StringVar()
+        label = ttk.Label(self, textvariable=self.text, font=('Courier', 10), justify=tk.LEFT)
+        label.grid(row=0, column=0, padx=10, pady=10)
+
+        self.refresh()
+
+    def refresh(self):
+        stage, laser = self.main_window.stage, self.main_window.laser
+        if stage is None:  # DEBUGモード
+            self.text.set('No port is opened.')
+            return
+        lines = [stage.transport.stats.summary(),
+                 f'  suppressed {stage.aio.suppressed_commands} commands / {stage.suppressed_bytes} B',
+                 laser.transport.stats.summary(),
+                 f'  suppressed {laser.aio.suppressed_writes} writes']
+        self.text.set('\n'.join(lines))
+        self.after(self.interval, self.refresh)
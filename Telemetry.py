@@ -0,0 +1,155 @@
+# ステージの位置やレーザーの状態を記録する
+# 一定の数だけNumPy配列に保持し、必要ならファイルにも書き出す
+import threading
+import numpy as np
+
+
+# 1サンプルの形式 (laserは周波数 [Hz]、0は停止、-1は不明)
+SAMPLE = np.dtype([('t', '<f8'), ('x', '<f8'), ('y', '<f8'),
+                   ('limit_x', '?'), ('limit_y', '?'), ('laser', '<i4')])
+
+
+class TelemetryRecorder:
+    """
+    streams samples to a binary file (records of SAMPLE, without header)
+    at most block samples are kept in memory
+    """
+    def __init__(self, filename: str, block: int = 1024):
+        """
+        :param filename: output file. read it with load_recording
+        :param block: number of samples written at once
+        """
+        self.filename = filename
+        self.buffer = np.zeros(block, dtype=SAMPLE)
+        self.n = 0
+        self.written = 0
+        self.file = open(filename, 'wb')
+
+    def write(self, sample: tuple):
+        self.buffer[self.n] = sample
+        self.n += 1
+        if self.n == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.buffer[:self.n].tofile(self.file)
+        self.file.flush()
+        self.written += self.n
+        self.n = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+
+class Telemetry:
+    """
+    ring buffer of the latest samples
+    append can be called from one thread while snapshot is called from another one
+    """
+    def __init__(self, capacity: int = 4096):
+        """
+        :param capacity: number of samples kept in memory
+        """
+        self.data = np.zeros(capacity, dtype=SAMPLE)
+        self.capacity = capacity
+        self.count = 0  # これまでに追加したサンプルの数
+        self.recorder = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, t: float, x: float, y: float, limit_x: bool = False, limit_y: bool = False, laser: int = -1):
+        """
+        add a sample. the oldest one is overwritten when the buffer is full
+        :param t: time [s] (e.g. time.perf_counter())
+        :param x: position [μm]
+        :param y: position [μm]
+        :param limit_x: True if x is at the limit
+        :param limit_y: True if y is at the limit
+        :param laser: frequency [Hz]. 0 if the laser is off, -1 if unknown
+        """
+        sample = (t, x, y, limit_x, limit_y, laser)
+        with self.lock:
+            self.data[self.count % self.capacity] = sample
+            self.count += 1
+            if self.recorder is not None:
+                self.recorder.write(sample)
+
+    def snapshot(self, n: int = None) -> np.ndarray:
+        """
+        copy of the latest samples in chronological order
+        :param n: number of samples. all samples in the buffer if None
+        :rtype: np.ndarray
+        :return: structured array of SAMPLE
+        """
+        with self.lock:
+            size = len(self) if n is None else min(n, len(self))
+            i = np.arange(self.count - size, self.count) % self.capacity
+            return self.data[i]  # fancy indexingなのでコピーになる
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+
+    def start_recording(self, filename: str, block: int = 1024):
+        """
+        write every following sample to filename
+        """
+        self.stop_recording()
+        with self.lock:
+            self.recorder = TelemetryRecorder(filename, block)
+
+    def stop_recording(self):
+        """
+        :rtype: int
+        :return: number of written samples
+        """
+        with self.lock:
+            recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return 0
+        recorder.close()
+        return recorder.written
+
+    def export(self, filename: str):
+        """
+        save the samples in the buffer to a .npz file
+        """
+        snapshot = self.snapshot()
+        np.savez_compressed(filename, **{name: snapshot[name] for name in SAMPLE.names})
+
+
+def load_recording(filename: str) -> np.ndarray:
+    """
+    :param filename: file written by TelemetryRecorder, or .npz file written by Telemetry.export
+    :rtype: np.ndarray
+    :return: structured array of SAMPLE
+    """
+    if filename.endswith('.npz'):
+        with np.load(filename) as f:
+            data = np.zeros(len(f['t']), dtype=SAMPLE)
+            for name in SAMPLE.names:
+                data[name] = f[name]
+        return data
+    return np.fromfile(filename, dtype=SAMPLE)
+
+
+def main():
+    import time
+    telemetry = Telemetry(capacity=1000)
+    telemetry.start_recording('telemetry.bin', block=256)
+    t0 = time.perf_counter()
+    for i in range(100000):
+        telemetry.append(time.perf_counter(), i, -i, False, False, 100)
+    dt = time.perf_counter() - t0
+    written = telemetry.stop_recording()
+    print(f'{dt / 100000 * 1e6:.2f} μs per sample, {written} samples written, '
+          f'{len(load_recording("telemetry.bin"))} samples loaded')
+
+
+if __name__ == '__main__':
+    main()
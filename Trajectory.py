@@ -0,0 +1,192 @@
+# CommandWindowで描く図形の軌跡をNumPy配列で生成する
+# 座標系はCommandWindowと同じ (単位は μm、y軸は下向きが正、開始位置からの相対座標)
+import functools
+import numpy as np
+
+
+LINE = 0
+RECTANGLE = 1
+VERTICAL = 0  # 縦
+HORIZONTAL = 1  # 横
+CHUNK_SIZE = 4096
+
+
+class Trajectory:
+    """
+    sequence of straight segments
+    segment i goes from the end of segment i-1 (start for i=0) to points[i]
+    """
+    def __init__(self, points, durations, lasers, start=(0, 0)):
+        """
+        :param points: (N, 2) end point of each segment [μm]
+        :param durations: (N,) estimated time of each segment [s]
+        :param lasers: (N,) True if the laser emits during the segment
+        :param start: start point of the first segment [μm]
+        """
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.durations = np.asarray(durations, dtype=float)
+        self.lasers = np.asarray(lasers, dtype=bool)
+        self.start = np.asarray(start, dtype=float)
+        for array in [self.points, self.durations, self.lasers, self.start]:
+            array.flags.writeable = False  # キャッシュを共有するので書き換えられないようにする
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 2)), [], [])
+
+    @classmethod
+    def concatenate(cls, trajectories):
+        """
+        join trajectories which continue from each other
+        :param trajectories: iterable of Trajectory
+        :rtype: Trajectory
+        """
+        trajectories = list(trajectories)
+        if not trajectories:
+            return cls.empty()
+        return cls(np.concatenate([t.points for t in trajectories]),
+                   np.concatenate([t.durations for t in trajectories]),
+                   np.concatenate([t.lasers for t in trajectories]),
+                   trajectories[0].start)
+
+    def __len__(self):
+        return len(self.points)
+
+    def starts(self) -> np.ndarray:
+        """
+        :rtype: np.ndarray
+        :return: (N, 2) start point of each segment
+        """
+        return np.vstack([self.start[np.newaxis], self.points[:-1]])
+
+    def end(self) -> np.ndarray:
+        return self.points[-1] if len(self) else self.start
+
+    def total_duration(self) -> float:
+        return float(self.durations.sum())
+
+    def translated(self, offset) -> 'Trajectory':
+        """
+        :param offset: (x, y) added to every point [μm]
+        :rtype: Trajectory
+        """
+        return Trajectory(self.points + offset, self.durations, self.lasers, self.start + offset)
+
+    def reversed(self) -> 'Trajectory':
+        """
+        the same segments traced from the end to the start
+        :rtype: Trajectory
+        """
+        return Trajectory(self.starts()[::-1], self.durations[::-1], self.lasers[::-1], self.end())
+
+    def skip(self, n: int) -> 'Trajectory':
+        """
+        the segments after the first n, starting from the end of the n-th one
+        :rtype: Trajectory
+        """
+        start = self.points[n - 1] if 0 < n <= len(self) else self.start
+        return Trajectory(self.points[n:], self.durations[n:], self.lasers[n:], start)
+
+    def chunks(self, size: int = CHUNK_SIZE):
+        """
+        split into trajectories of at most size segments
+        :param size: number of segments in one chunk
+        :type size: int
+        :return: generator of Trajectory
+        """
+        start = self.start
+        for i in range(0, len(self), size):
+            chunk = Trajectory(self.points[i:i + size], self.durations[i:i + size], self.lasers[i:i + size], start)
+            start = chunk.end()
+            yield chunk
+
+
+def line(x: float, y: float, vel: float) -> Trajectory:
+    """
+    :param x: end point [μm]
+    :param y: end point [μm] (upward is positive)
+    :param vel: velocity [μm/s]
+    """
+    return Trajectory([[x, -y]], [max(abs(x), abs(y)) / vel], [True])  # この系のy軸は下向きが正
+
+
+def rectangle(x: float, y: float, vel: float) -> Trajectory:
+    points = [[x, 0],
+              [x, -y],  # この系のy軸は下向きが正
+              [0, -y],  # この系のy軸は下向きが正
+              [0, 0]]
+    durations = np.array([abs(x), abs(y), abs(x), abs(y)]) / vel
+    return Trajectory(points, durations, [True] * 4)
+
+
+def count_fill(x: float, y: float, d: float, direction: int) -> int:
+    """
+    :return: number of segments of the fill
+    """
+    width = abs(x) if direction == VERTICAL else abs(y)
+    return int(width // d + 1) * 2 - 1
+
+
+def iter_fill(x: float, y: float, d: float, direction: int, vel: float, chunk_size: int = CHUNK_SIZE):
+    """
+    serpentine fill of the rectangle (0, 0)-(x, y), generated chunk by chunk
+    even segments scan with the laser on, odd segments step by d with the laser off
+    :param x: size of the rectangle [μm]
+    :param y: size of the rectangle [μm] (upward is positive)
+    :param d: interval of the scan lines [μm]
+    :param direction: VERTICAL or HORIZONTAL scan lines
+    :param vel: velocity [μm/s]
+    :param chunk_size: number of segments in one chunk
+    :return: generator of Trajectory
+    """
+    n = count_fill(x, y, d, direction)
+    scan = abs(y) if direction == VERTICAL else abs(x)
+    start = np.zeros(2)
+    for a in range(0, n, chunk_size):
+        i = np.arange(a + 1, min(a + chunk_size, n) + 1)
+        on_scan_end = np.isin(i % 4, [1, 2])
+        if direction == VERTICAL:
+            points = np.column_stack([d * (i // 2), np.where(on_scan_end, -y, 0)])
+        else:
+            points = np.column_stack([np.where(on_scan_end, x, 0), -d * (i // 2)])
+        lasers = (i - 1) % 2 == 0
+        durations = np.where(lasers, scan, d) / vel
+        chunk = Trajectory(points, durations, lasers, start)
+        start = chunk.end()
+        yield chunk
+
+
+def iter_build(shape: int, x: float, y: float, vel: float, d: float, is_filled: bool, direction: int,
+               chunk_size: int = CHUNK_SIZE):
+    """
+    trajectory of the settings of CommandWindow, generated chunk by chunk
+    :return: generator of Trajectory
+    """
+    if vel <= 0 or d <= 0:
+        return
+    if is_filled:
+        yield from iter_fill(x, y, d, direction, vel, chunk_size)
+    elif shape == LINE:
+        yield line(x, y, vel)
+    elif shape == RECTANGLE:
+        yield rectangle(x, y, vel)
+
+
+@functools.lru_cache(maxsize=16)
+def build(shape: int, x: float, y: float, vel: float, d: float, is_filled: bool, direction: int) -> Trajectory:
+    """
+    whole trajectory of the settings of CommandWindow
+    the result is cached, so the same settings are not computed twice
+    :rtype: Trajectory
+    """
+    return Trajectory.concatenate(iter_build(shape, x, y, vel, d, is_filled, direction))
+
+
+def main():
+    trajectory = build(RECTANGLE, 10000, 10000, 1000, 1, True, VERTICAL)
+    print(f'{len(trajectory)} segments, {trajectory.total_duration():.1f} s, '
+          f'{trajectory.points.nbytes + trajectory.durations.nbytes + trajectory.lasers.nbytes} bytes')
+
+
+if __name__ == '__main__':
+    main()
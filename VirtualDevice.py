@@ -0,0 +1,437 @@
+# 実機なしでDS102とパルスレーザーの通信・動作を再現する
+# 送受信のタイミング(ボーレート、応答遅延)とステージの加減速・駆動範囲をモデル化している
+import re
+import math
+import time
+import threading
+import serial
+from DS102Controller import MySerial
+
+
+class _VirtualPort:
+    """
+    timing model of a serial line connected to a virtual device
+    every byte takes 10 bits (start, 8 data, stop) on the wire in both directions
+    """
+    def __init__(self, baudrate: int, eol: bytes, latency: float, handler):
+        self.byte_time = 10 / baudrate
+        self.eol = eol
+        self.latency = latency
+        self.handler = handler
+        self.cond = threading.Condition()
+        self.tx_free = 0.0  # host -> device
+        self.rx_free = 0.0  # device -> host
+        self.pending = bytearray()  # 受信途中のコマンド
+        self.replies = []  # [start time, data]
+        self.ready = bytearray()
+
+    def write(self, data: bytes, now: float):
+        with self.cond:
+            start = max(now, self.tx_free)
+            for i, c in enumerate(data):
+                self.pending.append(c)
+                if self.pending[-len(self.eol):] != self.eol:
+                    continue
+                # コマンドは最後の1バイトが届いた時点で処理される
+                arrival = start + (i + 1) * self.byte_time
+                line = bytes(self.pending[:-len(self.eol)]).decode(errors='replace')
+                self.pending.clear()
+                reply = self.handler(line, arrival)
+                if reply is not None:
+                    reply_start = max(arrival + self.latency, self.rx_free)
+                    self.replies.append([reply_start, reply.encode() + self.eol])
+                    self.rx_free = reply_start + len(reply.encode() + self.eol) * self.byte_time
+            self.tx_free = start + len(data) * self.byte_time
+            self.cond.notify_all()
+
+    def _collect(self, now: float):
+        # 時刻nowまでに届いたバイトをreadyに移す
+        while self.replies:
+            start, data = self.replies[0]
+            n = min(len(data), int((now - start) / self.byte_time))
+            if n <= 0:
+                break
+            self.ready += data[:n]
+            if n == len(data):
+                self.replies.pop(0)
+            else:
+                self.replies[0] = [start + n * self.byte_time, data[n:]]
+                break
+
+    def _next_arrival(self):
+        if not self.replies:
+            return None
+        return self.replies[0][0] + self.byte_time
+
+    def in_waiting(self) -> int:
+        with self.cond:
+            self._collect(time.monotonic())
+            return len(self.ready)
+
+    def read(self, size: int, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self._collect(now)
+                if len(self.ready) >= size or (deadline is not None and now >= deadline):
+                    data = bytes(self.ready[:size])
+                    del self.ready[:size]
+                    return data
+                wait = None if deadline is None else deadline - now
+                next_arrival = self._next_arrival()
+                if next_arrival is not None:
+                    # 残りのバイトが届く頃に起きる
+                    remaining = (size - len(self.ready)) * self.byte_time
+                    until = max(next_arrival - now, remaining, 0.0001)
+                    wait = until if wait is None else min(wait, until)
+                self.cond.wait(wait)
+
+    def reset_input(self):
+        with self.cond:
+            self.replies.clear()
+            self.ready.clear()
+
+
+class _VirtualSerialMixin:
+    """
+    replaces the I/O of serial.Serial with a _VirtualPort
+    the port is never opened, so nothing touches the OS
+    """
+    def _open_virtual(self, eol: bytes, latency: float, handler):
+        self._vport = _VirtualPort(self.baudrate, eol, latency, handler)
+        self.is_open = True
+
+    def _reconfigure_port(self, *args, **kwargs):
+        pass
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        data = bytes(data)
+        self._vport.write(data, time.monotonic())
+        return len(data)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        return self._vport.read(size, self.timeout)
+
+    @property
+    def in_waiting(self):
+        return self._vport.in_waiting()
+
+    def reset_input_buffer(self):
+        self._vport.reset_input()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class _Motion:
+    """
+    trapezoidal velocity profile along a straight line
+    the axis with the longer travel runs at vel and the other axis follows it (GOLineA)
+    """
+    def __init__(self, t0: float, start: list, target: list, vel: float, acc: float):
+        self.t0 = t0
+        self.start = list(start)
+        self.delta = [p1 - p0 for p0, p1 in zip(start, target)]
+        self.length = max(abs(d) for d in self.delta)
+        self.acc = acc
+        # 距離が短い場合は最高速度に達しない(三角形プロファイル)
+        self.vel = min(vel, math.sqrt(self.length * acc)) if self.length > 0 else 0
+        self.t_acc = self.vel / acc if acc > 0 else 0
+        d_acc = self.vel * self.t_acc / 2
+        self.t_const = (self.length - 2 * d_acc) / self.vel if self.vel > 0 else 0
+        self.duration = 2 * self.t_acc + self.t_const
+
+    def progress(self, t: float):
+        """
+        :return: travelled distance and velocity along the major axis at time t
+        """
+        t = t - self.t0
+        if t <= 0:
+            return 0, 0
+        if t >= self.duration:
+            return self.length, 0
+        if t < self.t_acc:
+            return self.acc * t ** 2 / 2, self.acc * t
+        d_acc = self.vel * self.t_acc / 2
+        if t < self.t_acc + self.t_const:
+            return d_acc + self.vel * (t - self.t_acc), self.vel
+        t_dec = self.duration - t
+        return self.length - self.acc * t_dec ** 2 / 2, self.acc * t_dec
+
+    def position(self, t: float):
+        if self.length == 0:
+            return list(self.start)
+        s, _ = self.progress(t)
+        return [p0 + d * s / self.length for p0, d in zip(self.start, self.delta)]
+
+    def is_done(self, t: float) -> bool:
+        return t - self.t0 >= self.duration
+
+
+class _Deceleration(_Motion):
+    """
+    deceleration from vel to 0 (STOP Reduction)
+    """
+    def __init__(self, t0: float, start: list, target: list, vel: float, acc: float):
+        self.t0 = t0
+        self.start = list(start)
+        self.delta = [p1 - p0 for p0, p1 in zip(start, target)]
+        self.length = max(abs(d) for d in self.delta)
+        self.acc = acc
+        self.vel = vel
+        self.duration = vel / acc
+
+    @classmethod
+    def from_motion(cls, motion: _Motion, t: float):
+        s, v = motion.progress(t)
+        if v == 0 or motion.length == 0:
+            return None
+        stop = v ** 2 / (2 * motion.acc)
+        start = motion.position(t)
+        target = [p + d * stop / motion.length for p, d in zip(start, motion.delta)]
+        return cls(t, start, target, v, motion.acc)
+
+    def progress(self, t: float):
+        t = min(max(t - self.t0, 0), self.duration)
+        return self.vel * t - self.acc * t ** 2 / 2, self.vel - self.acc * t
+
+
+class VirtualDS102Device:
+    """
+    state machine of the DS102 stage controller (2 axes)
+    positions are kept in μm internally and exchanged in mm like the real device
+    """
+    axes = {'1': 0, '2': 1}
+
+    def __init__(self, acceleration: float = 100000, limit: float = 7.35, speed: int = 1000):
+        """
+        :param acceleration: acceleration of both axes [μm/s^2]
+        :param limit: travel range from the mechanical center [mm]
+        :param speed: initial Fspeed of every speed table [μm/s]
+        :type acceleration: float
+        :type limit: float
+        :type speed: int
+        """
+        self.acceleration = acceleration
+        self.limit = limit * 1000
+        self.speed_table = [[speed] * 10 for _ in self.axes]
+        self.selected = [0 for _ in self.axes]
+        self.offset = [0.0 for _ in self.axes]  # 論理座標 = 機械座標 - offset
+        self.rest = [0.0 for _ in self.axes]  # 停止中の機械座標
+        self.motions = [None for _ in self.axes]  # 軸ごとの動作、GOLineAは両軸で同じものを共有する
+        self.log = []  # (time, command)
+
+    def _speed(self, i: int) -> float:
+        return self.speed_table[i][self.selected[i]]
+
+    def _position(self, i: int, t: float) -> float:
+        motion = self.motions[i]
+        if motion is None:
+            return self.rest[i]
+        pos = motion.position(t)
+        return pos[0] if len(pos) == 1 else pos[i]
+
+    def _settle(self, t: float):
+        # 終わった動作を片付ける
+        for i, motion in enumerate(self.motions):
+            if motion is not None and motion.is_done(t):
+                self.rest[i] = self._position(i, t)
+                self.motions[i] = None
+
+    def _clip(self, pos: float) -> float:
+        return min(max(pos, -self.limit), self.limit)
+
+    def _stop(self, i: int, t: float, emergency: bool = True):
+        # GOLineA中は補間動作ごと止まる
+        motion = self.motions[i]
+        if motion is None:
+            return
+        shared = [j for j, m in enumerate(self.motions) if m is motion]
+        pos = motion.position(t)
+        if emergency or isinstance(motion, _Deceleration):
+            stopped = None
+        else:
+            stopped = _Deceleration.from_motion(motion, t)
+        for j in shared:
+            self.rest[j] = pos[0] if len(pos) == 1 else pos[j]
+            self.motions[j] = stopped
+
+    def _move_axis(self, i: int, target: float, t: float, vel: float):
+        self._stop(i, t)
+        start = self.rest[i]
+        self.motions[i] = _Motion(t, [start], [self._clip(target)], vel, self.acceleration)
+
+    def is_busy(self, i: int, t: float) -> bool:
+        self._settle(t)
+        return self.motions[i] is not None
+
+    def limit_state(self, i: int, t: float) -> int:
+        """
+        :return: 0: not on the limit, 1: CW limit, 2: CCW limit
+        """
+        pos = self._position(i, t)
+        if pos >= self.limit - 0.001:
+            return 1
+        if pos <= -self.limit + 0.001:
+            return 2
+        return 0
+
+    def handle(self, line: str, t: float):
+        """
+        process one command received at time t
+        :return: reply string or None
+        """
+        self.log.append((t, line))
+        self._settle(t)
+        line = line.strip()
+        if line.startswith('STOP'):
+            for i in self.axes.values():
+                self._stop(i, t, emergency='Reduction' not in line)
+            return None
+        m = re.fullmatch(r'GOLineA X(\S+) Y(\S+)', line)
+        if m:
+            try:
+                target = [float(m.group(1)) * 1000, float(m.group(2)) * 1000]
+            except ValueError:
+                return None
+            for i in self.axes.values():
+                self._stop(i, t)
+            start = [self.rest[i] for i in self.axes.values()]
+            target = [self._clip(p + off) for p, off in zip(target, self.offset)]
+            # 移動量の大きい軸の速度で補間する
+            major = 0 if abs(target[0] - start[0]) >= abs(target[1] - start[1]) else 1
+            motion = _Motion(t, start, target, self._speed(major), self.acceleration)
+            self.motions = [motion, motion]
+            return None
+        m = re.fullmatch(r'AXIs([12]):(\S+)\s*(.*)', line)
+        if not m:
+            return None
+        i, command, arg = self.axes[m.group(1)], m.group(2), m.group(3).strip()
+        if command == 'POSition?':
+            return f'{(self._position(i, t) - self.offset[i]) / 1000:.3f}'
+        if command == 'LIMIT?':
+            return str(self.limit_state(i, t))
+        if command == 'READY?':
+            return '0' if self.is_busy(i, t) else '1'
+        if command == 'MOTION?':
+            return '1' if self.is_busy(i, t) else '0'
+        if command == 'SELectSPeed?':
+            return str(self.selected[i])
+        try:
+            if command == 'SELectSPeed':
+                self.selected[i] = int(arg)
+            elif re.fullmatch(r'Fspeed\d', command):
+                self.speed_table[i][int(command[-1])] = int(float(arg))
+            elif command == 'GO':
+                direction = 1 if arg == '5' else -1
+                self._move_axis(i, direction * self.limit, t, self._speed(i))
+            elif command == 'GOABS':
+                self._move_axis(i, float(arg) * 1000 + self.offset[i], t, self._speed(i))
+            elif command == 'POS':
+                self.offset[i] = self._position(i, t) - float(arg) * 1000
+            elif command == 'STOP':
+                self._stop(i, t, emergency=arg != 'Reduction')
+        except ValueError:
+            pass
+        return None
+
+
+class VirtualDS102(_VirtualSerialMixin, MySerial):
+    """
+    MySerial connected to a VirtualDS102Device instead of a real port
+    """
+    def __init__(self, baudrate: int = 38400, latency: float = 0.002, device: VirtualDS102Device = None, **args):
+        """
+        :param baudrate: baud rate of the virtual line
+        :param latency: time from the end of a query to the start of its reply [s]
+        :param device: simulated controller. a new one is created if None
+        :type baudrate: int
+        :type latency: float
+        :type device: VirtualDS102Device
+        """
+        super().__init__(None, baudrate, **args)
+        self.device = device if device is not None else VirtualDS102Device()
+        self._open_virtual(self.eol, latency, self.device.handle)
+
+
+class VirtualPulseLaserDevice:
+    """
+    state of the pulse laser (Arduino)
+    it accepts '<frq>\\n' and answers the same line after booting
+    """
+    def __init__(self, boot_time: float = 1.0):
+        """
+        :param boot_time: time after opening the port during which input is ignored [s]
+        :type boot_time: float
+        """
+        self.ready_at = time.monotonic() + boot_time
+        self.frq = 0
+        self.history = []  # (time, frq)
+
+    def handle(self, line: str, t: float):
+        if t < self.ready_at:
+            return None
+        try:
+            frq = int(line.strip())
+        except ValueError:
+            return None
+        if frq == -1:
+            self.frq = 0
+        elif 16 <= frq <= 10000:
+            self.frq = frq
+        else:
+            return None
+        self.history.append((t, self.frq))
+        return str(frq)
+
+
+class VirtualPulseLaser(_VirtualSerialMixin, serial.Serial):
+    """
+    serial.Serial connected to a VirtualPulseLaserDevice
+    """
+    def __init__(self, baudrate: int = 9600, latency: float = 0.001, device: VirtualPulseLaserDevice = None, **args):
+        super().__init__(None, baudrate, **args)
+        self.device = device if device is not None else VirtualPulseLaserDevice()
+        self._open_virtual(b'\n', latency, self.device.handle)
+
+
+def open_virtual_ports(cl):
+    """
+    create virtual stage and laser ports from the SIMULATION section of config.json
+    :param cl: loaded config
+    :type cl: ConfigLoader
+    :rtype: (VirtualDS102, VirtualPulseLaser)
+    :return: port of the stage, port of the laser
+    """
+    sim = cl.simulation
+    stage = VirtualDS102(cl.baudrate_stage, sim.get('latency', 0.002),
+                         VirtualDS102Device(sim.get('acceleration', 100000), sim.get('limit', 7.35)),
+                         write_timeout=0)
+    laser = VirtualPulseLaser(cl.baudrate_laser, sim.get('latency', 0.002),
+                              VirtualPulseLaserDevice(sim.get('boot', 1.0)),
+                              write_timeout=0)
+    return stage, laser
+
+
+def main():
+    ser = VirtualDS102(timeout=1)
+    for msg in ['AXIs1:READY?', 'AXIs1:Fspeed0 10000', 'AXIs1:GO 5', 'AXIs1:POSition?']:
+        t = time.perf_counter()
+        ser.send(msg)
+        if msg.endswith('?'):
+            print(msg, ser.recv(), f'{(time.perf_counter() - t) * 1000:.2f} ms')
+    time.sleep(0.5)
+    ser.send('AXIs1:POSition?')
+    print('after 0.5 s:', ser.recv(), 'mm')
+
+
+if __name__ == '__main__':
+    main()
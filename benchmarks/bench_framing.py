@@ -0,0 +1,80 @@
+# MySerial.recvのフレーミング処理のベンチマーク
+# python -m benchmarks.bench_framing
+import time
+from DS102Controller import MySerial
+from VirtualDevice import VirtualDS102
+
+
+class MemorySerial(MySerial):
+    """
+    MySerial reading from a prefilled memory buffer
+    only the framing cost is measured (no wire time)
+    in_waiting reports one reply at a time as if each had just arrived
+    """
+    def __init__(self, data: bytes):
+        super().__init__(None, 38400)
+        self.data = bytearray(data)
+        self.reads = 0
+
+    def read(self, size=1):
+        self.reads += 1
+        chunk = bytes(self.data[:size])
+        del self.data[:size]
+        return chunk
+
+    @property
+    def in_waiting(self):
+        return self.data.find(self.eol) + self.leneol
+
+
+def recv_legacy(ser: MySerial):
+    # 以前のMySerial.recv (1バイトずつ読む)
+    line = bytearray()
+    while True:
+        c = ser.read(1)
+        if c:
+            line += c
+            if line[-ser.leneol:] == ser.eol:
+                break
+        else:
+            break
+    return bytes(line).decode().strip('\r')
+
+
+def bench_memory(n: int = 20000):
+    results = {}
+    data = b''.join(f'{i * 0.001:.3f}'.encode() + MySerial.eol for i in range(n))
+    for name, recv in [('legacy', recv_legacy), ('buffered', MySerial.recv)]:
+        ser = MemorySerial(data)
+        t = time.perf_counter()
+        for _ in range(n):
+            recv(ser)
+        elapsed = time.perf_counter() - t
+        results[name] = {'us_per_reply': elapsed / n * 1e6, 'reads_per_reply': ser.reads / n}
+    return results
+
+
+def bench_virtual(n: int = 50):
+    # 仮想DS102 (38400 baud) 相手に往復時間とCPU時間を測る
+    results = {}
+    for name, recv in [('legacy', recv_legacy), ('buffered', MySerial.recv)]:
+        ser = VirtualDS102(38400, latency=0.002, timeout=1)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        for _ in range(n):
+            ser.send('AXIs1:POSition?')
+            recv(ser)
+        results[name] = {'ms_per_round_trip': (time.perf_counter() - wall) / n * 1e3,
+                         'cpu_ms_per_round_trip': (time.process_time() - cpu) / n * 1e3}
+    return results
+
+
+def main():
+    for title, results in [('memory', bench_memory()), ('virtual DS102', bench_virtual())]:
+        print(title)
+        for name, values in results.items():
+            print(f'  {name:10s}', ', '.join(f'{k}: {v:.3f}' for k, v in values.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+# 線分ごとの待ち方による塗りつぶしジョブの実行時間の比較 (仮想DS102)
+# python -m benchmarks.bench_motion
+import asyncio
+from DS102Controller import AsyncDS102Controller
+from SerialTransport import SerialTransport
+from VirtualDevice import VirtualDS102
+from JobExecutor import JobExecutor, WAIT_READY, WAIT_SLEEP
+from Trajectory import RECTANGLE, VERTICAL, iter_build
+
+
+async def run(wait_mode: str, settings: tuple):
+    transport = SerialTransport(VirtualDS102())
+    await transport.start()
+    stage = AsyncDS102Controller(transport)
+    executor = JobExecutor(stage, wait_mode=wait_mode)
+    report = await executor.run(iter_build(*settings), vel=settings[3])
+    await transport.close()
+    return report
+
+
+def main():
+    # 200 μm角を20 μm毎に縦に塗りつぶす (21本)
+    settings = (RECTANGLE, 200, 200, 1000, 20, True, VERTICAL)
+    for wait_mode in [WAIT_SLEEP, WAIT_READY]:
+        report = asyncio.run(run(wait_mode, settings))
+        print(f'{wait_mode:6s} {report.segments} segments, {report.elapsed:.2f} s '
+              f'(predicted {report.predicted:.2f} s), {report.throughput():.2f} segments/s')
+
+
+if __name__ == '__main__':
+    main()
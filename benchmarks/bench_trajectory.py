@@ -0,0 +1,73 @@
+# CommandWindow.get_pointsの軌跡生成のベンチマーク
+# python -m benchmarks.bench_trajectory
+import time
+import tracemalloc
+from Trajectory import RECTANGLE, VERTICAL, build, iter_build
+
+
+def get_points_legacy(shape, x, y, vel, d, is_filled, direction):
+    # 以前のCommandWindow.get_points (リスト内包表記)
+    if shape == 0:  # Line
+        points = [[x, -y]]
+        delays = [max(abs(x), abs(y)) / vel]
+    elif shape == 1:  # Rectangle
+        points = [[x, 0], [x, -y], [0, -y], [0, 0]]
+        delays = [abs(x) / vel, abs(y) / vel, abs(x) / vel, abs(y) / vel]
+    else:
+        return
+    if is_filled:
+        if direction == 0:  # 縦
+            n = (abs(x) // d + 1) * 2
+            points = [[d * (i // 2), -y * (1 if i % 4 in [1, 2] else 0)] for i in range(1, n)]
+        elif direction == 1:  # 横
+            n = (abs(y) // d + 1) * 2
+            points = [[x * (1 if i % 4 in [1, 2] else 0), -d * (i // 2)] for i in range(1, n)]
+        lasers = [False if i % 2 else True for i in range(n - 1)]
+        delays = [d / vel if i % 2 else abs(y) / vel for i in range(n - 1)]
+    else:
+        lasers = [True] * len(points)
+    return points, delays, lasers
+
+
+def measure(func, repeat: int):
+    tracemalloc.start()
+    t = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - t) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench(size: int, d: int, repeat: int = 3):
+    settings = (RECTANGLE, size, size, 1000, d, True, VERTICAL)
+    results = {}
+    _, results['legacy'], legacy_peak = measure(lambda: get_points_legacy(*settings), repeat)
+    # キャッシュの効果を除くため毎回作り直す
+    _, results['vectorized'], peak = measure(lambda: (build.cache_clear(), build(*settings))[1], repeat)
+    _, results['streaming'], stream_peak = measure(
+        lambda: sum(len(chunk) for chunk in iter_build(*settings, chunk_size=4096)), repeat)
+    _, results['cached'], _ = measure(lambda: build(*settings), repeat)
+    return results, {'legacy': legacy_peak, 'vectorized': peak, 'streaming': stream_peak}
+
+
+def main():
+    for size, d in [(100, 5), (1000, 1), (10000, 1), (10000, 0.1)]:
+        if d < 1:
+            # 旧実装はrangeに浮動小数点を渡せないので比較できない
+            settings = (RECTANGLE, size, size, 1000, d, True, VERTICAL)
+            t = time.perf_counter()
+            n = sum(len(chunk) for chunk in iter_build(*settings))
+            print(f'{size} um / {d} um: {n} segments, streaming {(time.perf_counter() - t) * 1e3:.1f} ms')
+            continue
+        times, peaks = bench(size, d)
+        n = int(size // d + 1) * 2 - 1
+        print(f'{size} um / {d} um: {n} segments')
+        for name, elapsed in times.items():
+            memory = f', peak {peaks[name] / 1024:.0f} KiB' if name in peaks else ''
+            print(f'  {name:10s} {elapsed * 1e3:9.3f} ms{memory}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# 実機なしで (Linux) 動くベンチマークをまとめて実行し、結果をjsonに保存する
+# python -m benchmarks.suite --output results.json
+# python -m benchmarks.suite --compare old.json new.json
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import threading
+import subprocess
+import numpy as np
+from DS102Controller import MySerial, DS102Controller, AsyncDS102Controller, axis2msg, STATUS_QUERIES
+from PulseLaserController import AsyncPulseLaserController, LaserPort
+from SerialTransport import SerialTransport
+from VirtualDevice import VirtualDS102, VirtualPulseLaser
+from JobExecutor import JobExecutor
+from Trajectory import RECTANGLE, VERTICAL, build, iter_build
+
+
+# スクリプトで返答する偽のDS102の返答
+SCRIPT = {'READY?': '1', 'SELectSPeed?': '0', 'POSition?': '1.234', 'LIMIT?': '0'}
+
+
+class PtyDevice:
+    """
+    fake device on the master side of a pseudo terminal
+    MySerial opens the slave side (port) like a real serial port
+    every line is answered by script[command without the axis] if it is in the script
+    """
+    def __init__(self, script: dict = None, eol: bytes = b'\r'):
+        self.script = SCRIPT if script is None else script
+        self.eol = eol
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+        self.closed = False
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        buffer = b''
+        while not self.closed:
+            try:
+                buffer += os.read(self.master, 4096)
+            except OSError:
+                return
+            *lines, buffer = buffer.split(self.eol)
+            replies = []
+            for line in lines:
+                reply = self.script.get(line.decode().split(':', 1)[-1])
+                if reply is not None:
+                    replies.append(reply.encode() + self.eol)
+            if replies:
+                os.write(self.master, b''.join(replies))
+
+    def write(self, data: bytes):
+        os.write(self.master, data)
+
+    def close(self):
+        self.closed = True
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def per_call(func, n: int) -> float:
+    """
+    :return: time per call [μs]
+    """
+    t = time.perf_counter()
+    for _ in range(n):
+        func()
+    return (time.perf_counter() - t) / n * 1e6
+
+
+def latency(func, n: int) -> dict:
+    """
+    :return: mean, p50 and p95 of func [ms]
+    """
+    times = []
+    for _ in range(n):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    times = np.array(times) * 1e3
+    return {'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+            'p95_ms': float(np.percentile(times, 95))}
+
+
+def bench_encoding(n: int) -> dict:
+    msgs = [axis2msg(axis) + query for query in STATUS_QUERIES for axis in ['x', 'y']]
+    return {
+        'axis2msg_us': per_call(lambda: axis2msg('y'), n),
+        'encode_us': per_call(lambda: 'AXIs1:GO CW'.encode() + MySerial.eol, n),
+        'encode_status_batch_us': per_call(lambda: b''.join(msg.encode() + MySerial.eol for msg in msgs), n),
+    }
+
+
+def bench_framing(n: int) -> dict:
+    device = PtyDevice()
+    ser = MySerial(device.port, 38400)
+    try:
+        # 返答をまとめて書き込み、1つずつ取り出す速さ
+        device.write(b''.join(f'{i * 0.001:.3f}'.encode() + MySerial.eol for i in range(n)))
+        t = time.perf_counter()
+        for _ in range(n):
+            ser.recv_frame(1.0)
+        result = {'recv_frame_us': (time.perf_counter() - t) / n * 1e6}
+
+        def round_trip():
+            ser.send('AXIs1:POSition?')
+            ser.recv()
+        result['round_trip'] = latency(round_trip, n // 10)
+    finally:
+        ser.close()
+        device.close()
+    return result
+
+
+def bench_controller(n: int) -> dict:
+    device = PtyDevice()
+    ser = MySerial(device.port, 38400)
+    stage = DS102Controller(ser)
+    try:
+        result = {'get_position': latency(stage.get_position, n),
+                  'check_limit_all': latency(stage.check_limit_all, n),
+                  'get_status': latency(stage.get_status, n)}
+    finally:
+        stage.close()
+        ser.close()
+        device.close()
+    return result
+
+
+def bench_trajectory(sizes: list) -> dict:
+    result = {}
+    for size, d in sizes:
+        settings = (RECTANGLE, size, size, 1000, d, True, VERTICAL)
+        build.cache_clear()
+        t = time.perf_counter()
+        n = len(build(*settings))
+        elapsed = time.perf_counter() - t
+        t = time.perf_counter()
+        sum(len(chunk) for chunk in iter_build(*settings))
+        result[f'{size}um_{d}um'] = {'segments': n, 'build_ms': elapsed * 1e3,
+                                     'streaming_ms': (time.perf_counter() - t) * 1e3}
+    build.cache_clear()
+    return result
+
+
+async def run_job(settings: tuple) -> dict:
+    # CommandWindow.move_shapeと同じ流れ (仮想デバイス)
+    transport_stage = SerialTransport(VirtualDS102(), name='stage')
+    transport_laser = SerialTransport(LaserPort(VirtualPulseLaser()), read_replies=False, name='laser')
+    await transport_stage.start()
+    await transport_laser.start()
+    stage = AsyncDS102Controller(transport_stage)
+    laser = AsyncPulseLaserController(transport_laser)
+    try:
+        executor = JobExecutor(stage, laser, 100)
+        report = await executor.run(iter_build(*settings), vel=settings[3])
+    finally:
+        await transport_stage.close()
+        await transport_laser.close()
+    result = report.as_dict()
+    result['stage'] = {k: v for k, v in transport_stage.stats.as_dict().items()
+                       if k in ['bytes_sent', 'bytes_received', 'messages_sent', 'timeouts']}
+    return result
+
+
+def bench_job(settings: tuple) -> dict:
+    return asyncio.run(run_job(settings))
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.strip(), bool(dirty.strip())
+
+
+def run(quick: bool = False) -> dict:
+    """
+    :param quick: fewer repetitions and smaller jobs
+    :rtype: dict
+    :return: results with the environment
+    """
+    n = 1000 if quick else 20000
+    sizes = [(100, 5), (1000, 1), (10000, 1)] + ([] if quick else [(10000, 0.1)])
+    job = (RECTANGLE, 100, 100, 1000, 20, True, VERTICAL) if quick else (RECTANGLE, 200, 200, 1000, 20, True, VERTICAL)
+    commit, dirty = git_commit()
+    results = {}
+    for name, func in [('encoding', lambda: bench_encoding(n)),
+                       ('framing', lambda: bench_framing(n // 10)),
+                       ('controller', lambda: bench_controller(n // 100)),
+                       ('trajectory', lambda: bench_trajectory(sizes)),
+                       ('job', lambda: bench_job(job))]:
+        print(f'{name}...', file=sys.stderr)
+        results[name] = func()
+    return {'commit': commit, 'dirty': dirty, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'platform': platform.platform(), 'quick': quick,
+            'results': results}
+
+
+def flatten(d: dict, prefix: str = '') -> dict:
+    items = {}
+    for key, value in d.items():
+        if isinstance(value, dict):
+            items.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[prefix + key] = value
+    return items
+
+
+def compare(old: dict, new: dict):
+    """
+    print the values of two result files side by side
+    """
+    print(f'old: {old["commit"]}  new: {new["commit"]}')
+    a, b = flatten(old['results']), flatten(new['results'])
+    for key in sorted(a.keys() & b.keys()):
+        ratio = b[key] / a[key] if a[key] else float('nan')
+        print(f'{key:45s} {a[key]:12.4g} {b[key]:12.4g} {ratio:7.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmarks without hardware.')
+    parser.add_argument('--output', help='write the results (json) to this file')
+    parser.add_argument('--quick', action='store_true', help='fewer repetitions')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        results = []
+        for filename in args.compare:
+            with open(filename, 'r') as f:
+                results.append(json.load(f))
+        compare(*results)
+        return
+
+    report = run(args.quick)
+    for key, value in flatten(report['results']).items():
+        print(f'{key:45s} {value:12.4g}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,28 @@
 import os
 import sys
-import time
 import copy
-import threading
+import time
+import asyncio
+import concurrent.futures
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
-import serial
-from ds102controller import MySerial, DS102Controller
+from tkinter import filedialog
+from DS102Controller import DS102Controller
 from PulseLaserController import PulseLaserController
+from PulsePitch import PulsePitch
+from Journal import load_journal
 from CustomTkObject import MovableOval
+from Jog import RateLimiter, AnalogJog, budget_rate
 from ConfigLoader import ConfigLoader
 from CommandWindow import CommandWindow
+from StatsWindow import StatsWindow
+from JobRunner import open_ports, initialize
+from SerialTransport import LoopThread
+from Telemetry import Telemetry
+from PollScheduler import PollScheduler
+from Instrumentation import dump_periodically
+from ControlServer import ControlServer
 
 
 WIDTH_BUTTON = 7
@@ -33,6 +44,7 @@ class Application(tk.Frame):
     def __init__(self, master=None, config='./config.json'):
         super().__init__(master)
         self.master.title('Stage Controller')
+        self.t_start = time.perf_counter()  # 起動から最初の命令を受け付けるまでの時間を測る
 
         # フォントサイズの調整
         self.style = ttk.Style()
@@ -43,29 +55,87 @@ class Application(tk.Frame):
 
         self.cl = ConfigLoader(config)
 
+        # シリアル通信と位置の監視などはすべてこのイベントループ上で動かす
+        self.io = LoopThread()
+
+        self.msg_connection = tk.StringVar(value='')
+        self.connecting = None
+        self.connected = False
         self.open_port()
 
+        # 位置の履歴 (update_positionで追加する)
+        self.telemetry = Telemetry()
+        # 実行中のジョブのタスク (CommandWindow.move_shapeが設定する)
+        self.job = None
+        # 位置の問い合わせ間隔 (動いている間だけ速くする)
+        self.poller = PollScheduler(self.cl.poll_min_rate, self.cl.poll_max_rate, self.cl.baudrate_stage,
+                                    self.cl.poll_budget)
+
         self.create_widgets()
 
+        # 最後にステージへ送ったジョイスティックの状態
         self.rank_pre = 0
-        self.direction_pre = [0, 0]
+        self.direction_pre = [0, 0, 0]
 
         self.is_limit = [False, False]
-
-        self.create_thread_pos()
-
-        self.update()
+        self.is_ready = [True, True]
+
+        self.create_task_pos()
+        self.check_connection()
+        if self.cl.stats_file and self.stage is not None:
+            # 通信の統計を定期的にファイルへ書き出す
+            self.io.submit(dump_periodically([self.stage.transport.stats, self.laser.transport.stats],
+                                             self.cl.stats_file, self.cl.stats_interval))
+        self.server = None
+        if self.cl.server_enabled and self.stage is not None:
+            # スクリプトからの操作を受け付ける (GUIと同じコントローラーを使う)
+            self.server = ControlServer(self.stage.aio, self.laser.aio)
+            if self.cl.server_unix:
+                self.io.submit(self.server.start_unix(self.cl.server_unix))
+            else:
+                self.io.submit(self.server.start_tcp(self.cl.server_host, self.cl.server_port))
 
     def open_port(self):
-        if self.cl.mode == 'RELEASE':
-            self.ser_stage = MySerial(self.cl.port_stage, self.cl.baudrate_stage, write_timeout=0)
-            self.stage = DS102Controller(self.ser_stage)
-            self.ser_laser = serial.Serial(self.cl.port_laser, self.cl.baudrate_laser, write_timeout=0)
-            self.laser = PulseLaserController(self.ser_laser)
-        elif self.cl.mode == 'DEBUG':
+        if self.cl.mode == 'DEBUG':
             self.stage = self.laser = None
-        else:
-            raise ValueError('Wrong format in config.json. Mode must be DEBUG or RELEASE.')
+            return
+        if self.cl.mode not in ['RELEASE', 'SIMULATION']:
+            raise ValueError('Wrong format in config.json. Mode must be DEBUG, RELEASE or SIMULATION.')
+        # ステージとレーザーのポートを同時に開く (SIMULATIONでは実機の代わりに仮想デバイスと通信する)
+        self.ser_stage, self.ser_laser = open_ports(self.cl)
+        self.stage = DS102Controller(self.ser_stage, self.io, initialize=False)
+        self.laser = PulseLaserController(self.ser_laser, self.io, timeout=None)
+        # ステージの初期化とレーザーの起動待ちは同時に行う。lazyなら画面を先に出して裏で待つ
+        # (レーザーへの命令は起動を確認するまで送られずに待つ)
+        self.connecting = self.io.submit(self.connect())
+        if not self.cl.startup_lazy:
+            self.connecting.result()
+
+    async def connect(self) -> str:
+        # 失敗しても例外は投げず、画面に出すメッセージを返す
+        try:
+            init = await initialize(self.stage.aio, self.laser.aio, self.cl.startup_laser_timeout)
+        except Exception as e:
+            msg = f'Connection failed: {type(e).__name__}: {e}'
+            print(msg)
+            return msg
+        self.connected = True
+        msg = (f'Ready in {time.perf_counter() - self.t_start:.2f} s '
+               f'(stage {init["stage"]:.2f} s, laser {init["laser"]:.2f} s)')
+        if not init['laser_ready']:
+            msg += ' / laser not answering'
+        print(msg)
+        return msg
+
+    def check_connection(self):
+        # tkinterの変数はメインスレッドから書き換える
+        if self.connecting is None:
+            return
+        if not self.connecting.done():
+            self.msg_connection.set('Connecting...')
+            self.master.after(100, self.check_connection)
+            return
+        self.msg_connection.set(self.connecting.result())
 
     def create_widgets(self):
         # 親フレーム
@@ -77,6 +147,8 @@ class Application(tk.Frame):
         frame_laser.grid(row=1, column=0, pady=10)
         button_quit.grid(row=2, columnspan=2, pady=10)
         label_quit.grid(row=3, columnspan=2)
+        label_connection = ttk.Label(self.master, textvariable=self.msg_connection)
+        label_connection.grid(row=4, columnspan=2)
         # 子フレーム
         frame_controller_canvas = ttk.Frame(frame_stage)
         frame_controller_buttons = ttk.Frame(frame_stage)
@@ -97,7 +169,14 @@ class Application(tk.Frame):
             canvas_controller.create_oval(center - r, center - r, center + r, center + r, fill=color)
         MovableOval.canvas = canvas_controller
         MovableOval.thres_list = r_list
-        self.oval = MovableOval(center - SIZE_CONT, center - SIZE_CONT, center + SIZE_CONT, center + SIZE_CONT, fill='lightblue')
+        self.jog_limiter = RateLimiter(self.master, self.apply_joystick, self.cl.jog_max_rate)
+        # アナログモード: 更新の頻度は通信量の上限でも抑える
+        self.analog = AnalogJog(self.cl.jog_max_velocity, r_list[0] * 0.95, r_list[-1], self.cl.jog_curve,
+                                self.cl.jog_hysteresis)
+        analog_rate = min(self.cl.jog_max_rate, budget_rate(self.cl.baudrate_stage, self.cl.jog_budget))
+        self.analog_limiter = RateLimiter(self.master, self.apply_analog, analog_rate)
+        self.oval = MovableOval(center - SIZE_CONT, center - SIZE_CONT, center + SIZE_CONT, center + SIZE_CONT,
+                                on_drag=self.on_joystick, on_release=self.on_joystick_release, fill='lightblue')
         canvas_controller.pack()
         # ウィジェット buttons
         self.vel = tk.IntVar(value=100)
@@ -119,6 +198,9 @@ class Application(tk.Frame):
         combobox_xy.grid(row=1, column=1)
         button_right.grid(row=1, column=2)
         button_bottom.grid(row=2, column=1)
+        self.is_analog = tk.BooleanVar(value=self.cl.jog_analog)
+        check_analog = tk.Checkbutton(frame_controller_buttons, text='Analog', variable=self.is_analog)
+        check_analog.grid(row=3, column=0, columnspan=3)
         # ウィジェット position
         self.x_cur = tk.IntVar(value=0)
         self.y_cur = tk.IntVar(value=0)
@@ -127,11 +209,14 @@ class Application(tk.Frame):
         label_x_cur = ttk.Label(frame_controller_position, textvariable=self.x_cur)
         label_y_cur = ttk.Label(frame_controller_position, textvariable=self.y_cur)
         button_set_origin = ttk.Button(frame_controller_position, text='SET ORG', command=self.set_origin)
+        self.poll_rate = tk.StringVar(value='Poll: - Hz')
+        label_poll_rate = ttk.Label(frame_controller_position, textvariable=self.poll_rate)
         label_x.grid(row=0, column=0)
         label_x_cur.grid(row=0, column=1)
         label_y.grid(row=1, column=0)
         label_y_cur.grid(row=1, column=1)
         button_set_origin.grid(row=0, column=2, rowspan=2)
+        label_poll_rate.grid(row=2, column=0, columnspan=3)
 
         # laser
         self.frq = tk.IntVar(value=100)
@@ -143,12 +228,21 @@ class Application(tk.Frame):
         label_msg_frq = ttk.Label(frame_laser, textvariable=self.msg_laser)
         self.is_auto_emission = tk.BooleanVar(value=False)
         check_auto_emission = tk.Checkbutton(frame_laser, text="Auto Emission", command=self.change_auto_emission, variable=self.is_auto_emission)
+        # パルスの間隔を一定にする (周波数は速度から決める)
+        self.is_constant_pitch = tk.BooleanVar(value=False)
+        check_constant_pitch = tk.Checkbutton(frame_laser, text='Pitch', variable=self.is_constant_pitch)
+        self.pulse_pitch = tk.DoubleVar(value=1.0)
+        entry_pitch = ttk.Entry(frame_laser, textvariable=self.pulse_pitch, width=5, justify=tk.CENTER)
+        label_um = ttk.Label(frame_laser, text='\u03bcm')
         entry_frq.grid(row=0, column=0)
         label_hz.grid(row=0, column=1)
         self.button_emit_laser.grid(row=0, column=2)
         self.button_stop_laser.grid(row=0, column=3)
         label_msg_frq.grid(row=1, column=0, columnspan=4)
         check_auto_emission.grid(row=2, column=0, columnspan=4)
+        check_constant_pitch.grid(row=3, column=0, columnspan=2)
+        entry_pitch.grid(row=3, column=2)
+        label_um.grid(row=3, column=3, sticky='W')
 
         # menu bar
         menu_bar = tk.Menu(self.master, tearoff=False)
@@ -161,63 +255,149 @@ class Application(tk.Frame):
         menu_tool = tk.Menu(menu_bar, tearoff=False)
         menu_bar.add_cascade(label='Tool', menu=menu_tool)
         menu_tool.add_command(label='Command Mode', command=self.open_command_window)
-        menu_tool.add_command(label='Reset Origin', command=self.create_thread_reset)
+        menu_tool.add_command(label='Resume Job', command=self.resume_job)
+        menu_tool.add_command(label='Reset Origin', command=self.create_task_reset)
+        menu_tool.add_command(label='Start Recording', command=self.start_recording)
+        menu_tool.add_command(label='Stop Recording', command=self.stop_recording)
+        menu_tool.add_command(label='Statistics', command=self.open_stats_window)
 
         menu_help = tk.Menu(menu_bar, tearoff=False)
         menu_bar.add_cascade(label='Help', menu=menu_help)
         menu_help.add_command(label='Manual', command=lambda: print('IMPLEMENT ME'))
 
-    def create_thread_pos(self):
-        # update_positionの受信待ちで画面がフリーズしないようthreadを立てる
-        thread_pos = threading.Thread(target=self.update_position)
-        thread_pos.daemon = True
-        thread_pos.start()
+    def create_task_pos(self):
+        # update_positionの受信待ちで画面がフリーズしないようI/Oのイベントループ上で動かす
+        self.io.submit(self.keep_polling())
+
+    async def keep_polling(self):
+        # ステージの初期化が終わってから問い合わせる (接続に失敗したら問い合わせない)
+        if self.connecting is not None:
+            await asyncio.wrap_future(self.connecting)
+            if not self.connected:
+                return
+        # 通信エラーなどで位置の更新が止まったら、少し待ってからやり直す
+        while True:
+            try:
+                await self.update_position()
+            except Exception as e:
+                print(f'Position polling failed: {type(e).__name__}: {e}. Retrying in 1 s.')
+                await asyncio.sleep(1)
 
-    def create_thread_reset(self):
+    def create_task_reset(self):
         if messagebox.askyesno('確認', '機械原点を(0, 0)にしますか？'):
-            thread_reset = threading.Thread(target=self.reset_origin)
-            thread_reset.daemon = True
-            thread_reset.start()
+            self.io.submit(self.reset_origin())
 
     def quit(self):
-        if self.cl.mode == 'RELEASE':
+        if self.server is not None:
+            # 終了中にスクリプトから動かされないよう、先に受け付けをやめる
+            try:
+                self.io.run(self.server.close(), timeout=2)
+            except concurrent.futures.TimeoutError:
+                print('The control server did not close in time.')
+        if self.cl.mode in ['RELEASE', 'SIMULATION']:
+            # 実行中のジョブを止め、完了した線分までを記録してから終了する
+            try:
+                self.io.run(self.abort_job(), timeout=5)
+            except concurrent.futures.TimeoutError:
+                print('The job did not stop in time.')
             self.stop_stage()
             self.stop_laser()
+            self.telemetry.stop_recording()
+            self.stage.close()
+            self.laser.close()
             self.ser_stage.close()
             self.ser_laser.close()
         self.master.destroy()
         sys.exit()  # デーモン化してあるスレッドはここで死ぬ
 
-    def update(self):
+    def job_running(self) -> bool:
+        """
+        :rtype: bool
+        :return: True while a job of Command Mode is running
+        """
+        return self.job is not None and not self.job.done()
+
+    async def abort_job(self):
+        # 記録の書き込みと競合しないよう、ジョブと同じイベントループ上で止める
+        job = self.job
+        if not self.job_running():
+            return
+        job.cancel()
+        try:
+            await job  # move_shapeのfinallyで記録を閉じる
+        except (asyncio.CancelledError, Exception):
+            pass  # 例外はLoopThread.submitで表示済み
+
+    def on_joystick(self):
+        # ドラッグのたびに呼ばれる。送る命令の数はjog_limiterで抑える
+        if self.is_analog.get():
+            vel = self.analog.velocity(*self.oval.get_vector())
+            # 小さな変化は無視する (送信待ちがあれば最新の値に置き換える)
+            if self.analog.changed(vel) or self.analog_limiter.pending is not None:
+                self.analog_limiter.request(vel)
+            return
+        self.jog_limiter.request(self.oval.get_rank(), copy.copy(self.oval.get_direction()))
+
+    def on_joystick_release(self):
+        # 離したらjog_limiterを通さずすぐに止める
+        self.jog_limiter.cancel()
+        self.analog_limiter.cancel()
+        self.stop_stage()
+        self.rank_pre = 0
+        self.direction_pre = [0, 0, 0]
+        self.analog.sent = (0, 0)
+
+    def apply_joystick(self, rank: int, direction: list):
         # 動く or 止まる
-        self.check_and_move()
-        self.check_and_stop()
-        # previous変数を更新
-        self.rank_pre = self.oval.get_rank()
-        self.direction_pre = copy.copy(self.oval.get_direction())
-
-        self.master.after(self.cl.dt, self.update)
-
-    def check_and_move(self):
-        # 図形から操作された場合を検知
-        # XY方向
-        if self.rank_pre != self.oval.get_rank() or self.direction_pre != self.oval.get_direction():
+        if rank == 0:
+            # 前回までは動く命令、今回止まる命令が出ていればstopを呼び出す
+            if self.rank_pre != 0:
+                self.stop_stage()
+        elif self.rank_pre != rank or self.direction_pre != direction:
             # バグで方向が転換できないことがあるので、一度止めるようにする
-            if self.direction_pre != self.oval.get_direction():
+            if self.direction_pre != direction:
                 self.stop_stage()
-            if self.oval.direction[0] > 0:
+            if direction[0] > 0:
                 self.move_right()
-            elif self.oval.direction[0] < 0:
+            elif direction[0] < 0:
                 self.move_left()
-            if self.oval.direction[1] > 0:
+            if direction[1] > 0:
                 self.move_top()
-            elif self.oval.direction[1] < 0:
+            elif direction[1] < 0:
                 self.move_bottom()
+        self.rank_pre = rank
+        self.direction_pre = direction
 
-    def check_and_stop(self):
-        # 前回までは動く命令、今回止まる命令が出ていればstopを呼び出す
-        if self.rank_pre != 0 and self.oval.get_rank() == 0:
-            self.stop_stage()
+    def apply_analog(self, vel: tuple):
+        # 両軸を同時に、つまみの変位に応じた速度で動かす
+        if vel == (0, 0):
+            if self.analog.sent != (0, 0):
+                self.stop_stage()
+            self.analog.sent = vel
+            return
+        if self.cl.mode == 'DEBUG':
+            print(f'move x by {vel[0]} \u03bcm/s, y by {vel[1]} \u03bcm/s')
+        else:
+            pitch = self.get_pulse_pitch()
+            if self.is_auto_emission.get() and pitch is not None:  # 速さが変わるたびに周波数を合わせる
+                speed = (vel[0] ** 2 + vel[1] ** 2) ** 0.5
+                frq, limited = pitch.frequency(speed)
+                if limited != speed:
+                    vel = tuple(min(max(int(round(v * limited / speed)), -25000), 25000) for v in vel)
+                    # 軸ごとに速度の範囲で丸めたので、実際の速さから周波数を決め直す
+                    frq, _ = pitch.frequency((vel[0] ** 2 + vel[1] ** 2) ** 0.5)
+                self.emit(frq)
+            elif self.is_auto_emission.get() and self.analog.sent == (0, 0):  # 自動照射モード
+                self.emit()
+            for axis, v, v_pre in zip(['x', 'y'], vel, self.analog.sent):
+                if v == v_pre:
+                    continue
+                if v == 0:
+                    self.stage.stop_axis(axis)
+                else:
+                    self.stage.move_velocity(axis, v)
+            self.poller.wake()
+        self.analog.sent = vel
 
     def get_velocity(self):
         # entryに何も入っていないとエラーになってしまうので例外処理
@@ -255,17 +435,27 @@ class Application(tk.Frame):
         else:
             vel = self.get_velocity()
 
-        vel *= direction  # direction is 1 or -1
-
         if vel == 0:
             return
 
+        frq = None
+        pitch = self.get_pulse_pitch()
+        if self.is_auto_emission.get() and pitch is not None:
+            # パルスの間隔を保てない速さなら、保てる中で最も速い速度に変える
+            frq, speed = pitch.frequency(vel)
+            vel = min(max(int(round(speed)), 1), 25000)
+            # 速度の範囲で丸めたので、実際に送る速度から周波数を決め直す
+            frq, _ = pitch.frequency(vel)
+
+        vel *= direction  # direction is 1 or -1
+
         if self.cl.mode == 'DEBUG':
             print(f'move {axis} by {vel} \u03bcm/s')
         else:
             if self.is_auto_emission.get():  # 自動照射モード
-                self.emit()
+                self.emit(frq)
             self.stage.move_velocity(axis, vel)
+            self.poller.wake()  # 動き出したらすぐに速く問い合わせる
 
     def stop_stage(self, event=None):
         # xy方向に停止命令を出す
@@ -276,53 +466,78 @@ class Application(tk.Frame):
                 self.stop_laser()
             self.stage.stop()
 
-    def update_position(self):
+    async def update_position(self):
         # 現在位置を更新
-        # シリアル通信で受信する必要があるため，mainloopとは別threadで処理する．
+        # シリアル通信で受信する必要があるため，mainloopとは別のイベントループで処理する．
         while True:
             if self.cl.mode == 'DEBUG':
                 self.x_cur.set(int(self.x_cur.get() + 15))
                 self.y_cur.set(int(self.y_cur.get() + 15))
             else:
-                x, y = self.stage.get_position()
-                self.x_cur.set(x)
-                self.y_cur.set(-y)  # yは下向きだが、ユーザーは気にせず動かせるようにする
-                self.is_limit = self.stage.check_limit_all()  # 現在位置が機械限界か判定する
-            time.sleep(self.cl.dt * 0.001)
+                # 位置と機械限界の判定を1往復でまとめて取得する
+                status = await self.stage.aio.get_status()
+                self.x_cur.set(status.x)
+                self.y_cur.set(-status.y)  # yは下向きだが、ユーザーは気にせず動かせるようにする
+                self.is_limit = [status.limit_x, status.limit_y]  # 現在位置が機械限界か判定する
+                self.is_ready = [status.ready_x, status.ready_y]
+                frq = self.laser.aio.frq
+                self.telemetry.append(time.perf_counter(), status.x, status.y, status.limit_x, status.limit_y,
+                                      -1 if frq is None else frq)
+            self.poll_rate.set(f'Poll: {self.poller.effective_rate:.1f} Hz')
+            await self.poller.sleep(not all(self.is_ready))
 
     def set_origin(self):
         if self.cl.mode == 'DEBUG':
             print('set origin')
-        elif self.cl.mode == 'RELEASE':
+        elif self.cl.mode in ['RELEASE', 'SIMULATION']:
             for axis in ['x', 'y']:
                 self.stage.set_position(axis, 0)
 
-    def reset_origin(self):
+    async def reset_origin(self):
         if self.cl.mode == 'DEBUG':
             print('reset origin')
-        elif self.cl.mode == 'RELEASE':
-            for i, axis in enumerate(['x', 'y']):
-                self.stage.move_velocity(axis, 25000)
-                while not self.is_limit[i]:  # limitの判定はupdate_position内で取得している
-                    time.sleep(self.cl.dt * 0.001)
-                self.stage.set_position(axis, 7.35)  # 大体14.7mmが駆動範囲
-                self.stage.move_abs(axis, 0)  # 原点に戻す
-                time.sleep(3)
-
-    def emit(self):
-        frq = self.frq.get()
+        elif self.cl.mode in ['RELEASE', 'SIMULATION']:
+            self.poller.begin_job()
+            try:
+                for i, axis in enumerate(['x', 'y']):
+                    await self.stage.aio.move_velocity(axis, 25000)
+                    while not self.is_limit[i]:  # limitの判定はupdate_position内で取得している
+                        await asyncio.sleep(self.cl.dt * 0.001)
+                    await self.stage.aio.set_position(axis, 7.35)  # 大体14.7mmが駆動範囲
+                    await self.stage.aio.move_abs(axis, 0)  # 原点に戻す
+                    await asyncio.sleep(3)
+            finally:
+                self.poller.end_job()
+
+    def get_pulse_pitch(self):
+        """
+        :rtype: PulsePitch
+        :return: the pitch if the constant pitch mode is on and the pitch is valid, otherwise None
+        """
+        if not self.is_constant_pitch.get():
+            return None
+        try:
+            return PulsePitch(self.pulse_pitch.get())
+        except (tk.TclError, ValueError):
+            self.msg_laser.set('Pitch must be positive.')
+            return None
+
+    def emit(self, frq: int = None):
+        # frq is None: 入力された周波数
+        if frq is None:
+            frq = self.frq.get()
         if not 16 <= frq <= 10000:
             self.msg_laser.set('Frequency must be 16~10000 Hz.')
             return
-        if self.cl.mode == 'RELEASE':
+        if self.cl.mode in ['RELEASE', 'SIMULATION']:
             self.laser.set_frq(frq)
         elif self.cl.mode == 'DEBUG':
             print('Emit')
         self.msg_laser.set(f'Now: {frq} Hz (available: 16~10000 Hz)')
 
     def stop_laser(self):
-        if self.cl.mode == 'RELEASE':
-            self.laser.stop()
+        if self.cl.mode in ['RELEASE', 'SIMULATION']:
+            self.laser.stop(force=True)  # 画面からの停止は必ず送る
         elif self.cl.mode == 'DEBUG':
             print('Stop laser')
         self.msg_laser.set('Now: 0 Hz (available: 16~10000 Hz)')
@@ -336,9 +551,39 @@ class Application(tk.Frame):
             self.button_emit_laser.config(state=tk.ACTIVE)
             self.button_stop_laser.config(state=tk.ACTIVE)
 
+    def start_recording(self):
+        filename = filedialog.asksaveasfilename(defaultextension='.bin', filetypes=[('telemetry', '*.bin')])
+        if filename:
+            self.telemetry.start_recording(filename)
+
+    def stop_recording(self):
+        written = self.telemetry.stop_recording()
+        print(f'{written} samples recorded')
+
     def open_command_window(self):
         CommandWindow(self, self.cl, self.stage, self.laser)
 
+    def resume_job(self):
+        # 中断したジョブを、最後に完了した線分の終点から続ける
+        if self.job_running():
+            print('A job is running.')
+            return
+        if not (self.cl.journal_file and os.path.exists(self.cl.journal_file)):
+            print('No journal to resume.')
+            return
+        state = load_journal(self.cl.journal_file)
+        if state is None or state.finished:
+            print('The last job has finished.')
+            return
+        if 'shape' not in state.settings:
+            print('The last job was not started from Command Mode.')
+            return
+        if messagebox.askyesno('確認', f'{state.done}本の線分が完了しています。続きから再開しますか？'):
+            CommandWindow(self, self.cl, self.stage, self.laser).resume(state)
+
+    def open_stats_window(self):
+        StatsWindow(self)
+
 
 def main():
     root = tk.Tk()
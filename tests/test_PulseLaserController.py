@@ -0,0 +1,27 @@
+# python -m pytest tests
+import asyncio
+from PulseLaserController import AsyncPulseLaserController, LaserPort
+from SerialTransport import SerialTransport
+from VirtualDevice import VirtualPulseLaser, VirtualPulseLaserDevice
+
+
+def test_forced_stop_cancels_scheduled_switch():
+    device = VirtualPulseLaserDevice(boot_time=0)
+
+    async def run():
+        transport = SerialTransport(LaserPort(VirtualPulseLaser(device=device)), read_replies=False, name='laser')
+        await transport.start()
+        laser = AsyncPulseLaserController(transport)
+        try:
+            task = laser.schedule(0.1, True, 100)
+            await laser.stop(force=True)
+            await asyncio.sleep(0.3)
+        finally:
+            await transport.close()
+        return laser, task
+
+    laser, task = asyncio.run(run())
+    assert task.cancelled()
+    assert laser.frq == 0
+    assert device.frq == 0
+    assert all(frq == 0 for _, frq in device.history)
@@ -0,0 +1,54 @@
+# python -m pytest tests
+import asyncio
+from SerialTransport import SerialTransport
+from VirtualDevice import VirtualDS102, VirtualDS102Device
+
+
+class DroppingDevice(VirtualDS102Device):
+    """
+    virtual DS102 which loses the reply to the first READY?
+    """
+    def __init__(self):
+        super().__init__()
+        self.dropped = False
+
+    def handle(self, line: str, t: float):
+        reply = super().handle(line, t)
+        if line.endswith('READY?') and not self.dropped:
+            self.dropped = True
+            return None
+        return reply
+
+
+def test_query_after_lost_reply():
+    async def run():
+        ser = VirtualDS102(device=DroppingDevice(), reply_timeout=0.2)
+        transport = SerialTransport(ser, name='stage')
+        await transport.start()
+        try:
+            lost = await transport.query('AXIs1:READY?')
+            replies = [await transport.query(msg) for msg in ['AXIs1:POSition?', 'AXIs1:SELectSPeed?', 'AXIs1:READY?']]
+        finally:
+            await transport.close()
+        return lost, replies, transport.stats
+
+    lost, replies, stats = asyncio.run(run())
+    assert lost == ''
+    assert replies == ['0.000', '0', '1']
+    assert stats.resyncs == 1
+    assert sum(stats.timeouts.values()) == 1
+
+
+def test_concurrent_queries_after_lost_reply():
+    async def run():
+        ser = VirtualDS102(device=DroppingDevice(), reply_timeout=0.2)
+        transport = SerialTransport(ser, name='stage')
+        await transport.start()
+        try:
+            # 失われた返答の後ろに並んだ問い合わせは取り消されるが、その後はずれない
+            await asyncio.gather(*(transport.query(msg) for msg in ['AXIs1:READY?', 'AXIs1:POSition?', 'AXIs2:READY?']))
+            return await transport.query_many(['AXIs1:POSition?', 'AXIs1:SELectSPeed?', 'AXIs2:READY?'])
+        finally:
+            await transport.close()
+
+    assert asyncio.run(run()) == ['0.000', '0', '1']